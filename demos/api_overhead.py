@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Microbenchmark of the per-call overhead of relayr.api.Api.
+
+This starts a local stub server answering every request with a small
+JSON document and measures the mean time per call of:
+
+- plain ``requests`` calls on a pooled session (the baseline),
+- ``Api.perform_request`` with a pooled session, for GET and POST,
+- the same with ``config.LOG`` enabled, logging below the logger level.
+
+No credentials or network access are needed. Usage::
+
+    python demos/api_overhead.py [number of calls]
+"""
+
+import sys
+import json
+import time
+import logging
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import requests
+
+from relayr import config
+from relayr.api import Api
+
+
+BODY = json.dumps({'database': 'ok', 'items': list(range(20))}).encode('utf-8')
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    "Answer every request with the same JSON body over a kept-alive connection."
+
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _answer(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if length:
+            self.rfile.read(length)
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(BODY)))
+        self.end_headers()
+        self.wfile.write(BODY)
+
+    do_GET = do_POST = _answer
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+
+def measure(name, func, n):
+    "Print and return the mean time per call of a function in microseconds."
+
+    func()
+    t0 = time.time()
+    for i in range(n):
+        func()
+    us = (time.time() - t0) / n * 1e6
+    print('%-40s %8.1f us/call' % (name, us))
+    return us
+
+
+def main(n=2000):
+    server = StubServer(('localhost', 0), StubHandler)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    config.relayrAPI = host = 'http://localhost:%d' % server.server_port
+    url = host + '/server-status'
+    data = {'readings': [{'meaning': 'temperature', 'value': 21.5}]}
+
+    session = requests.Session()
+    base = measure('requests.Session GET', lambda: session.get(url).json(), n)
+
+    api = Api(session=requests.Session())
+    headers = api.headers
+    get = measure('Api GET', lambda: api.perform_request('GET', url,
+        headers=headers), n)
+    measure('Api POST', lambda: api.perform_request('POST', url, data=data,
+        headers=headers), n)
+
+    config.LOG = True
+    config.LOG_DIR = '/tmp'
+    api = Api(session=requests.Session())
+    api.logger.setLevel(logging.WARNING)
+    measure('Api GET (LOG on, level WARNING)', lambda: api.perform_request('GET',
+        url, headers=headers), n)
+    config.LOG = False
+
+    print('Api overhead per GET: %.1f us' % (get - base))
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Memory benchmark of device inventories held as different representations.
+
+This builds a synthetic inventory of devices as returned by the relayr API
+(with embedded models of a few device types) and measures the memory kept
+by the inventory when held as:
+
+- the plain dicts decoded from JSON,
+- :py:class:`relayr.resources.Device` objects,
+- :py:class:`relayr.compact.CompactDevice` objects with shared models.
+
+Memory is measured with ``tracemalloc`` (Python 3.4+), which also slows
+down the measured times considerably. No credentials or
+network access are needed. Usage::
+
+    python demos/compact_memory.py [number of devices]
+"""
+
+import sys
+import gc
+import json
+import time
+import tracemalloc
+
+from relayr.resources import Device
+from relayr.compact import CompactDevice
+
+
+MODELS = [{
+    'id': 'model-%d' % m,
+    'name': 'Wunderbar Sensor %d' % m,
+    'manufacturer': 'Relayr GmbH',
+    'readings': [{'meaning': meaning, 'unit': unit, 'minimum': 0,
+        'maximum': 100, 'precision': 0.25} for meaning, unit in
+        [('temperature', 'celsius'), ('humidity', 'percent'),
+         ('luminosity', 'lx')][:m % 3 + 1]],
+} for m in range(6)]
+
+
+def inventory_text(n):
+    "Return a JSON list of n devices like the one of ``GET /devices/public``."
+
+    return json.dumps([{
+        'id': '%08x-0000-4000-8000-%012x' % (i, i),
+        'name': 'My Wunderbar Sensor %d' % i,
+        'description': '',
+        'owner': 'owner-%d' % (i % 50),
+        'firmwareVersion': '1.0.0',
+        'public': True,
+        'model': MODELS[i % len(MODELS)],
+    } for i in range(n)])
+
+
+def measure(name, build, text):
+    "Print time and memory of building an inventory from JSON text."
+
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.time()
+    inventory = build(json.loads(text))
+    elapsed = time.time() - t0
+    gc.collect()
+    size = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    print('%-24s %8.1f MB %8.0f bytes/device %6.2f s' %
+        (name, size / 1e6, float(size) / len(inventory), elapsed))
+    return size
+
+
+def as_devices(items):
+    return [Device(d['id']).set_fields(d) for d in items]
+
+
+def as_compact(items):
+    models, strings = {}, {}
+    return [CompactDevice.from_json(d, models, strings) for d in items]
+
+
+def main(n=100000):
+    text = inventory_text(n)
+    print('%d devices, %.1f MB of JSON' % (n, len(text) / 1e6))
+    dicts = measure('dicts', list, text)
+    measure('resources.Device', as_devices, text)
+    compact = measure('compact.CompactDevice', as_compact, text)
+    print('compact / dicts: %.2f' % (float(compact) / dicts))
+
+
+if __name__ == '__main__':
+    main(*map(int, sys.argv[1:]))
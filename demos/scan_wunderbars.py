@@ -73,21 +73,21 @@ def scan_wunderbars():
     devices = scan_ble_devices(name_filter='Wunderbar.*')
     for dev in devices:
         print("Discovered device: %(addr)s %(name)s " % dev)
-        d = GattDevice(dev['addr'])
-        chars = d.characteristics()
-        for char in chars:
-            if len(char['_uuid']) == 4:
-                print('  characteristic uuid: %s' % char['uuid'])
-                h = char['name_handle']
-                dat = d.char_read_hnd(h)
-                args = (h, dat, repr(data2str(dat)))
-                print('    name handle: %s, data: %s, str: %s' % args)
-                h = char['value_handle']
-                dat = d.char_read_hnd(h)
-                args = (h, dat, repr(data2str(dat)))
-                print('    value handle: %s, data: %s, str: %s' % args)
-        print('  device name: %s' % d.read_device_name())
-        print('  battery level: %s' % d.read_battery_level())
+        with GattDevice(dev['addr']) as d:
+            chars = d.characteristics()
+            for char in chars:
+                if len(char['_uuid']) == 4:
+                    print('  characteristic uuid: %s' % char['uuid'])
+                    h = char['name_handle']
+                    dat = d.char_read_hnd(h)
+                    args = (h, dat, repr(data2str(dat)))
+                    print('    name handle: %s, data: %s, str: %s' % args)
+                    h = char['value_handle']
+                    dat = d.char_read_hnd(h)
+                    args = (h, dat, repr(data2str(dat)))
+                    print('    value handle: %s, data: %s, str: %s' % args)
+            print('  device name: %s' % d.read_device_name())
+            print('  battery level: %s' % d.read_battery_level())
         print('')
 
 
@@ -14,38 +14,97 @@ import platform
 import urllib
 import warnings
 import logging
+import functools
+import threading
 
 import requests
 
 from relayr import config
+from relayr.log import get_logger
+from relayr.jsonstream import iter_json_array
+from relayr.compression import wire_size
 from relayr.version import __version__
-from relayr.compat import PY26
+from relayr.compat import PY26, urlparse
+from relayr.retry import RetryPolicy, CircuitBreaker
 from relayr.exceptions import RelayrApiException
 
 
 def create_logger(sender):
-    """Create a logger for the requesting object."""
+    """
+    Return the logger shared by all API objects.
+
+    Kept for backwards compatibility, see :py:func:`relayr.log.get_logger`.
+    """
+    return get_logger()
+
+
+# the maximum number of characters of a response body logged
+MAX_LOGGED_BODY = 1024
 
-    logger = logging.getLogger('Relayr API Client')
-    logger.setLevel(logging.DEBUG)
 
-    logfile = "{0}/relayr-api-{1}.log".format(config.LOG_DIR, id(sender))
-    h = logging.FileHandler(logfile)
-    # h = logging.RotatingFileHandler(logfile,
-    #     mode='a', maxBytes=2**14, backupCount=5, encoding=None, delay=0)
+def _truncate(text, size=MAX_LOGGED_BODY):
+    "Shorten a text to a size for logging."
 
-    # h.setLevel(logging.DEBUG)
+    if len(text) <= size:
+        return text
+    return '%s... (%d characters)' % (text[:size], len(text))
 
-    # create formatter and add it to the handler(s)
-    fmt = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-    formatter = logging.Formatter(fmt, '%Y-%m-%d %H:%M:%S.%f %Z%z')
-    formatter.converter = time.gmtime
-    h.setFormatter(formatter)
 
-    # add the handler(s) to the logger
-    logger.addHandler(h)
+class _Lazy(object):
+    "A log message argument computed only if the message is formatted."
+
+    def __init__(self, func, *args):
+        self.func = func
+        self.args = args
+
+    def __str__(self):
+        return self.func(*self.args)
+
+
+class SingleFlight(object):
+    """
+    Lets concurrent calls with the same key share one execution.
+
+    The first caller of :py:meth:`do` for a key runs the function, callers
+    arriving meanwhile wait for it and get the same result or exception.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.shared = 0
+
+    def do(self, key, func):
+        """
+        Call a function unless a call with the same key is in flight.
+
+        :param key: A hashable key identifying identical calls.
+        :param func: The function to be called without arguments.
+        :rtype: The result of the function.
+        """
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = {'done': threading.Event()}
+            else:
+                self.shared += 1
+        if not leader:
+            call['done'].wait()
+            if 'error' in call:
+                raise call['error']
+            return call['result']
+        try:
+            call['result'] = func()
+        except Exception as e:
+            call['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call['done'].set()
+        return call['result']
 
-    return logger
 
 def build_curl_call(method, url, data=None, headers=None):
     """
@@ -95,15 +154,54 @@ class Api(object):
         assert a.get_public_device_model_meanings() > 0
     """
 
-    def __init__(self, token=None):
+    def __init__(self, token=None, session=None, cache=None, coalesce=True,
+        limiter=None, timeout=(10, 60), retry=None, breaker=None,
+        json_codec=None, compression=None):
         """
         Object construction.
 
         :param token: A token generated on the relayr platform for a combination of
             a relayr user and application.
         :type token: string
+        :param session: A session whose pooled connections are reused for
+            all requests, instead of opening a new connection per request.
+        :type session: ``requests.Session``
+        :param cache: A cache for results of ``GET`` requests.
+        :type cache: :py:class:`relayr.httpcache.ResponseCache`
+        :param coalesce: Flag indicating if identical concurrent ``GET``
+            requests share one HTTP request and its result.
+        :type coalesce: bool
+        :param limiter: A limiter of request rate and concurrency.
+        :type limiter: :py:class:`relayr.ratelimit.RateLimiter`
+        :param timeout: The connect and read timeouts in seconds. The read
+            timeout is shortened to the time left before the ``deadline``
+            of the retry policy.
+        :type timeout: tuple
+        :param retry: The policy for retrying failed requests, by default
+            a :py:class:`relayr.retry.RetryPolicy` with default arguments.
+        :type retry: :py:class:`relayr.retry.RetryPolicy`
+        :param breaker: The circuit breaker for failing hosts, by default
+            a :py:class:`relayr.retry.CircuitBreaker` with default arguments.
+        :type breaker: :py:class:`relayr.retry.CircuitBreaker`
+        :param json_codec: A module or object with ``dumps`` and ``loads``
+            functions used for request and response bodies, e.g. ``ujson``,
+            by default the standard ``json`` module.
+        :type json_codec: module
+        :param compression: Settings for compressed responses and request
+            bodies, collecting transfer statistics.
+        :type compression: :py:class:`relayr.compression.Compression`
         """
         self.token = token
+        self.session = session
+        self.cache = cache
+        self.coalesce = coalesce
+        self.limiter = limiter
+        self.timeout = timeout
+        self.retry = RetryPolicy() if retry is None else retry
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.json_codec = json_codec or json
+        self.compression = compression
+        self._flights = SingleFlight()
         self.host = config.relayrAPI
         self.useragent = config.userAgent
         self.headers = {
@@ -114,7 +212,7 @@ class Api(object):
             self.headers['Authorization'] = 'Bearer {0}'.format(self.token)
 
         if config.LOG:
-            self.logger = create_logger(self)
+            self.logger = get_logger()
             self.logger.info('started')
 
         # check if the API is available
@@ -125,8 +223,9 @@ class Api(object):
 
     def __del__(self):
         """Object destruction."""
-        if config.LOG:
-            self.logger.info('terminated')
+        logger = getattr(self, 'logger', None)
+        if logger is not None:
+            logger.info('terminated')
 
     def perform_request(self, method, url, data=None, headers=None):
         """
@@ -147,46 +246,240 @@ class Api(object):
         is raised which contains the API call (method and URL) plus
         a ``curl`` command replicating the API call for debugging reuse
         on the command-line.
-        """
-        if config.LOG:
-            command = build_curl_call(method, url, data, headers)
-            self.logger.info("API request: " + command)
 
-        json_data = 'null'
-        if data is not None:
-            json_data = json.dumps(data)
-            try:
-                json_data = json_data.encode('utf-8')
-            except (UnicodeDecodeError, AttributeError):
-                # bytes/str - no need to re-encode
-                pass
-
-        func = getattr(requests, method.lower())
-        resp = func(url, data=json_data or '', headers=headers or {})
-        resp.connection.close()
+        If a ``cache`` is set, fresh cached results of ``GET`` requests are
+        returned without a request, stale ones are revalidated and other
+        requests invalidate cached results of the same resource.
+
+        If ``compression`` is set, compressed responses are requested and
+        large request bodies are compressed.
+
+        If a ``limiter`` is set, requests wait for their turn and throttled
+        requests (``429`` and ``503`` responses) are sent again later.
+
+        Failed requests are retried according to the ``retry`` policy and
+        requests to hosts failing repeatedly are refused by the ``breaker``
+        with a ``CircuitOpenException``.
+
+        If ``coalesce`` is set, a ``GET`` request identical to one already
+        in flight in another thread waits for and returns the same result
+        (or exception) instead of sending another request.
+        """
+        if self.coalesce and method.upper() == 'GET':
+            key = (url, tuple(sorted((headers or {}).items())))
+            return self._flights.do(key,
+                lambda: self._perform_request(method, url, data, headers))
+        return self._perform_request(method, url, data, headers)
+
+    def _perform_request(self, method, url, data=None, headers=None):
+        cache = self.cache
+        entry = None
+        if cache is not None:
+            if method.upper() == 'GET':
+                fresh, entry, conditions = cache.lookup(url, headers)
+                if fresh:
+                    return 200, entry['data']
+                if conditions:
+                    headers = dict(headers or {}, **conditions)
+            else:
+                cache.invalidate(url)
 
         if config.LOG:
-            hd = dict(resp.headers.items())
-            self.logger.info("API response headers: " + json.dumps(hd))
-            self.logger.info("API response content: " + resp.content)
+            self.logger.debug("API request: %s",
+                _Lazy(build_curl_call, method, url, data, headers))
 
+        body = None
+        if data is not None:
+            body = self.json_codec.dumps(data)
+            if not isinstance(body, bytes):
+                body = body.encode('utf-8')
+
+        compression = self.compression
+        if compression is not None:
+            headers = dict(headers or {})
+            headers['Accept-Encoding'] = compression.accept_encoding
+            if body is not None:
+                body, encoding = compression.encode(body)
+                if encoding:
+                    headers['Content-Encoding'] = encoding
+
+        t0 = time.time()
+        resp, _ = self._execute(method, url, body, headers)
         status = resp.status_code
+        if cache is not None and method.upper() != 'GET':
+            # again, in case a result was cached while the request was sent
+            cache.invalidate(url)
+        if compression is not None:
+            compression.record_response(len(resp.content), wire_size(resp))
+
+        if config.LOG:
+            level = logging.WARNING if status >= 400 else logging.INFO
+            self.logger.log(level, "API call: %s %s %d", method.upper(), url,
+                status, extra={'method': method.upper(), 'url': url,
+                'status': status, 'duration': round(time.time() - t0, 6),
+                'sample': True})
+            self.logger.debug("API response headers: %s",
+                _Lazy(lambda: json.dumps(dict(resp.headers.items()))))
+            self.logger.debug("API response content: %s",
+                _Lazy(lambda: _truncate(resp.content.decode('utf-8', 'replace'))))
+
+        if status == 304 and entry is not None:
+            entry = cache.refresh(url, headers, resp.headers, entry)
+            return 200, entry['data']
         if 200 <= status < 300:
             try:
-                js = resp.json()
+                js = self._decode(resp)
             except:
                 js = None
                 # raise ValueError('Invalid JSON code(?): %r' % resp.content)
                 if config.DEBUG:
                     warnings.warn("Replaced suspicious API response (invalid JSON?) %r with 'null'!" % resp.content)
+            if cache is not None and method.upper() == 'GET':
+                cache.store(url, headers, resp.headers, js)
             return status, js
         else:
-            args = (resp.json()['message'], method.upper(), url)
+            args = (self._decode(resp)['message'], method.upper(), url)
             msg = "{0} - {1} {2}".format(*args)
             command = build_curl_call(method, url, data, headers)
             msg = "%s - %s" % (msg, command)
             raise RelayrApiException(msg)
 
+    def stream_request(self, method, url, headers=None, chunk_size=8192):
+        """
+        Perform an API call returning a JSON array and yield its elements
+        while the response body is still arriving.
+
+        :param method: HTTP request method, usually ``GET``.
+        :type method: string
+        :param url: Full HTTP path.
+        :type url: string
+        :param headers: Additional HTTP request headers.
+        :type headers: dictionary
+        :param chunk_size: The number of bytes read at once.
+        :type chunk_size: int
+        :rtype: A generator of decoded array elements.
+
+        The request is sent when iteration starts. Rate limiter, retry
+        policy and circuit breaker apply as in :py:meth:`perform_request`,
+        but results are neither cached nor shared between callers.
+        Status codes other than 2XX raise a ``RelayrApiException``.
+        """
+        if config.LOG:
+            self.logger.debug("API request: %s",
+                _Lazy(build_curl_call, method, url, None, headers))
+        compression = self.compression
+        if compression is not None:
+            headers = dict(headers or {})
+            headers['Accept-Encoding'] = compression.accept_encoding
+        received = [0]
+        def chunks():
+            for chunk in resp.iter_content(chunk_size):
+                received[0] += len(chunk)
+                yield chunk
+
+        t0 = time.time()
+        resp, release = self._execute(method, url, None, headers, stream=True)
+        try:
+            status = resp.status_code
+            if config.LOG:
+                level = logging.WARNING if status >= 400 else logging.INFO
+                self.logger.log(level, "API call: %s %s %d", method.upper(),
+                    url, status, extra={'method': method.upper(), 'url': url,
+                    'status': status, 'duration': round(time.time() - t0, 6),
+                    'stream': True, 'sample': True})
+            if not 200 <= status < 300:
+                args = (self._decode(resp)['message'], method.upper(), url)
+                msg = "{0} - {1} {2}".format(*args)
+                command = build_curl_call(method, url, None, headers)
+                raise RelayrApiException("%s - %s" % (msg, command))
+            for item in iter_json_array(chunks()):
+                yield item
+        finally:
+            if compression is not None:
+                compression.record_response(received[0], wire_size(resp))
+            resp.close()
+            if release is not None:
+                release()
+
+    def _execute(self, method, url, body, headers, stream=False):
+        """
+        Send a request applying rate limiter, retry policy and circuit
+        breaker, return the final response and a function to be called
+        when it has been read, or None. The circuit breaker records one
+        result per call, after all retries.
+
+        Throttled requests are sent again for ``429`` responses and, for
+        idempotent methods only, for ``503`` responses, which may also come
+        from a proxy after the request was processed. A streamed response
+        keeps its slot of the limiter until its function is called.
+        """
+        limiter, retry, breaker = self.limiter, self.retry, self.breaker
+        host = urlparse(url).netloc
+        deadline = time.time() + retry.deadline
+        idempotent = method.upper() in retry.methods
+        attempt = throttled = 0
+        breaker.check(host)
+        while True:
+            group = limiter.acquire(url) if limiter is not None else None
+            try:
+                resp = self._send(method, url, body, headers, deadline, stream)
+            except requests.RequestException as e:
+                if limiter is not None:
+                    limiter.release(group)
+                if not retry.should_retry(method, attempt, deadline, error=e):
+                    breaker.record(host, error=e)
+                    raise
+            except Exception:
+                if limiter is not None:
+                    limiter.release(group)
+                breaker.cancel(host)
+                raise
+            else:
+                status = resp.status_code
+                release = None
+                if limiter is not None:
+                    release = functools.partial(limiter.release, group, status,
+                        resp.headers.get('Retry-After'))
+                    if (status == 429 or status == 503 and idempotent) \
+                            and throttled < limiter.max_retries:
+                        release()
+                        throttled += 1
+                        resp.close()
+                        continue
+                if not retry.should_retry(method, attempt, deadline,
+                        status=status):
+                    breaker.record(host, status=status)
+                    if release is not None and not stream:
+                        release()
+                        release = None
+                    return resp, release
+                if release is not None:
+                    release()
+                resp.close()
+            time.sleep(retry.delay(attempt, deadline))
+            attempt += 1
+
+    def _send(self, method, url, body, headers, deadline, stream=False):
+        """
+        Send a request with an encoded body or None and return the response.
+
+        Streamed responses must be closed by the caller.
+        """
+        connect, read = self.timeout
+        timeout = (connect, max(0.001, min(read, deadline - time.time())))
+        if self.session is not None:
+            return self.session.request(method, url, data=body,
+                headers=headers, timeout=timeout, stream=stream)
+        resp = requests.request(method, url, data=body, headers=headers,
+            timeout=timeout, stream=stream)
+        if not stream:
+            resp.connection.close()
+        return resp
+
+    def _decode(self, resp):
+        "Return the JSON content of a response decoded with the JSON codec."
+
+        return self.json_codec.loads(resp.content.decode('utf-8'))
 
     # ..............................................................................
     # System
@@ -441,16 +734,21 @@ class Api(object):
         _, data = self.perform_request('GET', url, headers=self.headers)
         return data
 
-    def get_user_devices(self, userID):
+    def get_user_devices(self, userID, stream=False):
         """
         Get all devices registered for a user with a specific UUID.
 
         :param userID: the users's UUID
         :type userID: string
+        :param stream: flag to return a generator yielding each device
+            as soon as it is received, see :py:meth:`stream_request`
+        :type stream: bool
         :rtype: list of dicts ...
         """
         # https://api.relayr.io/users/%s/devices
         url = '{0}/users/{1}/devices'.format(self.host, userID)
+        if stream:
+            return self.stream_request('GET', url, headers=self.headers)
         _, data = self.perform_request('GET', url, headers=self.headers)
         return data
 
@@ -606,14 +904,19 @@ class Api(object):
     # Applications
     # ..............................................................................
 
-    def get_public_apps(self):
+    def get_public_apps(self, stream=False):
         """
         Get a list of all public relayr applications on the relayr platform.
 
+        :param stream: flag to return a generator yielding each application
+            as soon as it is received, see :py:meth:`stream_request`
+        :type stream: bool
         :rtype: list of dicts, each representing a relayr application
         """
         # https://api.relayr.io/apps
         url = '{0}/apps'.format(self.host)
+        if stream:
+            return self.stream_request('GET', url, headers=self.headers)
         _, data = self.perform_request('GET', url, headers=self.headers)
         return data
 
@@ -923,18 +1226,23 @@ class Api(object):
         _, data = self.perform_request('POST', url, data=data, headers=self.headers)
         return data
 
-    def get_public_devices(self, meaning=''):
+    def get_public_devices(self, meaning='', stream=False):
         """
         Get list of all public devices on the relayr platform filtered by meaning.
 
         :param meaning: required meaning in the device model's ``readings`` attribute
         :type meaning: string
+        :param stream: flag to return a generator yielding each device
+            as soon as it is received, see :py:meth:`stream_request`
+        :type stream: bool
         :rtype: list of dicts, each representing a relayr device
         """
         # https://api.relayr.io/devices/public
         url = '{0}/devices/public'.format(self.host)
         if meaning:
             url += '?meaning={0}'.format(meaning)
+        if stream:
+            return self.stream_request('GET', url)
         _, data = self.perform_request('GET', url)
         return data
 
@@ -0,0 +1,259 @@
+# -*- coding: utf-8 -*-
+
+"""
+Asyncio Data Streams
+
+This module provides an MQTT stream driven by an asyncio event loop instead
+of a thread, so messages can be consumed without locks or cross-thread
+queues. It needs Python 3.5 or above and is not imported by the package.
+
+Example:
+
+.. code-block:: python
+
+    import asyncio
+    from relayr import Client
+    from relayr.asyncstream import AsyncMqttStream
+
+    async def main():
+        c = Client(token='<my_access_token>')
+        dev = c.get_device(id='<my_device_id>')
+        async with AsyncMqttStream([dev]) as stream:
+            async for topic, payload in stream:
+                print('%s %s' % (topic, payload))
+
+    asyncio.get_event_loop().run_until_complete(main())
+"""
+
+import asyncio
+import collections
+
+import paho.mqtt.client as mqtt
+
+from relayr.dataconnection import fetch_mqtt_certificate
+
+
+class AsyncMqttStream(object):
+    "MQTT stream reading data from devices in the relayr cloud into asyncio."
+
+    def __init__(self, devices, maxsize=10000, transport='mqtt'):
+        """
+        Prepares an MQTT stream for one or more devices.
+
+        Channel credentials are created when the stream is started.
+
+        :param devices: Device objects from which to receive data.
+        :type devices: list
+        :param maxsize: Maximum number of buffered messages, if exceeded
+            the oldest ones are dropped and counted in ``dropped``.
+        :type maxsize: int
+        :param transport: Name of the transport method, right now only 'mqtt'.
+        :type transport: string
+        """
+        self.devices = list(devices)
+        self.maxsize = maxsize
+        self.transport = transport
+        self.credentials_list = []
+        self.topics = []
+        self.client = None
+        self.dropped = 0
+        self._buffer = collections.deque()
+        self._ready = asyncio.Event()
+        self._stopped = False
+        self._loop = None
+        self._sock = None
+        self._fd = None
+        self._misc_task = None
+
+    async def start(self):
+        """
+        Create channel credentials, connect to the MQTT server and subscribe.
+
+        Blocking steps (HTTP requests, TCP/TLS handshake) are run in the
+        default executor of the event loop.
+        """
+        loop = self._loop = asyncio.get_event_loop()
+        self.credentials_list = await loop.run_in_executor(None,
+            lambda: [dev.create_channel(self.transport) for dev in self.devices])
+        self.topics = [credentials['credentials']['topic']
+            for credentials in self.credentials_list]
+
+        creds = self.credentials_list[0]['credentials']
+        c = self.client = mqtt.Client(client_id=creds['clientId'])
+        c.on_connect = self.on_connect
+        c.on_message = self.on_message
+        c.username_pw_set(creds['user'], creds['password'])
+
+        # only encryption, no authentication
+        c.tls_insecure_set(True)
+        cert_path = await loop.run_in_executor(None, fetch_mqtt_certificate)
+        c.tls_set(ca_certs=cert_path)
+
+        await loop.run_in_executor(None,
+            lambda: c.connect('mqtt.relayr.io', port=8883, keepalive=60))
+        self._watch_socket()
+        self._misc_task = asyncio.ensure_future(self._misc_loop())
+
+    async def stop(self):
+        """
+        Unsubscribe, disconnect and end all pending iterations.
+        """
+        if self._stopped:
+            return
+        self._stopped = True
+        if self._misc_task is not None:
+            self._misc_task.cancel()
+        if self.client is not None:
+            for t in self.topics:
+                self.client.unsubscribe(t)
+            self._unwatch_socket()
+            self.client.disconnect()
+            self.client.loop_write()
+        self._ready.set()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, exc_type, exc, tb):
+        await self.stop()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        """
+        Return the next message as a (topic, payload) tuple.
+
+        Raises ``StopAsyncIteration`` when the stream was stopped and all
+        buffered messages have been consumed.
+        """
+        while not self._buffer:
+            if self._stopped:
+                raise StopAsyncIteration
+            self._ready.clear()
+            await self._ready.wait()
+        return self._buffer.popleft()
+
+    async def get_batch(self, n, timeout=None):
+        """
+        Return a list of up to ``n`` buffered (topic, payload) tuples.
+
+        Waits until ``n`` messages are available, the timeout has expired
+        or the stream was stopped, whichever comes first. The list may be
+        empty.
+
+        :param n: The maximum number of messages to return.
+        :type n: int
+        :param timeout: The maximum waiting time in seconds, or ``None``
+            to wait without limit.
+        :type timeout: float
+        :rtype: list
+        """
+        loop = asyncio.get_event_loop()
+        deadline = None if timeout is None else loop.time() + timeout
+        while len(self._buffer) < n and not self._stopped:
+            remaining = None
+            if deadline is not None:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+            self._ready.clear()
+            try:
+                await asyncio.wait_for(self._ready.wait(), remaining)
+            except asyncio.TimeoutError:
+                break
+        buf = self._buffer
+        return [buf.popleft() for i in range(min(n, len(buf)))]
+
+    def qsize(self):
+        "Return the number of currently buffered messages."
+
+        return len(self._buffer)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if not self._stopped:
+            for t in self.topics:
+                self.client.subscribe(t)
+
+    def on_message(self, client, userdata, msg):
+        """
+        Buffer the message topic and payload as strings.
+        """
+        buf = self._buffer
+        if len(buf) >= self.maxsize:
+            buf.popleft()
+            self.dropped += 1
+        buf.append((msg.topic, msg.payload.decode('utf-8')))
+        self._ready.set()
+
+    # event loop integration of the paho client
+
+    def _watch_socket(self):
+        self._sock = self.client.socket()
+        # watch the file descriptor, the socket may be closed by paho first
+        self._fd = self._sock.fileno()
+        self._loop.add_reader(self._fd, self._on_readable)
+        self._flush()
+
+    def _unwatch_socket(self):
+        if self._sock is not None:
+            self._loop.remove_reader(self._fd)
+            self._loop.remove_writer(self._fd)
+            self._sock = None
+
+    def _flush(self):
+        "Watch the socket for writing as long as the client has data to send."
+
+        if self._sock is None:
+            return
+        if self.client.want_write():
+            self._loop.add_writer(self._fd, self._on_writable)
+        else:
+            self._loop.remove_writer(self._fd)
+
+    def _on_readable(self):
+        rc = self.client.loop_read()
+        # TLS may have decrypted more data than reported by the socket
+        while rc == mqtt.MQTT_ERR_SUCCESS and self._sock is not None \
+                and getattr(self._sock, 'pending', lambda: 0)():
+            rc = self.client.loop_read()
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            self._connection_lost()
+        else:
+            self._flush()
+
+    def _on_writable(self):
+        rc = self.client.loop_write()
+        if rc != mqtt.MQTT_ERR_SUCCESS:
+            self._connection_lost()
+        else:
+            self._flush()
+
+    def _connection_lost(self):
+        self._unwatch_socket()
+        if not self._stopped:
+            asyncio.ensure_future(self._reconnect())
+
+    async def _reconnect(self, delay=1):
+        "Reconnect after a growing delay, subscribing again on success."
+
+        while not self._stopped:
+            await asyncio.sleep(delay)
+            try:
+                await self._loop.run_in_executor(None, self.client.reconnect)
+            except (OSError, IOError):
+                delay = min(delay * 2, 60)
+                continue
+            if not self._stopped:
+                self._watch_socket()
+            return
+
+    async def _misc_loop(self):
+        "Handle keepalive pings and message retries once per second."
+
+        while not self._stopped:
+            await asyncio.sleep(1)
+            if self._sock is not None:
+                self.client.loop_misc()
+                self._flush()
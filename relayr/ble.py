@@ -20,14 +20,28 @@ Example:
      {'addr': 'F2:EE:50:45:39:74', 'name': 'WunderbarGYRO'}]
 """
 
+import os
 import re
 import sys
+import json
 import time
+import heapq
 import shlex
+import signal
+import struct
+import binascii
+import warnings
+import threading
+import traceback
 import subprocess
+from os.path import exists, join, expanduser, dirname
 
 import pexpect
 
+from relayr import config
+from relayr.compat import PY2, Queue
+from relayr.exceptions import RelayrException
+
 
 # Device information service
 Device_Name_UUID = '2a00'
@@ -37,6 +51,63 @@ Hardware_Revision_UUID = '2a27'
 # Battery service
 Battery_Level_UUID = '2a19'
 
+# gatttool output lines, which use '=' in non-interactive and ':' in
+# interactive mode between names and values
+_primary_pat = re.compile('attr handle\s*[=:]\s*0x[0-9a-fA-F]{4},\s*end grp handle\s*[=:]\s*0x[0-9a-fA-F]{4}\s*uuid:\s*[0-9a-fA-F\-]{36}')
+_char_pat = re.compile('handle\s*[=:]\s*(?P<name_handle>0x[0-9a-fA-F]{4}),\s*char\s*properties\s*[=:]\s*(?P<properties>0x[0-9a-fA-F]+),\s*char\s*value\s*handle\s*[=:]\s*(?P<value_handle>0x[0-9a-fA-F]{4}),\s*uuid\s*[=:]\s*(?P<uuid>[0-9a-fA-F\-]{36})')
+_desc_pat = re.compile('handle\s*[=:]\s*0x[0-9a-fA-F]{4},\s*uuid\s*[=:]\s*[0-9a-fA-F\-]{36}')
+_value_pat = re.compile('Characteristic value/descriptor:\s*(?P<value>[0-9a-fA-F ]*?)\s*\r?\n')
+_error_pat = re.compile('Error: .*\r?\n')
+_lescan_pat = re.compile('(?P<addr>(?:[0-9A-F]{2}:){5}[0-9A-F]{2}) (?P<name>.*?)\r?\n')
+_written_pat = re.compile('Characteristic value was written successfully')
+_notification_pat = re.compile('(Notification|Indication)\s+handle\s*=\s*(?P<handle>0x[0-9a-fA-F]{4})\s+value:\s*(?P<value>[0-9a-fA-F ]*?)\s*\r?\n')
+
+# WunderBar sensor characteristics
+Sensor_ID_UUID = '2010'
+Beacon_Frequency_UUID = '2011'
+Frequency_UUID = '2012'
+LED_State_UUID = '2013'
+Threshold_UUID = '2014'
+Config_UUID = '2015'
+Data_UUID = '2016'
+# Client characteristic configuration descriptor
+CCCD_UUID = '2902'
+
+
+# Layouts of WunderBar sensor data values (little-endian structs), as
+# pairs of field names and scale factors to physical units
+_wunderbar_layouts = {
+    'htu': ('<hh', (('temperature', 0.01), ('humidity', 0.01))),
+    'gyro': ('<iiihhh', (('gyro_x', 0.01), ('gyro_y', 0.01), ('gyro_z', 0.01),
+        ('acc_x', 0.01), ('acc_y', 0.01), ('acc_z', 0.01))),
+    'light': ('<HHHHH', (('red', 1), ('green', 1), ('blue', 1), ('clear', 1),
+        ('proximity', 1))),
+    'mic': ('<h', (('noise_level', 1),)),
+}
+_wunderbar_structs = dict((kind, struct.Struct(fmt))
+    for kind, (fmt, fields) in _wunderbar_layouts.items())
+
+
+def hex2bytes(data):
+    """
+    Convert a data string of hex digits as used by ``gatttool`` to bytes.
+
+    Spaces between the digits are optional, e.g.:
+
+    '57 75 6e 64 65 72 62 61 72 49 52' -> b'WunderbarIR'
+    """
+    return bytes(bytearray.fromhex(data))
+
+
+def bytes2hex(data):
+    """
+    Convert bytes to a data string of space separated hex digits, e.g.:
+
+    b'WunderbarIR' -> '57 75 6e 64 65 72 62 61 72 49 52'
+    """
+    digits = binascii.hexlify(data).decode('ascii')
+    return ' '.join([digits[i:i+2] for i in range(0, len(digits), 2)])
+
 
 def data2str(data):
     """
@@ -48,8 +119,8 @@ def data2str(data):
     '' -> ''
     """
     if not data: return data
-    text = ''.join([chr(int(v, 16)) for v in data.split()])
-    return text
+    text = hex2bytes(data)
+    return text if PY2 else text.decode('latin-1')
 
 
 def str2data(str):
@@ -62,11 +133,107 @@ def str2data(str):
     '' -> ''
     """
     if not str: return str
-    data = ' '.join([hex(ord(c))[2:] for c in str])
-    return data
+    if not isinstance(str, (bytes, bytearray)):
+        str = str.encode('latin-1')
+    return bytes2hex(str)
+
+
+def decode_wunderbar(kind, data):
+    """
+    Decode the data value of a WunderBar sensor into physical units.
+
+    :param kind: the sensor kind, one of 'htu', 'gyro', 'light' and 'mic'
+    :type kind: string
+    :param data: the value as bytes or as a string of hex digits
+    :type data: bytes or string
+    :rtype: a dict with one entry per measured quantity, e.g.
+        ``{'temperature': 21.5, 'humidity': 42.0}``
+    """
+    if not isinstance(data, (bytes, bytearray)):
+        data = hex2bytes(data)
+    s = _wunderbar_structs[kind]
+    fields = _wunderbar_layouts[kind][1]
+    values = s.unpack_from(data)
+    return dict((name, v * scale) for (name, scale), v in zip(fields, values))
+
+
+def decode_wunderbar_batch(kind, values):
+    """
+    Decode many data values of a WunderBar sensor into NumPy arrays.
+
+    This needs NumPy to be installed. All values are decoded at once
+    instead of one struct at a time.
+
+    :param kind: the sensor kind, one of 'htu', 'gyro', 'light' and 'mic'
+    :type kind: string
+    :param values: the values as bytes or as strings of hex digits
+    :type values: list
+    :rtype: a dict with one float array per measured quantity
+    """
+    import numpy
 
+    fmt, fields = _wunderbar_layouts[kind]
+    size = _wunderbar_structs[kind].size
+    chunks = [v if isinstance(v, (bytes, bytearray)) else hex2bytes(v)
+        for v in values]
+    if any(len(c) < size for c in chunks):
+        raise ValueError('Values of %s data need %d bytes.' % (kind, size))
+    # values may carry trailing bytes, only the leading struct is decoded
+    buf = b''.join([bytes(c[:size]) for c in chunks])
+    dtype = numpy.dtype([(name, '<' + code)
+        for (name, scale), code in zip(fields, fmt[1:])])
+    records = numpy.frombuffer(buf, dtype=dtype)
+    return dict((name, records[name] * float(scale)) for name, scale in fields)
 
-def scan_ble_devices(hci_name='hci0', name_filter='.*', timeout=1):
+
+def iter_ble_devices(hci_name='hci0', name_filter='.*', timeout=1, max_devices=None):
+    """
+    Yield discovered Bluetooth LE devices with address and name while scanning.
+
+    Every device is yielded once, as soon as it is seen with a name matching
+    the filter. The scan ends after the timeout or when ``max_devices``
+    devices were found, whichever comes first.
+
+    Attention: This must be run with sudo permissions!
+
+    :param hci_name: the HCI device name
+    :type hci_name: string
+    :param name_filter: a regular expression that service names need to match
+    :type name_filter: string
+    :param timeout: the timeout value for the scan duration in seconds
+    :type timeout: float
+    :param max_devices: the number of devices after which to stop scanning
+    :type max_devices: int
+    :rtype: a generator of dicts, one per device, each with a name and addr entry
+    """
+
+    name_pat = re.compile(name_filter)
+    pexpect.run('hciconfig %s reset' % hci_name) # needs sudo
+    conn = pexpect.spawnu('hcitool -i %s lescan' % hci_name) # needs sudo
+    seen = set()
+    deadline = time.time() + timeout
+    try:
+        while len(seen) != max_devices:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            i = conn.expect([_lescan_pat, pexpect.TIMEOUT, pexpect.EOF],
+                timeout=remaining)
+            if i != 0:
+                break
+            addr, name = conn.match.group('addr', 'name')
+            if addr in seen or not name_pat.match(name):
+                continue
+            seen.add(addr)
+            yield {'addr': addr, 'name': name}
+    finally:
+        # interrupt to make hcitool disable scanning on the adapter
+        if conn.isalive():
+            conn.kill(signal.SIGINT)
+        conn.close(force=True)
+
+
+def scan_ble_devices(hci_name='hci0', name_filter='.*', timeout=1, max_devices=None):
     """
     Return list of discovered Bluetooth LE devices with address and name.
     
@@ -78,6 +245,8 @@ def scan_ble_devices(hci_name='hci0', name_filter='.*', timeout=1):
     :type name_filter: string
     :param timeout: the timeout value for the scan duration in seconds
     :type timeout: string
+    :param max_devices: the number of devices after which to stop scanning
+    :type max_devices: int
     :rtype: a list of dicts, one per device, each with a name and addr entry
 
     Sample output::
@@ -90,50 +259,162 @@ def scan_ble_devices(hci_name='hci0', name_filter='.*', timeout=1):
          {'addr': 'E9:5D:10:B9:E2:1C', 'name': 'WunderbarMIC'},
          {'addr': 'F2:EE:50:45:39:74', 'name': 'WunderbarGYRO'}]
     """
-    
-    conn = pexpect.spawn('hciconfig %s reset' % hci_name) # needs sudo
-    time.sleep(0.2)
 
-    conn = pexpect.spawn('timeout %d hcitool lescan' % timeout) # needs sudo
-    time.sleep(0.2)
+    return list(iter_ble_devices(hci_name=hci_name, name_filter=name_filter,
+        timeout=timeout, max_devices=max_devices))
 
-    conn.expect('LE Scan \.+', timeout=timeout)
 
-    output = ''
-    line_pat = '(?P<addr>([0-9A-F]{2}:){5}[0-9A-F]{2}) (?P<name>.*)'
-    
-    while True:
+def list_adapters():
+    """
+    Return the HCI device names of all Bluetooth adapters, e.g. ['hci0', 'hci1'].
+    """
+
+    res = subprocess.check_output(['hciconfig']).decode('utf-8')
+    return re.findall('^(hci\d+):', res, re.M)
+
+
+class AdapterPool(object):
+    """
+    Assigns BLE devices to Bluetooth adapters by load.
+
+    Each device is assigned to the adapter with the lowest total load of
+    its assigned devices, where a device's load is e.g. its number of
+    reads per second. Every adapter has its own limit of concurrently
+    connected devices. A device whose adapter has no free connection
+    slot is moved to the least loaded adapter with a free one:
+
+    .. code-block:: python
+
+        pool = AdapterPool(list_adapters(), max_connections=5)
+        hci_name = pool.acquire('F4:D7:AB:6D:EB:D5', load=0.2)
         try:
-            res = conn.expect(line_pat)
-            output += conn.after
-        except pexpect.EOF:
-            break
-      
-    lines = re.split('\r?\n', output.strip())
-    lines = list(set(lines))
-    lines = [line for line in lines if re.match(line_pat, line)]
-    lines = [re.match(line_pat, line).groupdict() for line in lines]
-    lines = [line for line in lines if re.match(name_filter, line['name'])]
-    
-    return lines
+            with GattDevice('F4:D7:AB:6D:EB:D5', hci_name=hci_name) as d:
+                print(d.read_device_name())
+        finally:
+            pool.release_slot(hci_name)
+    """
+
+    def __init__(self, adapters, max_connections=5):
+        """
+        :param adapters: The HCI device names of the adapters to use.
+        :type adapters: list
+        :param max_connections: The maximum number of devices connected at
+            the same time per adapter.
+        :type max_connections: int
+        """
+        self.adapters = list(adapters)
+        self.max_connections = max_connections
+        self.loads = dict((a, 0.0) for a in self.adapters)
+        self.connected = dict((a, 0) for a in self.adapters)
+        self.assignments = {}
+        self._cond = threading.Condition()
+
+    def _assign(self, addr, load, adapters):
+        "Assign a device to the least loaded of some adapters, needs the lock."
+
+        adapter = min(adapters, key=lambda a: self.loads[a])
+        self.assignments[addr] = (adapter, load)
+        self.loads[adapter] += load
+        return adapter
+
+    def assign(self, addr, load=1.0):
+        """
+        Return the adapter of a device, assigning the least loaded one if needed.
+
+        :param addr: the MAC address of the device
+        :type addr: string
+        :param load: the load caused by the device on its adapter
+        :type load: float
+        """
+        with self._cond:
+            if addr not in self.assignments:
+                return self._assign(addr, load, self.adapters)
+            return self.assignments[addr][0]
+
+    def release(self, addr):
+        "Remove the assignment of a device, e.g. to reassign it after failures."
+
+        with self._cond:
+            if addr in self.assignments:
+                adapter, load = self.assignments.pop(addr)
+                self.loads[adapter] -= load
+
+    def acquire(self, addr, load=1.0):
+        """
+        Return an adapter with a free connection slot for a device, waiting
+        until one is free.
+
+        The device's assigned adapter is used if it has a free slot,
+        otherwise the device is moved to the least loaded adapter with a
+        free slot. The slot must be given back with :py:meth:`release_slot`.
+
+        :param addr: the MAC address of the device
+        :type addr: string
+        :param load: the load caused by the device on its adapter
+        :type load: float
+        """
+        with self._cond:
+            while True:
+                adapter = self.assign(addr, load)
+                if self.connected[adapter] < self.max_connections:
+                    break
+                free = [a for a in self.adapters
+                    if self.connected[a] < self.max_connections]
+                if free:
+                    self.release(addr)
+                    adapter = self._assign(addr, load, free)
+                    break
+                self._cond.wait()
+            self.connected[adapter] += 1
+            return adapter
+
+    def release_slot(self, adapter):
+        "Give back a connection slot of an adapter taken with :py:meth:`acquire`."
+
+        with self._cond:
+            self.connected[adapter] -= 1
+            self._cond.notify_all()
 
 
 class GattDevice(object):
     """
     A class to communicate via GATT with a Bluetooth LE device.
 
-    This class uses the Bluez ``getttool`` in a non-interactive manner.
+    This class uses the Bluez ``getttool`` in a non-interactive manner,
+    spawning one process per operation, unless a session was started with
+    :py:meth:`connect`. Then all operations are sent to one interactive
+    ``gatttool`` process staying connected to the device:
+
+    .. code-block:: python
+
+        with GattDevice('F4:D7:AB:6D:EB:D5') as d:
+            d.characteristics()
+            print(d.read_device_name())
     """
-    
-    def __init__(self, addr):
+
+    def __init__(self, addr, timeout=10, use_cache=True, hci_name=None):
         """
         Instantiate an object representing a device accessible via GATT.
 
         :param addr: the MAC address of the device
         :type addr: string
+        :param timeout: the timeout for connecting and single operations
+            in seconds when using an interactive session
+        :type timeout: float
+        :param use_cache: flag indicating if discovered services and
+            characteristics are loaded from and saved to a cache file
+            (see :py:meth:`cache_path`), skipping discovery for known devices
+        :type use_cache: bool
+        :param hci_name: the HCI device name of the adapter to use, e.g.
+            'hci1', or None for the default adapter
+        :type hci_name: string
         """
 
         self.addr = addr
+        self.timeout = timeout
+        self.use_cache = use_cache
+        self.hci_name = hci_name
+        self.session = None
         self.data = {
             'services': [],
             'characteristics': [],
@@ -141,46 +422,254 @@ class GattDevice(object):
             'read_log': [], # log of read data: {'ts':..., ''handle':..., 'bytes':...}
             'write_log': []  # log of written data: same...
         }
-        self.callbacks = {}
+        self.callbacks = DeviceCallbacks()
+        self._chars_by_uuid = {}
+        self._chars_by_handle = {}
+        if use_cache:
+            self.load_cache()
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.disconnect()
+
+    def connect(self):
+        """
+        Start an interactive ``gatttool`` session connected to the device.
+
+        Raises ``RelayrException`` if the connection cannot be established.
+        """
+
+        if self.session is not None:
+            return
+        cmd = 'gatttool %s -I' % self._gatttool_args()
+        session = pexpect.spawnu(cmd)
+        session.delaybeforesend = 0
+        session.sendline('connect')
+        i = session.expect(['Connection successful', _error_pat, pexpect.TIMEOUT,
+            pexpect.EOF], timeout=self.timeout)
+        if i != 0:
+            session.close(force=True)
+            msg = 'Cannot connect to %s: %s' % (self.addr, session.after)
+            raise RelayrException(msg)
+        self.session = session
+
+    def disconnect(self):
+        "End the interactive ``gatttool`` session, if any."
+
+        if self.session is None:
+            return
+        session, self.session = self.session, None
+        if session.isalive():
+            session.sendline('disconnect')
+            session.sendline('exit')
+            try:
+                session.expect(pexpect.EOF, timeout=1)
+            except pexpect.TIMEOUT:
+                pass
+        session.close(force=True)
+
+    def _gatttool_args(self):
+        "Return the ``gatttool`` options selecting adapter and device."
+
+        args = '-t random -b %s' % self.addr
+        if self.hci_name:
+            args = '-i %s %s' % (self.hci_name, args)
+        return args
+
+    def _gatttool(self, options):
+        "Run ``gatttool`` non-interactively with given options, return its output."
+
+        cmd = 'gatttool %s %s' % (self._gatttool_args(), options)
+        return subprocess.check_output(shlex.split(cmd)).decode('utf-8')
+
+    def _expect(self, patterns, timeout):
+        """
+        Wait for one of the patterns in the session output, return its index.
+
+        Notifications and indications arriving meanwhile are dispatched to
+        the registered callbacks. Return -1 on timeout.
+        """
+
+        s = self.session
+        patterns = [_notification_pat, pexpect.TIMEOUT] + list(patterns)
+        deadline = time.time() + timeout
+        while True:
+            i = s.expect(patterns, timeout=max(0, deadline - time.time()))
+            if i == 0:
+                handle = '0x%04x' % int(s.match.group('handle'), 16)
+                self.callbacks(handle, s.match.group('value'))
+            elif i == 1:
+                return -1
+            else:
+                return i - 2
+
+    def _session_lines(self, command, pattern):
+        """
+        Send a command to the session and return all matching output lines.
+
+        The output is collected until no further matching line has arrived
+        for a short time after the first one or an error is reported.
+        """
+
+        s = self.session
+        s.sendline(command)
+        lines = []
+        timeout = self.timeout
+        while True:
+            i = self._expect([pattern, _error_pat], timeout)
+            if i != 0:
+                break
+            lines.append(s.after)
+            timeout = 0.5
+        return lines
+
+    def cache_path(self):
+        "Return the path of the file caching this device's GATT tables."
+
+        name = self.addr.replace(':', '').lower() + '.json'
+        return join(expanduser(config.RELAYR_FOLDER), 'gatt', name)
 
-    def primary(self):
+    def load_cache(self):
+        """
+        Load services and characteristics from the cache file, if any.
+
+        An unreadable or corrupt cache file is treated like a missing one.
+
+        :rtype: bool, True if the cache file was loaded.
+        """
+
+        path = self.cache_path()
+        if not exists(path):
+            return False
+        try:
+            with open(path) as f:
+                cached = json.load(f)
+        except (IOError, ValueError):
+            return False
+        if not isinstance(cached, dict):
+            return False
+        self.data['services'] = cached.get('services', [])
+        self._index_characteristics(cached.get('characteristics', []))
+        return True
+
+    def save_cache(self):
+        "Save services and characteristics to the cache file."
+
+        path = self.cache_path()
+        if not exists(dirname(path)):
+            os.makedirs(dirname(path))
+        cached = {
+            'services': self.data['services'],
+            'characteristics': self.data['characteristics']
+        }
+        with open(path, 'w') as f:
+            json.dump(cached, f, indent=1)
+
+    def _index_characteristics(self, chars):
+        "Store characteristics and index them by short UUID and handles."
+
+        self.data['characteristics'] = chars
+        self._chars_by_uuid = {}
+        self._chars_by_handle = {}
+        for char in chars:
+            self._chars_by_uuid[char['_uuid']] = char
+            self._chars_by_uuid[char['uuid']] = char
+            self._chars_by_handle[int(char['name_handle'], 16)] = char
+            self._chars_by_handle[int(char['value_handle'], 16)] = char
+
+    def characteristic(self, uuid=None, handle=None):
+        """
+        Return the characteristic with given UUID or handle.
+
+        The characteristics are discovered first if not known yet.
+
+        :param uuid: short or full UUID, e.g. '2a19'
+        :type uuid: string
+        :param handle: name or value handle, e.g. '0x0029' or 41
+        :type handle: string or int
+        :rtype: a dict as returned by :py:meth:`characteristics`, or None
+        """
+
+        if not self.data['characteristics']:
+            self.characteristics()
+        if uuid is not None:
+            return self._chars_by_uuid.get(uuid.lower())
+        if not isinstance(handle, int):
+            handle = int(handle, 16)
+        return self._chars_by_handle.get(handle)
+
+    def primary(self, refresh=False):
         """
         Discover primary services.
+
+        Known services are returned without discovery, unless ``refresh``
+        is set.
+
+        :param refresh: flag indicating if services are discovered again
+        :type refresh: bool
         """
 
+        if self.data['services'] and not refresh:
+            return self.data['services']
+
         # example line format:
         # 'attr handle = 0x0001, end grp handle = 0x0007 uuid: 00001800-0000-1000-8000-00805f9b34fb'
-        cmd = 'gatttool -t random -b %s --primary' % self.addr
-        res = subprocess.check_output(shlex.split(cmd))
-        lines = re.split('\r?\n', res)
-        lines = sorted(set(lines))
+        if self.session:
+            lines = self._session_lines('primary', _primary_pat)
+        else:
+            res = self._gatttool('--primary')
+            lines = re.split('\r?\n', res)
+        lines = sorted(set(line for line in lines if _primary_pat.search(line)))
         self.data['services'] = lines
+        if self.use_cache:
+            self.save_cache()
         return lines
 
-    def characteristics(self, uuid=None):
+    def characteristics(self, uuid=None, refresh=False):
         """
         Read list of characteristics.
 
         If the ``uuid`` parameter is given, only this characteristic will be read.
+        Known characteristics are returned without discovery, unless
+        ``refresh`` is set.
 
         :param uuid: uuid to be read
         :type uuid: string
+        :param refresh: flag indicating if characteristics are discovered again
+        :type refresh: bool
         """
 
+        if self.data['characteristics'] and not refresh:
+            if not uuid:
+                return self.data['characteristics']
+            char = self._chars_by_uuid.get(uuid.lower())
+            return [char] if char else []
+
         # example line format:
         # 'handle = 0x0002, char properties = 0x02, char value handle = 0x0003, uuid = 00002a00-0000-1000-8000-00805f9b34fb'
-        cmd = 'gatttool -t random -b %s --characteristics' % self.addr
-        if uuid:
-            cmd += ' --uuid=%s' % uuid
-        res = subprocess.check_output(shlex.split(cmd))
-        lines = re.split('\r?\n', res)
-        pat = '^handle\s*=\s*(?P<name_handle>0x[0-9a-fA-F]{4}),\s*char\s*properties\s*=\s*(?P<properties>0x[0-9a-fA-F]+),\s*char\s*value\s*handle\s*=\s*(?P<value_handle>0x[0-9a-fA-F]{4}),\s*uuid\s*=\s*(?P<uuid>[0-9a-fA-F\-]+)'
-        lines = [re.match(pat, line).groupdict() for line in lines]
+        if self.session:
+            cmd = 'characteristics'
+            if uuid:
+                cmd += ' 0x0001 0xffff %s' % uuid
+            lines = self._session_lines(cmd, _char_pat)
+        else:
+            options = '--characteristics'
+            if uuid:
+                options += ' --uuid=%s' % uuid
+            res = self._gatttool(options)
+            lines = re.split('\r?\n', res)
+        lines = [m.groupdict() for m in map(_char_pat.search, lines) if m]
         for line in lines:
             short = line['uuid'].split('-')[0]
             while short[0] == '0': short = short[1:]
             line['_uuid'] = short
-        self.data['characteristics'] = lines
+        if not uuid:
+            self._index_characteristics(lines)
+            if self.use_cache:
+                self.save_cache()
         return lines
 
     def char_desc(self):
@@ -190,9 +679,11 @@ class GattDevice(object):
 
         # example line format:
         # 'handle = 0x000e, uuid = 00002010-0000-1000-8000-00805f9b34fb'
-        cmd = 'gatttool -t random -b %s --char-desc' % self.addr
-        res = subprocess.check_output(shlex.split(cmd))
-        lines = re.split('\r?\n', res)
+        if self.session:
+            lines = self._session_lines('char-desc', _desc_pat)
+        else:
+            res = self._gatttool('--char-desc')
+            lines = re.split('\r?\n', res)
         # lines = re.findall('handle: .* uuid: [0-9a-f\-]{36}', res)
         self.data['char-desc'] = lines
         return lines
@@ -207,36 +698,140 @@ class GattDevice(object):
         :type handle: string
         """
 
-        cmd = 'gatttool -t random -b %s --char-read --handle %s' % (self.addr, handle)
-        res = subprocess.check_output(shlex.split(cmd))
+        if self.session:
+            s = self.session
+            s.sendline('char-read-hnd %s' % handle)
+            if self._expect([_value_pat, _error_pat], self.timeout) != 0:
+                return None
+            return s.match.group('value').strip()
+
+        res = self._gatttool('--char-read --handle %s' % handle)
         if not res.startswith('Characteristic value/descriptor:'):
             return None
         res = re.match('Characteristic value/descriptor: (.*)', res).groups()[0]
         byte_values = res # .split()
         return byte_values
 
+    def char_write_req(self, handle, value):
+        """
+        Write a data string to a handle and wait for the confirmation.
+
+        :param handle: handle to be written, e.g. '0x0017'
+        :type handle: string
+        :param value: data to be written as hex digits, e.g. '0100'
+        :type value: string
+        :rtype: bool, True if the value was written successfully
+        """
+
+        if self.session:
+            self.session.sendline('char-write-req %s %s' % (handle, value))
+            return self._expect([_written_pat, _error_pat], self.timeout) == 0
+
+        options = '--char-write-req --handle=%s --value=%s' % (handle, value)
+        res = self._gatttool(options)
+        return _written_pat.search(res) is not None
+
+    def _value_handle(self, characteristic):
+        "Return the value handle of a characteristic given by short UUID or handle."
+
+        if characteristic.startswith('0x'):
+            return characteristic
+        char = self.characteristic(uuid=characteristic)
+        if char is None:
+            msg = 'Unknown characteristic %s of %s'
+            raise RelayrException(msg % (characteristic, self.addr))
+        return char['value_handle']
+
+    def _cccd_handle(self, value_handle):
+        """
+        Return the handle of the client characteristic configuration
+        descriptor following a value handle.
+
+        Known descriptors (see :py:meth:`char_desc`) are searched first,
+        else the handle directly after the value handle is assumed.
+        """
+
+        value_handle = int(value_handle, 16)
+        for line in self.data['char-desc']:
+            m = re.search('handle\s*[=:]\s*(0x[0-9a-fA-F]{4}),\s*uuid\s*[=:]\s*0000(\w{4})', line)
+            if m and m.group(2) == CCCD_UUID and int(m.group(1), 16) > value_handle:
+                return m.group(1)
+        return '0x%04x' % (value_handle + 1)
+
+    def subscribe(self, characteristic, callback, indication=False):
+        """
+        Enable notifications or indications of a characteristic.
+
+        Needs an interactive session, see :py:meth:`connect`. Received
+        values are passed to the callback while the session is waiting for
+        other output or when calling :py:meth:`listen`.
+
+        :param characteristic: short UUID or value handle, e.g. '2016'
+        :type characteristic: string
+        :param callback: A callable to be called with two arguments:
+            the value handle and the received data string.
+        :type callback: A function/method or object implementing the ``__call__`` method.
+        :param indication: flag indicating if indications (confirmed by
+            the receiver) are used instead of notifications
+        :type indication: bool
+        :rtype: bool, True if the descriptor was written successfully
+        """
+
+        if not self.session:
+            raise RelayrException('Subscriptions need a connected session.')
+        handle = self._value_handle(characteristic)
+        self.callbacks.register(handle, callback)
+        value = '0200' if indication else '0100'
+        return self.char_write_req(self._cccd_handle(handle), value)
+
+    def unsubscribe(self, characteristic):
+        """
+        Disable notifications and indications of a characteristic.
+
+        :param characteristic: short UUID or value handle, e.g. '2016'
+        :type characteristic: string
+        """
+
+        handle = self._value_handle(characteristic)
+        self.callbacks.unregister(handle)
+        if self.session:
+            self.char_write_req(self._cccd_handle(handle), '0000')
+
+    def listen(self, duration):
+        """
+        Dispatch incoming notifications and indications for some time.
+
+        :param duration: the time to listen in seconds
+        :type duration: float
+        """
+
+        self._expect([], duration)
+
     # higher-level interface
 
     def read_device_name(self):
-        "Return device name."
+        "Return device name, or None if it cannot be read."
 
-        for char in self.data['characteristics']:
-            if char['_uuid'] == Device_Name_UUID:
-                value_handle = char['value_handle']
+        char = self.characteristic(uuid=Device_Name_UUID)
+        if not char:
+            return None
+        value_handle = char['value_handle']
         data = self.char_read_hnd(value_handle) # eg. '57 75 6e 64 65 72 62 61 72 49 52'
+        if data is None:
+            return None
         name = ''.join([chr(int(v, 16)) for v in data.split()]) # e.g. 'WunderbarIR'
         return name
 
     def read_battery_level(self):
-        "Return current battery level."
+        "Return current battery level, or None if it cannot be read."
 
-        value_handle = None
-        for char in self.data['characteristics']:
-            if char['_uuid'] == Battery_Level_UUID:
-                value_handle = char['value_handle']
-        if not value_handle:
+        char = self.characteristic(uuid=Battery_Level_UUID)
+        if not char:
             return None
+        value_handle = char['value_handle']
         data = self.char_read_hnd(value_handle) # eg. '64'
+        if data is None:
+            return None
         level = int(data, 16) # e.g. 100
         return level
 
@@ -245,31 +840,283 @@ class WunderbarGattDevice(GattDevice):
     """
     A class to communicate via GATT with a Bluetooth LE Wunderbar device.
 
-    This class uses the Bluez ``getttool`` in a non-interactive manner.
+    This class uses the Bluez ``getttool`` in a non-interactive manner,
+    unless a session was started with :py:meth:`connect`. Sensor data can
+    be streamed as notifications:
+
+    .. code-block:: python
+
+        def show(handle, value):
+            print(value)
+
+        with WunderbarGattDevice('DE:7F:20:07:AD:04') as d:
+            d.subscribe_named('data', show)
+            d.listen(10)
     """
 
+    # characteristic names and their short UUIDs
+    uuids = {
+        'device_name': Device_Name_UUID,
+        'manufacturer_name': Manufacturer_Name_UUID,
+        'firmware_revision': Firmware_Revision_UUID,
+        'hardware_revision': Hardware_Revision_UUID,
+        'battery_level': Battery_Level_UUID,
+        'sensor_id': Sensor_ID_UUID,
+        'beacon_frequency': Beacon_Frequency_UUID,
+        'frequency': Frequency_UUID,
+        'led_state': LED_State_UUID,
+        'threshold': Threshold_UUID,
+        'config': Config_UUID,
+        'data': Data_UUID,
+    }
+
     def switch_led_on(self):
         "Switch device LED on."
 
-        pass
+        return self.write_value_named('led_state', '01')
 
     def switch_led_off(self):
         "Switch device LED off."
 
-        pass
+        return self.write_value_named('led_state', '00')
 
     def read_value_named(self, name):
         "Return value with given name."
 
-        pass
+        return self.char_read_hnd(self._value_handle(self.uuids[name]))
 
     def write_value_named(self, name, value):
         "Write value with given name."
 
-        pass
+        return self.char_write_req(self._value_handle(self.uuids[name]), value)
+
+    def subscribe_named(self, name, callback, indication=False):
+        "Enable notifications or indications of the value with given name."
+
+        return self.subscribe(self.uuids[name], callback, indication=indication)
+
+    def read_data(self, kind):
+        """
+        Return the current sensor data decoded into physical units.
+
+        :param kind: the sensor kind, one of 'htu', 'gyro', 'light' and 'mic'
+        :type kind: string
+        :rtype: a dict, see :py:func:`decode_wunderbar`
+        """
+
+        data = self.read_value_named('data')
+        if data is None:
+            return None
+        return decode_wunderbar(kind, data)
 
 
 class DeviceCallbacks(object):
-    "A set of callbacks for handling device data." 
+    """
+    A set of callbacks for handling device data.
+
+    Callbacks are registered per value handle and called with the handle
+    and the received data string.
+    """
+
+    def __init__(self):
+        self.handlers = {}
+
+    def register(self, handle, callback):
+        "Register a callback for data received for a value handle."
+
+        self.handlers['0x%04x' % int(handle, 16)] = callback
+
+    def unregister(self, handle):
+        "Remove the callback of a value handle, if any."
+
+        self.handlers.pop('0x%04x' % int(handle, 16), None)
+
+    def __call__(self, handle, value):
+        "Pass received data to the callback registered for its handle."
+
+        callback = self.handlers.get(handle)
+        if callback is not None:
+            callback(handle, value)
+
+
+class BlePoller(object):
+    """
+    Periodically read characteristics from several devices concurrently.
+
+    Every device is polled on its own thread through an interactive
+    ``gatttool`` session, with at most ``max_connections`` sessions open
+    at once per adapter. Devices are spread over several adapters, if
+    given, by their number of reads per second. Results are passed to a
+    callback or, if none is given, put into the ``results`` queue:
+
+    .. code-block:: python
+
+        poller = BlePoller(lambda addr, handle, value: print(addr, value))
+        poller.add('F4:D7:AB:6D:EB:D5', '2a19', interval=60)
+        poller.add('D0:DA:36:13:EB:39', '0x0029', interval=5)
+        poller.start()
+        ...
+        poller.stop()
+        print(poller.stats())
+    """
+
+    def __init__(self, callback=None, max_connections=5, retry_interval=5,
+        device_class=GattDevice, adapters=None):
+        """
+        :param callback: A callable to be called with three arguments:
+            the device address, the value handle and the read data string.
+        :type callback: A function/method or object implementing the ``__call__`` method.
+        :param max_connections: The maximum number of devices connected at
+            the same time per adapter, usually limited by the Bluetooth adapter.
+        :type max_connections: int
+        :param retry_interval: The time in seconds to wait before connecting
+            again after a connection failed.
+        :type retry_interval: float
+        :param device_class: The class used to access devices.
+        :type device_class: :py:class:`GattDevice` or a subclass
+        :param adapters: The HCI device names of the adapters to spread the
+            devices over (see :py:func:`list_adapters`), by default only the
+            default adapter is used.
+        :type adapters: list
+        """
+        self.results = Queue()
+        self.callback = callback or (lambda *args: self.results.put(args))
+        self.retry_interval = retry_interval
+        self.device_class = device_class
+        self.adapters = AdapterPool(adapters or [None], max_connections)
+        self.schedules = {}
+        self._stats = {}
+        self._stop_event = threading.Event()
+        self._threads = []
+
+    def add(self, addr, characteristic, interval):
+        """
+        Schedule periodic reads of a characteristic.
+
+        :param addr: the MAC address of the device
+        :type addr: string
+        :param characteristic: a short UUID, e.g. '2a19', or a value handle,
+            e.g. '0x0029'
+        :type characteristic: string
+        :param interval: the time between reads in seconds
+        :type interval: float
+        """
+        self.schedules.setdefault(addr, []).append((characteristic, interval))
+
+    def start(self):
+        "Start one polling thread per device."
+
+        self._stop_event.clear()
+        for addr, schedule in self.schedules.items():
+            self._stats[addr] = {'reads': 0, 'errors': 0, 'connects': 0,
+                'callback_errors': 0, 'latency': 0.0, 'max_latency': 0.0,
+                'started': time.time(), 'adapter': None}
+            t = threading.Thread(target=self._poll, args=(addr, schedule))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        "Stop all polling threads and disconnect all devices."
+
+        self._stop_event.set()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def stats(self):
+        """
+        Return polling statistics per device address.
+
+        Each entry contains the number of ``reads``, failed reads
+        (``errors``), ``connects`` and exceptions raised by the callback
+        (``callback_errors``), the ``mean_latency`` and
+        ``max_latency`` of reads in seconds, the ``throughput`` in
+        reads per second and the ``adapter`` last used.
+        """
+        res = {}
+        now = time.time()
+        for addr, st in self._stats.items():
+            reads = st['reads']
+            res[addr] = {
+                'reads': reads,
+                'errors': st['errors'],
+                'connects': st['connects'],
+                'callback_errors': st['callback_errors'],
+                'mean_latency': st['latency'] / reads if reads else None,
+                'max_latency': st['max_latency'],
+                'throughput': reads / (now - st['started']),
+                'adapter': st['adapter'],
+            }
+        return res
+
+    def _poll(self, addr, schedule):
+        "Polling thread loop for one device, reconnecting after failures."
+
+        st = self._stats[addr]
+        load = sum(1.0 / interval for characteristic, interval in schedule)
+        while not self._stop_event.is_set():
+            adapter = st['adapter'] = self.adapters.acquire(addr, load)
+            if self._stop_event.is_set():
+                self.adapters.release_slot(adapter)
+                break
+            if adapter is None:
+                dev = self.device_class(addr)
+            else:
+                dev = self.device_class(addr, hci_name=adapter)
+            try:
+                dev.connect()
+                st['connects'] += 1
+                self._poll_connected(dev, schedule, st)
+            except (RelayrException, pexpect.ExceptionPexpect):
+                st['errors'] += 1
+                # let another adapter take over if one is less loaded
+                self.adapters.release(addr)
+            except Exception:
+                # keep polling the device after unexpected errors
+                st['errors'] += 1
+                self.adapters.release(addr)
+                if config.DEBUG:
+                    warnings.warn('Polling %s failed:\n%s' % (addr, traceback.format_exc()))
+            finally:
+                dev.disconnect()
+                self.adapters.release_slot(adapter)
+            self._stop_event.wait(self.retry_interval)
+
+    def _poll_connected(self, dev, schedule, st):
+        "Read characteristics of a connected device when they are due."
 
-    pass
+        now = time.time()
+        due = []
+        for characteristic, interval in schedule:
+            handle = characteristic
+            if not characteristic.startswith('0x'):
+                char = dev.characteristic(uuid=characteristic)
+                if char is None:
+                    msg = 'Unknown characteristic %s of %s'
+                    raise RelayrException(msg % (characteristic, dev.addr))
+                handle = char['value_handle']
+            heapq.heappush(due, (now, handle, interval))
+        while not self._stop_event.is_set():
+            t, handle, interval = due[0]
+            if self._stop_event.wait(max(0, t - time.time())):
+                break
+            start = time.time()
+            value = dev.char_read_hnd(handle)
+            latency = time.time() - start
+            if value is None:
+                st['errors'] += 1
+                if not dev.session.isalive():
+                    raise RelayrException('Lost connection to %s' % dev.addr)
+            else:
+                st['reads'] += 1
+                st['latency'] += latency
+                st['max_latency'] = max(st['max_latency'], latency)
+                try:
+                    self.callback(dev.addr, handle, value)
+                except Exception:
+                    st['callback_errors'] += 1
+                    if config.DEBUG:
+                        warnings.warn('Poller callback failed:\n%s' % traceback.format_exc())
+            # skip reads missed while being late instead of catching up
+            heapq.heapreplace(due, (max(t + interval, time.time()), handle, interval))
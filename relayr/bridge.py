@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+
+"""
+BLE to Cloud Bridge
+
+This module forwards sensor readings taken locally via Bluetooth LE, e.g. on
+a Raspberry Pi, to devices in the relayr cloud. Readings are buffered in
+memory and uploaded in batches by a background thread over pooled HTTP
+connections. While the cloud cannot be reached batches are stored on disk
+and uploaded later, so sampling never has to wait for the network.
+
+Example:
+
+.. code-block:: python
+
+    import time
+    from relayr.api import Api
+    from relayr.ble import BlePoller
+    from relayr.bridge import BleBridge
+
+    bridge = BleBridge(Api(token='<my_access_token>'))
+    bridge.add_device('DE:7F:20:07:AD:04', '<my_device_id>', kind='htu')
+    poller = BlePoller(bridge)
+    poller.add('DE:7F:20:07:AD:04', '2016', interval=10)
+    bridge.start()
+    poller.start()
+    time.sleep(3600)
+    poller.stop()
+    bridge.stop()
+"""
+
+import os
+import json
+import time
+import struct
+import warnings
+import threading
+import collections
+from os.path import exists, join
+
+import requests
+
+from relayr import config
+from relayr.ble import decode_wunderbar
+from relayr.exceptions import RelayrApiException, CircuitOpenException
+
+
+class BleBridge(object):
+    """
+    Uploads readings of local BLE devices to relayr cloud devices.
+
+    Readings are passed to :py:meth:`put` or, when using the bridge as the
+    callback of a :py:class:`relayr.ble.BlePoller`, to :py:meth:`__call__`.
+    Both only append to a buffer. Every ``flush_interval`` seconds, or as
+    soon as ``batch_size`` readings are pending, they are posted per device
+    as ``{'readings': [...]}`` with :py:meth:`relayr.api.Api.post_device_data`.
+    """
+
+    def __init__(self, api, batch_size=100, flush_interval=5,
+        spool_dir=None, retry_interval=30, max_buffer=100000):
+        """
+        :param api: The API used for uploading. If it has no session one
+            is created, so connections are reused between batches.
+        :type api: :py:class:`relayr.api.Api`
+        :param batch_size: The maximum number of readings per request.
+        :type batch_size: int
+        :param flush_interval: The maximum time in seconds a reading waits
+            in the buffer.
+        :type flush_interval: float
+        :param spool_dir: The folder storing batches while offline,
+            defaults to ``spool`` in ``config.RELAYR_FOLDER``.
+        :type spool_dir: string
+        :param retry_interval: The time in seconds to wait before trying to
+            upload again after the cloud could not be reached.
+        :type retry_interval: float
+        :param max_buffer: The maximum number of readings in memory, if
+            exceeded the oldest ones are dropped and counted in ``dropped``.
+        :type max_buffer: int
+        """
+        if api.session is None:
+            api.session = requests.Session()
+        self.api = api
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.spool_dir = spool_dir or join(config.RELAYR_FOLDER, 'spool')
+        self.retry_interval = retry_interval
+        self.max_buffer = max_buffer
+        self.devices = {}
+        self.uploaded = 0
+        self.spooled = 0
+        self.rejected = 0
+        self.dropped = 0
+        self.ignored = 0
+        self.errors = 0
+        self._buffer = collections.deque()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stop_event = threading.Event()
+        self._offline_until = 0
+        self._seq = 0
+        self._thread = None
+
+    def add_device(self, addr, deviceID, kind=None):
+        """
+        Map a local BLE device to a relayr device receiving its readings.
+
+        :param addr: the MAC address of the BLE device
+        :type addr: string
+        :param deviceID: the UUID of the relayr device
+        :type deviceID: string
+        :param kind: the WunderBar sensor kind used to decode values, see
+            :py:func:`relayr.ble.decode_wunderbar`, or ``None`` to upload
+            raw data strings with the value handle as meaning
+        :type kind: string
+        """
+        self.devices[addr] = (deviceID, kind)
+
+    def __call__(self, addr, handle, value):
+        """
+        Buffer a value read from a BLE device.
+
+        The signature matches the callback of :py:class:`relayr.ble.BlePoller`.
+        Values of unmapped devices or values that cannot be decoded are
+        counted in ``ignored`` instead of raising an exception, which the
+        poller would count as a callback error.
+        """
+        device = self.devices.get(addr)
+        if device is None:
+            with self._lock:
+                self.ignored += 1
+            return
+        deviceID, kind = device
+        recorded = int(time.time() * 1000)
+        if kind is None:
+            readings = [{'meaning': handle, 'value': value, 'recorded': recorded}]
+        else:
+            try:
+                decoded = decode_wunderbar(kind, value)
+            except (KeyError, ValueError, TypeError, struct.error):
+                with self._lock:
+                    self.ignored += 1
+                return
+            readings = [{'meaning': k, 'value': v, 'recorded': recorded}
+                for k, v in decoded.items()]
+        self.put(deviceID, readings)
+
+    def put(self, deviceID, readings):
+        """
+        Buffer readings for a relayr device without waiting for the upload.
+
+        :param deviceID: the UUID of the relayr device
+        :type deviceID: string
+        :param readings: readings, each a dict with ``meaning`` and ``value``
+            and optionally ``recorded`` (in milliseconds since the epoch)
+        :type readings: list
+        """
+        with self._lock:
+            buf = self._buffer
+            for reading in readings:
+                buf.append((deviceID, reading))
+            while len(buf) > self.max_buffer:
+                buf.popleft()
+                self.dropped += 1
+            if len(buf) >= self.batch_size:
+                self._wakeup.set()
+
+    def pending(self):
+        "Return the number of buffered and spooled readings."
+
+        with self._lock:
+            n = len(self._buffer)
+        for name in self._spool_files():
+            with open(join(self.spool_dir, name)) as f:
+                n += len(json.load(f)['readings'])
+        return n
+
+    def start(self):
+        "Start the upload thread."
+
+        self._stop_event.clear()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        "Stop the upload thread after a last upload attempt of all buffered readings."
+
+        self._stop_event.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+
+    def flush(self):
+        """
+        Upload all buffered readings, or spool them while offline.
+
+        Spooled batches are uploaded first, oldest first, once the cloud
+        can be reached again.
+        """
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        batches = self._take_batches()
+        if time.time() < self._offline_until:
+            for deviceID, readings in batches:
+                self._spool(deviceID, readings)
+            return
+        for name in self._spool_files():
+            path = join(self.spool_dir, name)
+            with open(path) as f:
+                batch = json.load(f)
+            if not self._upload(batch['deviceID'], batch['readings']):
+                break
+            os.remove(path)
+        for i, (deviceID, readings) in enumerate(batches):
+            if time.time() < self._offline_until or \
+                    not self._upload(deviceID, readings):
+                for deviceID, readings in batches[i:]:
+                    self._spool(deviceID, readings)
+                break
+
+    def _take_batches(self):
+        "Empty the buffer into a list of (deviceID, readings) batches."
+
+        with self._lock:
+            items, self._buffer = self._buffer, collections.deque()
+        order, pending = [], {}
+        for deviceID, reading in items:
+            if deviceID not in pending:
+                order.append(deviceID)
+                pending[deviceID] = []
+            pending[deviceID].append(reading)
+        batches = []
+        for deviceID in order:
+            readings = pending[deviceID]
+            for i in range(0, len(readings), self.batch_size):
+                batches.append((deviceID, readings[i:i+self.batch_size]))
+        return batches
+
+    def _upload(self, deviceID, readings):
+        """
+        Post a batch, return False if the cloud could not be reached.
+
+        Batches refused by the API are dropped and counted in ``rejected``,
+        as posting them again would fail again. Unexpected errors are
+        counted in ``errors`` and handled like an unreachable cloud.
+        """
+        try:
+            self.api.post_device_data(deviceID, {'readings': readings})
+        except CircuitOpenException:
+            self._offline_until = time.time() + self.retry_interval
+            return False
+        except RelayrApiException as e:
+            self.rejected += len(readings)
+            if config.DEBUG:
+                warnings.warn('Dropped readings refused by API: %s' % e)
+        except (requests.RequestException, IOError):
+            self._offline_until = time.time() + self.retry_interval
+            return False
+        except Exception as e:
+            # e.g. a proxy error page that is no JSON, keep it for later
+            self.errors += 1
+            if config.DEBUG:
+                warnings.warn('Failed to upload readings: %r' % e)
+            self._offline_until = time.time() + self.retry_interval
+            return False
+        else:
+            self.uploaded += len(readings)
+        return True
+
+    def _spool_files(self):
+        if not exists(self.spool_dir):
+            return []
+        return sorted(n for n in os.listdir(self.spool_dir) if n.endswith('.json'))
+
+    def _spool(self, deviceID, readings):
+        "Store a batch on disk, named to be sorted by creation time."
+
+        if not exists(self.spool_dir):
+            os.makedirs(self.spool_dir)
+        self._seq += 1
+        name = '%017.6f-%06d.json' % (time.time(), self._seq % 10**6)
+        tmp = join(self.spool_dir, name + '.tmp')
+        with open(tmp, 'w') as f:
+            json.dump({'deviceID': deviceID, 'readings': readings}, f)
+        os.rename(tmp, join(self.spool_dir, name))
+        self.spooled += len(readings)
+
+    def _run(self):
+        "Upload thread loop."
+
+        while not self._stop_event.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self._safe_flush()
+        self._safe_flush()
+
+    def _safe_flush(self):
+        "Flush, counting errors like a failing spool folder instead of ending the thread."
+
+        try:
+            self.flush()
+        except Exception as e:
+            self.errors += 1
+            if config.DEBUG:
+                warnings.warn('Failed to flush readings: %r' % e)
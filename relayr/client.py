@@ -4,11 +4,14 @@
 
 import platform
 
+import requests
+
 from relayr import config
 from relayr.api import Api
 from relayr.version import __version__
 from relayr.exceptions import RelayrApiException
 from relayr.resources import User, App, Device, DeviceModel, Transmitter, Publisher
+from relayr.resources import batched, run_concurrently
 
 
 class Client(object):
@@ -35,14 +38,20 @@ class Client(object):
 
         self.api = Api(token=token)
 
-    def get_public_apps(self):
+    def get_public_apps(self, prefetch=0, stream=False):
         """
         Returns a generator for all apps on the relayr platform.
 
-        A generator is returned since the called API method always
-        returns the entire results list and not a paginated one.
-
+        Fields missing in the list are retrieved on first access, for
+        ``prefetch`` apps at once if given.
 
+        :arg prefetch: The number of apps whose info is retrieved
+            together when the first of them needs it.
+        :type prefetch: int
+        :arg stream: Parse the list while it is received, so the first
+            apps are available before the entire list has arrived. Streamed
+            responses are not cached.
+        :type stream: bool
         :rtype: A generator for :py:class:`relayr.resources.App` objects.
 
         .. code-block:: python
@@ -53,10 +62,9 @@ class Client(object):
                 print('%s %s' % (app.id, app.name))
         """
 
-        for app in self.api.get_public_apps():
-            a = App(app['id'], client=self)
-            a.get_info()
-            yield a
+        apps = (App(app['id'], client=self).set_fields(app)
+            for app in self.api.get_public_apps(stream=stream))
+        return batched(apps, prefetch)
 
     def get_public_publishers(self):
         """
@@ -76,39 +84,52 @@ class Client(object):
             # p.get_info()
             yield p
 
-    def get_public_devices(self, meaning=''):
+    def get_public_devices(self, meaning='', prefetch=0, stream=False):
         """
         Returns a generator for all devices on the relayr platform.
 
-        A generator is returned since the called API method always
-        returns the entire results list and not a paginated one.
-
+        Fields missing in the list are retrieved on first access, for
+        ``prefetch`` devices at once if given.
 
         :arg meaning: The *meaning* (type) of the desired devices.
         :type meaning: string
+        :arg prefetch: The number of devices whose info is retrieved
+            together when the first of them needs it.
+        :type prefetch: int
+        :arg stream: Parse the list while it is received, so the first
+            devices are available before the entire list has arrived.
+            Streamed responses are not cached.
+        :type stream: bool
         :rtype: A generator for :py:class:`relayr.resources.Device` objects.
+
+        .. code-block:: python
+
+            c = Client(token='...')
+            ids = [d.id for d in c.get_public_devices(stream=True)] # a single request
+            for d in c.get_public_devices(prefetch=20):
+                print('%s %s' % (d.id, d.description))
         """
 
-        for dev in self.api.get_public_devices(meaning=meaning):
-            d = Device(dev['id'], client=self)
-            d.get_info()
-            yield d
+        devices = (Device(dev['id'], client=self).set_fields(dev)
+            for dev in self.api.get_public_devices(meaning=meaning, stream=stream))
+        return batched(devices, prefetch)
 
-    def get_public_device_models(self):
+    def get_public_device_models(self, prefetch=0):
         """
         Returns a generator for all device models on the relayr platform.
 
-        A generator is returned since the called API method always
-        returns the entire results list and not a paginated one.
-
+        Fields missing in the list of device models are retrieved on first
+        access, for ``prefetch`` device models at once if given.
 
+        :arg prefetch: The number of device models whose info is retrieved
+            together when the first of them needs it.
+        :type prefetch: int
         :rtype: A generator for :py:class:`relayr.resources.DeviceModel` objects.
         """
 
-        for dm in self.api.get_public_device_models():
-            d = DeviceModel(dm['id'], client=self)
-            d.get_info()
-            yield d
+        models = (DeviceModel(dm['id'], client=self).set_fields(dm)
+            for dm in self.api.get_public_device_models())
+        return batched(models, prefetch)
 
     def get_public_device_model_meanings(self):
         """
@@ -163,3 +184,40 @@ class Client(object):
         :rtype: A :py:class:`relayr.resources.Device` object.
         """
         return Device(id=id, client=self)
+
+    def get_devices(self, ids, concurrency=8):
+        """
+        Returns the devices with the specified IDs with their info retrieved.
+
+        Duplicate IDs are fetched once. Devices are fetched concurrently,
+        reusing pooled connections (a session is created for the API if
+        it has none) and retrieving each device model only once. A device
+        that cannot be fetched does not stop the others, its exception is
+        returned instead.
+
+        :arg ids: the unique IDs of the desired devices.
+        :type ids: list of strings
+        :arg concurrency: the maximum number of concurrent requests.
+        :type concurrency: int
+        :rtype: A tuple of a dict of :py:class:`relayr.resources.Device`
+            objects and a dict of exceptions, both keyed by device ID.
+
+        .. code-block:: python
+
+            c = Client(token='...')
+            devices, errors = c.get_devices(['<id1>', '<id2>', '<id1>'])
+            for id, error in errors.items():
+                print('%s failed: %s' % (id, error))
+        """
+        if self.api.session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(
+                pool_maxsize=max(10, concurrency))
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            self.api.session = session
+
+        models = {}
+        return run_concurrently(
+            lambda id: Device(id=id, client=self).get_info(models),
+            ids, concurrency)
@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compact Resources
+
+This module provides memory-efficient, read-mostly representations of
+devices and device models for holding large inventories in memory.
+Instead of an instance dictionary per object, they store known fields in
+``__slots__``, keep unknown fields in a small overflow dictionary created
+only when needed, share one device model object between all devices of
+that model and intern frequently repeated strings like model IDs,
+meanings and units. Native strings are interned with the built-in
+``intern`` and freed once no longer used, other strings (like unicode
+strings on Python 2) are shared through a pool dict passed along with
+the models dict for one inventory load.
+
+Unlike :py:mod:`relayr.resources` these objects make no API calls.
+
+Example:
+
+.. code-block:: python
+
+    from relayr import Client
+    from relayr.compact import CompactDevice
+
+    c = Client(token='<my_access_token>')
+    models, strings = {}, {}
+    inventory = [CompactDevice.from_json(d, models, strings)
+        for d in c.api.get_public_devices(stream=True)]
+"""
+
+from relayr.compat import intern
+
+
+_string_types = (type(u''), bytes)
+
+
+def intern_string(value, pool=None):
+    """
+    Return a shared string equal to the given one.
+
+    Native strings are interned with the built-in ``intern``, other
+    strings are shared through ``pool`` if given. Other values are
+    returned unchanged.
+    """
+    if type(value) is str:
+        return intern(value)
+    if pool is not None and isinstance(value, _string_types):
+        return pool.setdefault(value, value)
+    return value
+
+
+class CompactResource(object):
+    """
+    Base class of resources storing known fields in ``__slots__``.
+
+    Subclasses list their known fields in ``__slots__`` and the fields
+    whose values are interned in ``interned``. Unknown fields go to an
+    overflow dictionary and can be read and written like the known ones.
+    Unset known fields are None.
+    """
+
+    __slots__ = ('_extra',)
+    interned = ()
+
+    def __init__(self, **fields):
+        self._extra = None
+        for name in self.__slots__:
+            object.__setattr__(self, name, None)
+        self.update(fields)
+
+    def __repr__(self):
+        return "%s(id=%r)" % (self.__class__.__name__, self.id)
+
+    def __getattr__(self, name):
+        extra = None if name.startswith('_') else self._extra
+        if extra is None or name not in extra:
+            raise AttributeError("%r object has no attribute %r" %
+                (self.__class__.__name__, name))
+        return extra[name]
+
+    def __setattr__(self, name, value):
+        if name in self.interned:
+            value = intern_string(value)
+        try:
+            object.__setattr__(self, name, value)
+        except AttributeError:
+            if self._extra is None:
+                self._extra = {}
+            self._extra[name] = value
+
+    def update(self, fields, strings=None):
+        "Set several fields from a dict, sharing strings through a pool if given."
+
+        for name, value in fields.items():
+            if name in self.interned:
+                value = intern_string(value, strings)
+            setattr(self, name, value)
+        return self
+
+    @classmethod
+    def from_json(cls, data, strings=None):
+        "Create an object from a dict as returned by the API."
+
+        return cls().update(data, strings)
+
+    def to_json(self):
+        "Return the fields as a dict like the one returned by the API."
+
+        data = dict(self._extra or {})
+        for name in self.__slots__:
+            value = getattr(self, name)
+            if value is not None:
+                data[name] = value
+        return data
+
+
+class CompactReading(CompactResource):
+    "A reading of a device model, with interned meaning and unit."
+
+    __slots__ = ('meaning', 'unit', 'minimum', 'maximum', 'precision')
+    interned = ('meaning', 'unit')
+
+    def __repr__(self):
+        return "%s(meaning=%r)" % (self.__class__.__name__, self.meaning)
+
+
+class CompactDeviceModel(CompactResource):
+    "A device model with its readings as a tuple of :py:class:`CompactReading`."
+
+    __slots__ = ('id', 'name', 'manufacturer', 'readings')
+    interned = ('id', 'name', 'manufacturer')
+
+    @classmethod
+    def from_json(cls, data, strings=None):
+        "Create a device model from a dict as returned by the API."
+
+        data = dict(data)
+        if data.get('readings') is not None:
+            data['readings'] = tuple(CompactReading.from_json(r, strings)
+                for r in data['readings'])
+        return cls().update(data, strings)
+
+    def to_json(self):
+        data = CompactResource.to_json(self)
+        if self.readings is not None:
+            data['readings'] = [r.to_json() for r in self.readings]
+        return data
+
+
+class CompactDevice(CompactResource):
+    """
+    A device whose ``model`` is a :py:class:`CompactDeviceModel`, shared
+    with all other devices of the same model created with the same dict
+    of models.
+    """
+
+    __slots__ = ('id', 'name', 'description', 'owner', 'model',
+        'firmwareVersion', 'public', 'secret')
+    interned = ('owner', 'firmwareVersion')
+
+    @classmethod
+    def from_json(cls, data, models=None, strings=None):
+        """
+        Create a device from a dict as returned by the API.
+
+        :param data: the device fields, with the model given as a dict or ID
+        :type data: dict
+        :param models: device models already created, keyed by ID, to be
+            shared, new ones are added
+        :type models: dict
+        :param strings: a pool of non-native strings to be shared, new ones
+            are added
+        :type strings: dict
+        """
+        data = dict(data)
+        model = data.get('model')
+        if model is not None:
+            if models is None:
+                models = {}
+            if isinstance(model, dict):
+                modelID = model.get('id')
+            else:
+                modelID, model = model, None
+            shared = models.get(modelID)
+            if shared is None:
+                shared = models[modelID] = CompactDeviceModel(
+                    id=intern_string(modelID, strings))
+            if model is not None and shared.name is None:
+                # fill in a model first seen as an ID only
+                full = CompactDeviceModel.from_json(model, strings)
+                for name in CompactDeviceModel.__slots__ + ('_extra',):
+                    object.__setattr__(shared, name, getattr(full, name))
+            data['model'] = shared
+        return cls().update(data, strings)
+
+    def to_json(self):
+        data = CompactResource.to_json(self)
+        if self.model is not None:
+            data['model'] = self.model.to_json()
+        return data
@@ -11,9 +11,15 @@ PY26 = sys.version_info[:2] == (2, 6)
 
 if PY2:
     from urllib import urlopen
-    from urllib import urlencode
+    from urllib import urlencode, quote
     from urllib2 import URLError
+    from urlparse import urlparse
+    from Queue import Queue, Full, Empty
+    intern = intern
 else:
     from urllib.request import urlopen
-    from urllib.parse import urlencode
+    from urllib.parse import urlencode, quote
     from urllib.error import URLError
+    from urllib.parse import urlparse
+    from queue import Queue, Full, Empty
+    from sys import intern
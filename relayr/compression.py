@@ -0,0 +1,126 @@
+# -*- coding: utf-8 -*-
+
+"""
+Compressed Transfers
+
+This module provides the compression settings of :py:class:`relayr.api.Api`
+for slow or metered links. Responses are requested in every encoding
+available here, i.e. ``gzip`` and ``deflate`` and also ``br`` if the
+optional ``brotli`` package is installed, and are decompressed
+transparently. Request bodies above a size threshold, like bulk readings
+posted with ``post_device_data``, are compressed before sending. Bytes
+before and after compression are counted in both directions.
+
+Compressed request bodies must be supported by the server, so request
+compression is only enabled with an explicit threshold.
+
+Example:
+
+.. code-block:: python
+
+    from relayr import Client
+    from relayr.compression import Compression
+
+    c = Client(token='<my_access_token>')
+    c.api.compression = Compression(threshold=1024)
+    ...
+    print(c.api.compression.stats())
+"""
+
+import zlib
+import threading
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+class Compression(object):
+    """
+    Compression settings and transfer statistics.
+
+    The ``stats`` method reports per direction the bytes of the bodies
+    (``raw``) and the bytes transferred (``wire``) and their ratio.
+    """
+
+    def __init__(self, threshold=None, encoding='gzip', level=6):
+        """
+        :param threshold: The size in bytes above which request bodies are
+            compressed, None to never compress requests.
+        :type threshold: int
+        :param encoding: The request encoding, ``gzip`` or ``br``.
+        :type encoding: string
+        :param level: The compression level, 1 (fast) to 9 (small), for
+            ``br`` mapped to the quality range 0 to 11.
+        :type level: int
+        """
+        if encoding not in ('gzip', 'br'):
+            raise ValueError('Unsupported encoding: %s' % encoding)
+        if encoding == 'br' and brotli is None:
+            raise ValueError("Encoding 'br' requires the brotli package")
+        self.threshold = threshold
+        self.encoding = encoding
+        self.level = level
+        self.accept_encoding = 'gzip, deflate, br' if brotli else 'gzip, deflate'
+        self.sent_raw = self.sent_wire = 0
+        self.received_raw = self.received_wire = 0
+        self._lock = threading.Lock()
+
+    def compress(self, body):
+        "Return a request body compressed with the configured encoding."
+
+        if self.encoding == 'br':
+            return brotli.compress(body, quality=int(round(self.level * 11 / 9.0)))
+        # wbits 16 + MAX_WBITS writes a gzip header and trailer
+        c = zlib.compressobj(self.level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        return c.compress(body) + c.flush()
+
+    def encode(self, body):
+        """
+        Compress a request body if it exceeds the threshold.
+
+        :param body: The encoded request body.
+        :type body: bytes
+        :rtype: tuple of the body to send and its ``Content-Encoding`` or None
+        """
+        encoding = None
+        raw = len(body)
+        if self.threshold is not None and raw > self.threshold:
+            compressed = self.compress(body)
+            if len(compressed) < raw:
+                body, encoding = compressed, self.encoding
+        with self._lock:
+            self.sent_raw += raw
+            self.sent_wire += len(body)
+        return body, encoding
+
+    def record_response(self, raw, wire):
+        "Count the decompressed and transferred bytes of a response body."
+
+        with self._lock:
+            self.received_raw += raw
+            self.received_wire += wire
+
+    def stats(self):
+        "Return the counted bytes and compression ratios per direction."
+
+        with self._lock:
+            result = {}
+            for name, raw, wire in [('sent', self.sent_raw, self.sent_wire),
+                    ('received', self.received_raw, self.received_wire)]:
+                result[name] = {'raw': raw, 'wire': wire,
+                    'ratio': float(raw) / wire if wire else 1.0}
+            return result
+
+
+def wire_size(resp):
+    "Return the number of body bytes of a response read from the network."
+
+    tell = getattr(resp.raw, 'tell', None)
+    if tell is not None:
+        try:
+            return tell()
+        except Exception:
+            pass
+    return int(resp.headers.get('Content-Length') or 0)
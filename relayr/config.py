@@ -23,6 +23,9 @@ userAgentString += '({platform}; {arch}; {python_implementation}-{python_version
 DEBUG = False
 LOG = False
 LOG_DIR = os.getcwd()
+LOG_MAX_BYTES = 10 * 2**20
+LOG_BACKUPS = 5
+LOG_SAMPLE = 1
 RELAYR_FOLDER = os.path.expanduser('~/.relayr')
 MQTT_CERT_URL = 'http://mqtt.relayr.io/relayr.crt'
 
@@ -34,6 +37,9 @@ userAgentString = os.environ.get('RELAYR_DATAHUB', userAgentString)
 DEBUG = True if os.environ.get('RELAYR_DEBUG', 'False') == 'True' else False
 LOG = True if os.environ.get('RELAYR_LOG', 'False') == 'True' else False
 LOG_DIR = os.environ.get('RELAYR_LOG_DIR', LOG_DIR)
+LOG_MAX_BYTES = int(os.environ.get('RELAYR_LOG_MAX_BYTES', LOG_MAX_BYTES))
+LOG_BACKUPS = int(os.environ.get('RELAYR_LOG_BACKUPS', LOG_BACKUPS))
+LOG_SAMPLE = int(os.environ.get('RELAYR_LOG_SAMPLE', LOG_SAMPLE))
 RELAYR_FOLDER = os.environ.get('RELAYR_FOLDER', RELAYR_FOLDER)
 MQTT_CERT_URL = os.environ.get('MQTT_CERT_URL', MQTT_CERT_URL)
 
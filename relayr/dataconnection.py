@@ -11,14 +11,41 @@ import time
 import threading
 import platform
 import os
-from os.path import exists, join, expanduser, basename
+import warnings
+import traceback
+from os.path import exists, join, expanduser, basename, dirname
 
 import requests
 from Pubnub import Pubnub
 import paho.mqtt.client as mqtt
 
 from relayr import config
-from relayr.compat import PY2, PY3
+from relayr.compat import PY2, PY3, Queue
+from relayr.exceptions import RelayrException
+
+
+def mqtt_certificate_path():
+    "Return the path of the cached certificate for accessing the MQTT server."
+
+    folder = expanduser(config.RELAYR_FOLDER)
+    return join(folder, basename(config.MQTT_CERT_URL))
+
+
+def fetch_mqtt_certificate():
+    """
+    Fetch certificate for accessing MQTT server and cache it.
+
+    :rtype: the path of the cached certificate file
+    """
+    cert_path = mqtt_certificate_path()
+    folder = dirname(cert_path)
+    if not exists(folder):
+        os.makedirs(folder)
+    if not exists(cert_path):
+        resp = requests.get(config.MQTT_CERT_URL)
+        if resp.status_code == 200:
+            open(cert_path, 'wb').write(resp.content)
+    return cert_path
 
 
 class PubnubDataConnection(threading.Thread):
@@ -57,6 +84,27 @@ class PubnubDataConnection(threading.Thread):
 
         self.setDaemon(True)
 
+    @classmethod
+    def for_device(cls, callback, device, appID=None):
+        """
+        Create a connection to a single device.
+
+        :param callback: A callable to be called with two arguments:
+            message_content and channel_name.
+        :type callback: A function or object implementing the ``__call__`` method.
+        :param device: The device from which to receive data.
+        :type device: :py:class:`relayr.resources.Device`
+        :param appID: The UUID of the app receiving the data, or ``None``
+            for a public device.
+        :type appID: string
+        """
+        api = device.client.api
+        if appID is None:
+            creds = api.post_devices_public_subscription(device.id)
+        else:
+            creds = api.post_apps_devices(appID, device.id)
+        return cls(callback, creds)
+
     def run(self):
         """Thread method, called implicitly after starting the thread."""
 
@@ -97,41 +145,59 @@ class PubnubDataConnection(threading.Thread):
 class MqttStream(threading.Thread):
     "MQTT stream reading data from devices in the relayr cloud."
 
-    def __init__(self, callback, devices, transport='mqtt'):
+    def __init__(self, callback, devices, transport='mqtt', with_device=False):
         """
         Opens an MQTT connection with a callback and one or more devices.
 
         :param callback: A callable to be called with two arguments:
-            the topic and payload of a message.
+            the topic and payload of a message, plus the device the
+            topic belongs to as a third one if ``with_device`` is set.
+            It may be ``None`` if all devices have their own handler,
+            see :py:meth:`on`.
         :type callback: A function/method or object implementing the ``__call__`` method.
         :param devices: Device objects from which to receive data.
         :type devices: list
         :param transport: Name of the transport method, right now only 'mqtt'.
         :type transport: string
+        :param with_device: Flag indicating if callbacks and handlers also
+            get the device of a message.
+        :type with_device: bool
         """
         super(MqttStream, self).__init__()
         self._stop_event = threading.Event()
         self.callback = callback
+        self.with_device = with_device
         self.credentials_list = [dev.create_channel(transport)
             for dev in devices]
         self.topics = [credentials['credentials']['topic']
             for credentials in self.credentials_list]
+        # routing tables: topic -> device, device ID -> topic, topic -> handler
+        self.routes = dict(zip(self.topics, devices))
+        self._device_topics = dict((dev.id, t) for t, dev in self.routes.items())
+        self._handlers = {}
         self.setDaemon(True)
 
+    @classmethod
+    def for_device(cls, callback, device, appID=None):
+        """
+        Create a stream for a single device.
+
+        The ``appID`` parameter is ignored, MQTT channels are created
+        for the device itself.
+
+        :param callback: A callable to be called with two arguments:
+            the topic and payload of a message.
+        :type callback: A function/method or object implementing the ``__call__`` method.
+        :param device: The device from which to receive data.
+        :type device: :py:class:`relayr.resources.Device`
+        """
+        return cls(callback, [device])
+
     def _fetch_certificate(self):
         """
         Fetch certificate for accessing MQTT server and cache it.
         """
-        folder = expanduser(config.RELAYR_FOLDER)
-        cert_url = config.MQTT_CERT_URL
-        cert_filename = basename(cert_url)
-        if not exists(folder):
-            os.makedirs(folder)
-        if not exists(join(folder, cert_filename)):
-            resp = requests.get(cert_url)
-            if resp.status_code == 200:
-                cert = resp.content
-                open(join(folder, cert_filename), 'w').write(cert)
+        fetch_mqtt_certificate()
 
     def run(self):
         """
@@ -148,12 +214,9 @@ class MqttStream(threading.Thread):
 
         # only encryption, no authentication
         c.tls_insecure_set(True)
-        folder = expanduser(config.RELAYR_FOLDER)
-        cert_url = config.MQTT_CERT_URL
-        cert_filename = basename(cert_url)
-        if not exists(join(folder, cert_filename)):
+        cert_path = mqtt_certificate_path()
+        if not exists(cert_path):
             self._fetch_certificate()
-        cert_path = join(folder, cert_filename)
         c.tls_set(ca_certs=cert_path)
 
         try:
@@ -200,12 +263,41 @@ class MqttStream(threading.Thread):
 
     def on_message(self, client, userdata, msg):
         """
-        Pass the message topic and payload as strings to our callback.
+        Pass the message topic and payload as strings to the handler
+        registered for the topic's device or else to our callback.
         """
-        if PY2:
-            self.callback(msg.topic, msg.payload)
+        topic = msg.topic
+        callback = self._handlers.get(topic, self.callback)
+        if callback is None:
+            return
+        payload = msg.payload if PY2 else msg.payload.decode("utf-8")
+        if self.with_device:
+            callback(topic, payload, self.routes.get(topic))
         else:
-            self.callback(msg.topic, msg.payload.decode("utf-8"))
+            callback(topic, payload)
+
+    def device_for(self, topic):
+        "Return the device a topic belongs to, or None for unknown topics."
+        return self.routes.get(topic)
+
+    def on(self, device, handler):
+        """
+        Register a handler for messages of a specific device.
+
+        The handler is called instead of the stream's callback, with the
+        same arguments.
+
+        :param device: A device already added to the stream.
+        :type device: :py:class:`relayr.resources.Device`
+        :param handler: The callable handling the device's messages.
+        :type handler: A function/method or object implementing the ``__call__`` method.
+        """
+        self._handlers[self._device_topics[device.id]] = handler
+
+    def off(self, device):
+        "Unregister the handler of a specific device, if any."
+        topic = self._device_topics.get(device.id)
+        self._handlers.pop(topic, None)
 
     def add_device(self, device):
         "Add a specific device to the MQTT connection to receive data from."
@@ -215,6 +307,8 @@ class MqttStream(threading.Thread):
         # extract topic
         topic = creds['credentials']['topic']
         self.topics.append(topic)
+        self.routes[topic] = device
+        self._device_topics[device.id] = topic
         # subscribe topic
         if PY2:
            topic = topic.encode('utf-8')
@@ -223,20 +317,185 @@ class MqttStream(threading.Thread):
     def remove_device(self, device):
         "Remove a specific device from the MQTT connection to no longer receive data from."
         # find respective credentials
-        dummy_creds = device.create_channel('mqtt')
+        topic = self._device_topics.pop(device.id)
         creds = [c for c in self.credentials_list
-            if c['credentials']['topic'] == dummy_creds['credentials']['topic']][0]
-        # remove from self.credentials_list and self.topics
+            if c['credentials']['topic'] == topic][0]
+        # remove from self.credentials_list, self.topics and routing tables
         self.credentials_list.remove(creds)
-        topic = creds['credentials']['topic']
         self.topics.remove(topic)
+        del self.routes[topic]
+        self._handlers.pop(topic, None)
         # unsubscribe topic
         if PY2:
            topic = topic.encode('utf-8')
         self.client.unsubscribe(topic)
 
 
-if config.dataConnectionHubName == 'PubNub':
-    Connection = PubnubDataConnection
-elif config.dataConnectionHubName == 'MQTT':
-    Connection = MqttStream
+class KeyedDispatcher(object):
+    """
+    Dispatches messages by key to a fixed pool of worker threads.
+
+    Messages with the same key, e.g. the topic of a device, are always
+    handled by the same worker thread and hence strictly in order, while
+    messages with different keys are handled in parallel. An instance can
+    be used as the callback of a data connection:
+
+    .. code-block:: python
+
+        dispatcher = KeyedDispatcher(handle_reading, workers=8)
+        dispatcher.start()
+        stream = MqttStream(dispatcher, devices)
+        stream.start()
+        ...
+        print(dispatcher.hot_keys(3))
+    """
+
+    def __init__(self, callback, workers=4, key=None):
+        """
+        :param callback: A callable to be called on a worker thread with
+            the same arguments the dispatcher was called with.
+        :type callback: A function/method or object implementing the ``__call__`` method.
+        :param workers: The number of worker threads.
+        :type workers: int
+        :param key: A callable returning the key for the arguments of a
+            message. Defaults to the first argument, the topic for an
+            :py:class:`MqttStream`. For a :py:class:`PubnubDataConnection`
+            use e.g. ``lambda message, channel: channel``.
+        :type key: A function.
+        """
+        self.callback = callback
+        self.key = key or (lambda *args: args[0])
+        self.errors = 0
+        self._queues = [Queue() for i in range(workers)]
+        self._depths = {}
+        self._lock = threading.Lock()
+        self._threads = []
+
+    def __call__(self, *args):
+        "Queue a message for the worker thread responsible for its key."
+
+        k = self.key(*args)
+        with self._lock:
+            self._depths[k] = self._depths.get(k, 0) + 1
+        self._queues[hash(k) % len(self._queues)].put((k, args))
+
+    def start(self):
+        "Start the worker threads."
+
+        for q in self._queues:
+            t = threading.Thread(target=self._work, args=(q,))
+            t.setDaemon(True)
+            t.start()
+            self._threads.append(t)
+
+    def stop(self):
+        "Handle all queued messages, then stop the worker threads."
+
+        for q in self._queues:
+            q.put(None)
+        for t in self._threads:
+            t.join()
+        self._threads = []
+
+    def depth(self, key):
+        "Return the number of queued or running messages with given key."
+
+        return self._depths.get(key, 0)
+
+    def depths(self):
+        "Return a dict with the number of queued or running messages per key."
+
+        with self._lock:
+            return dict(self._depths)
+
+    def hot_keys(self, n=10):
+        "Return a list of up to n (key, depth) tuples with the largest depths."
+
+        items = sorted(self.depths().items(), key=lambda kv: kv[1], reverse=True)
+        return items[:n]
+
+    def _work(self, q):
+        while True:
+            item = q.get()
+            if item is None:
+                break
+            k, args = item
+            try:
+                self.callback(*args)
+            except Exception:
+                self.errors += 1
+                if config.DEBUG:
+                    warnings.warn('Dispatched callback failed:\n%s' % traceback.format_exc())
+            finally:
+                with self._lock:
+                    if self._depths[k] == 1:
+                        del self._depths[k]
+                    else:
+                        self._depths[k] -= 1
+
+
+# registry of data hub connection classes, keyed by hub name
+hubs = {}
+
+
+def register_hub(name, cls):
+    """
+    Register a connection class for a data hub under a given name.
+
+    The class must provide a ``for_device`` class method creating a
+    connection for a single device, see e.g.
+    :py:meth:`MqttStream.for_device`.
+
+    :param name: The name of the data hub, e.g. 'PubNub' or 'MQTT'.
+    :type name: string
+    :param cls: The connection class to be used for that data hub.
+    :type cls: class
+    """
+    hubs[name] = cls
+
+
+def get_hub(name=None):
+    """
+    Return the connection class registered for a data hub with given name.
+
+    :param name: The name of the data hub, defaults to
+        ``config.dataConnectionHubName`` when not given.
+    :type name: string
+    :rtype: A connection class.
+    """
+    name = name or config.dataConnectionHubName
+    try:
+        return hubs[name]
+    except KeyError:
+        msg = "Unknown data hub '%s', available are: %s"
+        raise RelayrException(msg % (name, ', '.join(sorted(hubs))))
+
+
+def connect(callback, device, appID=None, hub=None):
+    """
+    Create and return a connection to a device via the given data hub.
+
+    The data hub is selected at call time, so connections using different
+    hubs can be used side by side in the same process.
+
+    :param callback: A callable to be called for every received message,
+        its signature depends on the data hub used.
+    :type callback: A function/method or object implementing the ``__call__`` method.
+    :param device: The device from which to receive data.
+    :type device: :py:class:`relayr.resources.Device`
+    :param appID: The UUID of the app receiving the data, or ``None``
+        for a public device.
+    :type appID: string
+    :param hub: The name of the data hub, defaults to
+        ``config.dataConnectionHubName`` when not given.
+    :type hub: string
+    :rtype: A connection object (not yet started).
+    """
+    return get_hub(hub).for_device(callback, device, appID=appID)
+
+
+register_hub('PubNub', PubnubDataConnection)
+register_hub('MQTT', MqttStream)
+
+# kept for backwards compatibility, use connect() or get_hub() instead
+Connection = hubs.get(config.dataConnectionHubName)
@@ -5,9 +5,11 @@ This module contains exceptions raised when an operation on the
 relayr API or the relayr platform fails due to, 
 for example: missing credentials, invalid UIDs, etc.
 
-At the moment two exception classes are provided: 
+At the moment these exception classes are provided: 
 
 - ``RelayrApiException``: raised for exceptions caused by API calls
+- ``CircuitOpenException``: raised for API calls refused without sending
+  them, because their host failed repeatedly
 - ``RelayrException``: raised for other exceptions
 """
 
@@ -17,6 +19,11 @@ class RelayrApiException(Exception):
     RelayrApiException
     """
 
+class CircuitOpenException(RelayrApiException):
+    """
+    CircuitOpenException
+    """
+
 class RelayrException(Exception):
     """
     RelayrException
@@ -0,0 +1,399 @@
+# -*- coding: utf-8 -*-
+
+"""
+HTTP Response Cache
+
+This module provides a cache for the results of ``GET`` requests made by
+:py:class:`relayr.api.Api`. Results are kept in an in-memory LRU store and
+optionally also on disk. Freshness follows the ``Cache-Control`` response
+header unless overwritten per endpoint, and stale results carrying an
+``ETag`` or ``Last-Modified`` header are revalidated with a conditional
+request instead of being fetched again. Any other request to a resource
+invalidates the cached results of that resource, its sub-resources and
+its parent collection.
+
+Example:
+
+.. code-block:: python
+
+    from relayr import Client
+    from relayr.httpcache import ResponseCache, DiskStore
+
+    c = Client(token='<my_access_token>')
+    c.api.cache = ResponseCache(disk=DiskStore(),
+        ttls={'^/device-models': 3600, '^/apps$': 600})
+    models = c.api.get_public_device_models() # fetched
+    models = c.api.get_public_device_models() # cached
+"""
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+from os.path import exists, join
+
+from relayr import config
+from relayr.compat import urlparse, quote
+
+
+_max_age_pat = re.compile(r'max-age\s*=\s*(\d+)')
+
+
+def _key_path(key):
+    "Return the URL path of a cache key without trailing slash."
+
+    return urlparse(key.split(' ', 1)[1]).path.rstrip('/')
+
+
+class MemoryStore(object):
+    "A thread-safe in-memory store evicting the least recently used entries."
+
+    def __init__(self, maxsize=1000):
+        """
+        :param maxsize: The maximum number of entries.
+        :type maxsize: int
+        """
+        self.maxsize = maxsize
+        self._map = {}
+        # circular doubly linked list of [prev, next, key, value] links,
+        # the root's next link is the least recently used entry
+        self._root = root = []
+        root[:] = [root, root, None, None]
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._map)
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self._root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def get(self, key):
+        "Return the entry for a key or None, marking it as recently used."
+
+        with self._lock:
+            link = self._map.get(key)
+            if link is None:
+                return None
+            self._unlink(link)
+            self._append(link)
+            return link[3]
+
+    def set(self, key, value):
+        "Store an entry, evicting the least recently used one if full."
+
+        with self._lock:
+            link = self._map.get(key)
+            if link is not None:
+                self._unlink(link)
+            link = self._map[key] = [None, None, key, value]
+            self._append(link)
+            if len(self._map) > self.maxsize:
+                oldest = self._root[1]
+                self._unlink(oldest)
+                del self._map[oldest[2]]
+
+    def delete(self, key):
+        with self._lock:
+            link = self._map.pop(key, None)
+            if link is not None:
+                self._unlink(link)
+
+    def keys(self):
+        with self._lock:
+            return list(self._map.keys())
+
+
+class DiskStore(object):
+    """
+    A store keeping one JSON file per entry in a folder.
+
+    Entries are kept in one subfolder per URL path segment of their keys,
+    so results of a resource and its sub-resources can be removed by any
+    process sharing the folder without reading all entries.
+    """
+
+    def __init__(self, folder=None):
+        """
+        :param folder: The folder to store entries in, defaults to
+            ``httpcache`` in ``config.RELAYR_FOLDER``.
+        :type folder: string
+        """
+        self.folder = folder or join(config.RELAYR_FOLDER, 'httpcache')
+        if not exists(self.folder):
+            os.makedirs(self.folder)
+
+    def _dir(self, path):
+        # segments are prefixed so they never clash with entry file names
+        segments = ['@' + quote(s, safe='') for s in path.split('/') if s]
+        return join(self.folder, *segments)
+
+    def _path(self, key):
+        name = hashlib.sha1(key.encode('utf-8')).hexdigest()
+        return join(self._dir(_key_path(key)), name + '.json')
+
+    def get(self, key):
+        try:
+            with open(self._path(key)) as f:
+                return json.load(f)['value']
+        except (IOError, OSError, ValueError, KeyError):
+            return None
+
+    def version(self, key):
+        "Return a value changing whenever the entry of a key is written, None if there is none."
+
+        try:
+            st = os.stat(self._path(key))
+        except OSError:
+            return None
+        return st.st_ino, st.st_mtime
+
+    def set(self, key, value):
+        path = self._path(key)
+        folder = os.path.dirname(path)
+        if not exists(folder):
+            try:
+                os.makedirs(folder)
+            except OSError:
+                pass # created by another thread or process
+        tmp = path + '.%d.%d.tmp' % (os.getpid(), threading.current_thread().ident)
+        with open(tmp, 'w') as f:
+            json.dump({'key': key, 'value': value}, f)
+        os.rename(tmp, path)
+
+    def delete(self, key):
+        try:
+            os.remove(self._path(key))
+        except OSError:
+            pass
+
+    def _files(self, folder, subtree):
+        if not exists(folder):
+            return
+        if not subtree:
+            for name in os.listdir(folder):
+                if name.endswith('.json'):
+                    yield join(folder, name)
+            return
+        for root, dirs, names in os.walk(folder):
+            for name in names:
+                if name.endswith('.json'):
+                    yield join(root, name)
+
+    def delete_path(self, path, subtree=False):
+        "Remove the entries of a URL path and, if ``subtree`` is set, of all paths below."
+
+        for name in list(self._files(self._dir(path), subtree)):
+            try:
+                os.remove(name)
+            except OSError:
+                pass
+
+    def clear(self):
+        "Remove all entries."
+
+        self.delete_path('', subtree=True)
+
+    def keys(self):
+        keys = []
+        for name in self._files(self.folder, True):
+            try:
+                with open(name) as f:
+                    keys.append(json.load(f)['key'])
+            except (IOError, OSError, ValueError, KeyError):
+                pass
+        return keys
+
+
+class ResponseCache(object):
+    """
+    A cache for results of ``GET`` requests, used by :py:class:`relayr.api.Api`.
+
+    Entries are dicts with the result ``data``, the validators ``etag``
+    and ``last_modified`` and the ``expires`` timestamp. Results are cached
+    per URL and ``Authorization`` header, so users never see each other's
+    results. Results from memory are shared between callers and must not
+    be modified. With a disk store, results in memory are only used while
+    their file is unchanged, so writes and invalidations of other
+    processes sharing the store are seen.
+    """
+
+    def __init__(self, maxsize=1000, disk=None, ttls=None, default_ttl=0):
+        """
+        :param maxsize: The maximum number of results kept in memory.
+        :type maxsize: int
+        :param disk: An additional store keeping results across processes.
+        :type disk: :py:class:`DiskStore`
+        :param ttls: Times to live in seconds overwriting the ``Cache-Control``
+            header, keyed by regular expressions searched in URL paths.
+        :type ttls: dict
+        :param default_ttl: The time to live in seconds of results without
+            ``Cache-Control`` header and TTL override.
+        :type default_ttl: float
+        """
+        self.memory = MemoryStore(maxsize)
+        self.disk = disk
+        self.ttls = [(re.compile(pat), ttl) for pat, ttl in (ttls or {}).items()]
+        self.default_ttl = default_ttl
+        # keys in memory by URL path, so invalidation needs no scan
+        self._index = {}
+        self._indexed = 0
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.revalidations = 0
+        self.misses = 0
+
+    def key(self, url, headers=None):
+        "Return the cache key of a request."
+
+        auth = (headers or {}).get('Authorization', '').encode('utf-8')
+        return '%s %s' % (hashlib.sha1(auth).hexdigest()[:16], url)
+
+    def get(self, key):
+        "Return the cached entry for a key or None."
+
+        cached = self.memory.get(key)
+        if self.disk is None:
+            return None if cached is None else cached[1]
+        version = self.disk.version(key)
+        if version is None:
+            if cached is not None:
+                self.memory.delete(key)
+            return None
+        if cached is not None and cached[0] == version:
+            return cached[1]
+        entry = self.disk.get(key)
+        if entry is not None:
+            self._remember(key, version, entry)
+        return entry
+
+    def lookup(self, url, headers=None):
+        """
+        Return a fresh cached result, or conditional request headers.
+
+        :rtype: tuple of a flag indicating if the entry is fresh, the
+            entry (or None) and a dict of headers to add to the request
+        """
+        entry = self.get(self.key(url, headers))
+        if entry is None:
+            self.misses += 1
+            return False, None, {}
+        if time.time() < entry['expires']:
+            self.hits += 1
+            return True, entry, {}
+        self.revalidations += 1
+        conditions = {}
+        if entry.get('etag'):
+            conditions['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            conditions['If-Modified-Since'] = entry['last_modified']
+        return False, entry, conditions
+
+    def ttl(self, url, response_headers):
+        "Return the time to live in seconds for a response, None if not to be stored."
+
+        path = urlparse(url).path
+        for pat, ttl in self.ttls:
+            if pat.search(path):
+                return ttl
+        cache_control = response_headers.get('Cache-Control', '').lower()
+        if 'no-store' in cache_control:
+            return None
+        if 'no-cache' in cache_control:
+            return 0
+        m = _max_age_pat.search(cache_control)
+        if m:
+            return int(m.group(1))
+        return self.default_ttl
+
+    def store(self, url, headers, response_headers, data):
+        """
+        Cache the result of a successful request if permitted.
+
+        Results that expire immediately are only kept if they can be
+        revalidated.
+        """
+        ttl = self.ttl(url, response_headers)
+        etag = response_headers.get('ETag')
+        last_modified = response_headers.get('Last-Modified')
+        if ttl is None or (ttl <= 0 and not etag and not last_modified):
+            return
+        entry = {'data': data, 'etag': etag, 'last_modified': last_modified,
+            'expires': time.time() + ttl}
+        self._set(self.key(url, headers), entry)
+
+    def refresh(self, url, headers, response_headers, entry):
+        """
+        Renew a cached entry confirmed by a ``304 Not Modified`` response.
+        """
+        ttl = self.ttl(url, response_headers) or 0
+        entry = dict(entry, expires=time.time() + ttl)
+        if response_headers.get('ETag'):
+            entry['etag'] = response_headers['ETag']
+        self._set(self.key(url, headers), entry)
+        return entry
+
+    def _remember(self, key, version, entry):
+        "Keep an entry in memory with the version of its file, if any."
+
+        self.memory.set(key, (version, entry))
+        with self._lock:
+            keys = self._index.setdefault(_key_path(key), set())
+            if key not in keys:
+                keys.add(key)
+                self._indexed += 1
+            if self._indexed > 2 * self.memory.maxsize:
+                # drop keys evicted from memory
+                self._index = {}
+                self._indexed = 0
+                for k in self.memory.keys():
+                    self._index.setdefault(_key_path(k), set()).add(k)
+                    self._indexed += 1
+
+    def _set(self, key, entry):
+        version = None
+        if self.disk is not None:
+            self.disk.set(key, entry)
+            version = self.disk.version(key)
+        self._remember(key, version, entry)
+
+    def invalidate(self, url):
+        """
+        Remove cached results of a resource, its sub-resources and its
+        parent collection, e.g. after a write request to that resource.
+        """
+        path = urlparse(url).path.rstrip('/')
+        parent = path.rsplit('/', 1)[0]
+        prefix = path + '/'
+        keys = []
+        with self._lock:
+            for p in list(self._index):
+                if p == path or p == parent or p.startswith(prefix):
+                    removed = self._index.pop(p)
+                    self._indexed -= len(removed)
+                    keys.extend(removed)
+        for key in keys:
+            self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.delete_path(path, subtree=True)
+            self.disk.delete_path(parent)
+
+    def clear(self):
+        "Remove all cached results."
+
+        with self._lock:
+            self._index = {}
+            self._indexed = 0
+        for key in self.memory.keys():
+            self.memory.delete(key)
+        if self.disk is not None:
+            self.disk.clear()
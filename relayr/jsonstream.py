@@ -0,0 +1,182 @@
+# -*- coding: utf-8 -*-
+
+"""
+Streaming JSON Parsing
+
+This module parses a JSON array arriving in chunks of bytes, e.g. the body
+of a large API response, yielding each element as soon as it is complete.
+Only the elements currently parsed are held in memory, not the whole
+document or its decoded result.
+
+Example:
+
+.. code-block:: python
+
+    from relayr.jsonstream import iter_json_array
+
+    chunks = [b'[{"id": 1}, {"i', b'd": 2}]']
+    assert list(iter_json_array(chunks)) == [{'id': 1}, {'id': 2}]
+"""
+
+import re
+import json
+import codecs
+
+
+_whitespace_pat = re.compile('[ \t\n\r]*')
+_string_special_pat = re.compile(r'["\\]')
+_structure_pat = re.compile(r'["\[\]{}]')
+_scalar_end_pat = re.compile('[,\\]} \t\n\r]')
+
+
+class _Buffer(object):
+    "Text decoded from chunks of bytes, consumed from the front."
+
+    def __init__(self, chunks, encoding):
+        self.chunks = iter(chunks)
+        self.decoder = codecs.getincrementaldecoder(encoding)()
+        self.text = ''
+        self.pos = 0
+        self.eof = False
+
+    def read(self):
+        "Return the decoded text of the next non-empty chunk, '' at the end."
+
+        while not self.eof:
+            try:
+                chunk = next(self.chunks)
+            except StopIteration:
+                self.eof = True
+                chunk = b''
+            text = self.decoder.decode(chunk, final=self.eof)
+            if text:
+                return text
+        return ''
+
+    def fill(self):
+        "Append decoded text from the next non-empty chunk, return False at the end."
+
+        text = self.read()
+        if not text:
+            return False
+        if self.pos > len(self.text) // 2:
+            self.text = self.text[self.pos:]
+            self.pos = 0
+        self.text += text
+        return True
+
+    def peek(self):
+        "Skip whitespace and return the next character, '' at the end."
+
+        while True:
+            self.pos = _whitespace_pat.match(self.text, self.pos).end()
+            if self.pos < len(self.text):
+                return self.text[self.pos]
+            if not self.fill():
+                return ''
+
+    def complete(self):
+        """
+        Make sure the value starting at the current position is complete
+        in the text, unless the chunks end before.
+
+        Pieces of text are collected and scanned only once each, so a
+        large value is not decoded again for every chunk it spans.
+        """
+        scanner = _Scanner(self.text[self.pos])
+        if scanner.feed(self.text, self.pos) >= 0:
+            return
+        pieces = [self.text[self.pos:]]
+        while True:
+            text = self.read()
+            if text:
+                pieces.append(text)
+            if not text or scanner.feed(text) >= 0:
+                break
+        self.text = ''.join(pieces)
+        self.pos = 0
+
+
+class _Scanner(object):
+    """
+    Finds the end of a JSON value arriving in pieces of text by tracking
+    the nesting depth and whether the scan is inside a string.
+    """
+
+    def __init__(self, first):
+        self.scalar = first not in '[{"'
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+
+    def feed(self, text, pos=0):
+        "Scan text from pos, return the index after the value or -1 if not yet complete."
+
+        if self.scalar:
+            # a number or literal ends with the next delimiter
+            m = _scalar_end_pat.search(text, pos)
+            return -1 if m is None else m.start()
+        while True:
+            if self.escape:
+                if pos >= len(text):
+                    return -1
+                pos += 1
+                self.escape = False
+            pat = _string_special_pat if self.in_string else _structure_pat
+            m = pat.search(text, pos)
+            if m is None:
+                return -1
+            pos, c = m.end(), m.group()
+            if c == '\\':
+                self.escape = True
+            elif c == '"':
+                self.in_string = not self.in_string
+                if not self.in_string and self.depth == 0:
+                    return pos
+            elif c in '[{':
+                self.depth += 1
+            else:
+                self.depth -= 1
+                if self.depth <= 0:
+                    return pos
+
+
+def iter_json_array(chunks, encoding='utf-8'):
+    """
+    Yield the elements of a JSON array parsed incrementally from chunks.
+
+    :param chunks: An iterable of byte strings forming a JSON array.
+    :type chunks: iterable
+    :param encoding: The character encoding of the bytes.
+    :type encoding: string
+    :rtype: A generator of decoded elements.
+
+    A ``ValueError`` is raised when the document is no valid JSON array,
+    possibly after some elements were already yielded.
+    """
+    buf = _Buffer(chunks, encoding)
+    raw_decode = json.JSONDecoder().raw_decode
+    if buf.peek() != '[':
+        raise ValueError('Expected a JSON array')
+    buf.pos += 1
+    if buf.peek() == ']':
+        buf.pos += 1
+    else:
+        while True:
+            if not buf.peek():
+                raise ValueError('Unterminated JSON array')
+            buf.complete()
+            try:
+                value, buf.pos = raw_decode(buf.text, buf.pos)
+            except ValueError:
+                raise ValueError('Invalid JSON array element at '
+                    'character %d' % buf.pos)
+            yield value
+            sep = buf.peek()
+            buf.pos += 1
+            if sep == ']':
+                break
+            if sep != ',':
+                raise ValueError("Expected ',' or ']' in JSON array")
+    if buf.peek():
+        raise ValueError('Extra data after JSON array')
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+
+"""
+Logging
+
+This module sets up the single logger shared by all :py:class:`relayr.api.Api`
+instances when ``config.LOG`` is set. Records are handed over to a
+background thread through a bounded queue, so logging never blocks a
+request, and are written as one JSON object per line to a rotating file
+``relayr-api-<pid>.log`` in ``config.LOG_DIR``. Records of high-rate
+events, like the summary logged for every API request, can be marked
+for sampling so only every n-th of them is written.
+
+Example:
+
+.. code-block:: python
+
+    from relayr import config, log
+
+    config.LOG = True
+    log.configure(log_dir='/var/log/relayr', sample=100)
+    log.get_logger().info('reading', extra={'device': 'd1', 'value': 21.5})
+"""
+
+import os
+import json
+import time
+import atexit
+import logging
+import threading
+from logging.handlers import RotatingFileHandler
+
+from relayr import config
+from relayr.compat import Queue, Full
+
+
+LOGGER_NAME = 'Relayr API Client'
+
+# attributes of every log record, not to be repeated as extra fields
+_record_attrs = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None)))
+_record_attrs = _record_attrs.union(['message', 'asctime'])
+
+_handler = None
+_lock = threading.Lock()
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats records as single-line JSON objects.
+
+    Besides time, level, logger, thread and message every field passed
+    with the ``extra`` argument of a logging call is included.
+    """
+
+    def format(self, record):
+        stamp = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created))
+        doc = {
+            'time': '%s.%03dZ' % (stamp, record.msecs),
+            'level': record.levelname,
+            'logger': record.name,
+            'thread': record.threadName,
+            'message': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _record_attrs:
+                doc[key] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            doc['exception'] = record.exc_text
+        return json.dumps(doc, sort_keys=True, default=str)
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Passes only every n-th record marked for sampling.
+
+    Records are marked by passing ``extra={'sample': True}``. Passed
+    records get the sampling rate as their ``sample`` field, so counts
+    can be scaled back up. Unmarked records and warnings or worse always
+    pass.
+    """
+
+    def __init__(self, every=1):
+        """
+        :param every: Pass one of this many marked records.
+        :type every: int
+        """
+        logging.Filter.__init__(self)
+        self.every = max(1, int(every))
+        self.seen = 0
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if not getattr(record, 'sample', False) or record.levelno >= logging.WARNING:
+            return True
+        with self._lock:
+            self.seen += 1
+            keep = (self.seen - 1) % self.every == 0
+        record.sample = self.every
+        return keep
+
+
+class AsyncHandler(logging.Handler):
+    """
+    Hands records over to a background thread writing them with other handlers.
+
+    Records are queued without blocking the logging thread. When the queue
+    is full, records are dropped and counted in ``dropped``.
+    """
+
+    def __init__(self, handlers, maxsize=10000):
+        """
+        :param handlers: The handlers writing the records.
+        :type handlers: list
+        :param maxsize: The maximum number of queued records.
+        :type maxsize: int
+        """
+        logging.Handler.__init__(self)
+        self.handlers = handlers
+        self.queue = Queue(maxsize)
+        self.dropped = 0
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def prepare(self, record):
+        "Render message and exception now, as their arguments may change later."
+
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def emit(self, record):
+        try:
+            self.queue.put_nowait(self.prepare(record))
+        except Full:
+            self.dropped += 1
+        except Exception:
+            self.handleError(record)
+
+    def _run(self):
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    break
+                for h in self.handlers:
+                    if record.levelno >= h.level:
+                        h.handle(record)
+            finally:
+                self.queue.task_done()
+
+    def flush(self):
+        "Wait until all queued records are written."
+
+        if self._thread.is_alive():
+            self.queue.join()
+        for h in self.handlers:
+            h.flush()
+
+    def close(self):
+        "Write all queued records, stop the thread and close the handlers."
+
+        if self._thread.is_alive():
+            self.queue.put(None)
+            self._thread.join()
+        for h in self.handlers:
+            h.close()
+        logging.Handler.close(self)
+
+
+def configure(log_dir=None, max_bytes=None, backups=None, sample=None,
+    queue_size=10000, level=logging.INFO):
+    """
+    Set up the shared logger, replacing an earlier configuration.
+
+    Arguments not given are taken from ``config.LOG_DIR``,
+    ``config.LOG_MAX_BYTES``, ``config.LOG_BACKUPS`` and ``config.LOG_SAMPLE``.
+
+    :param log_dir: The folder to write log files into.
+    :type log_dir: string
+    :param max_bytes: The size of a log file at which it is rotated.
+    :type max_bytes: int
+    :param backups: The number of rotated log files kept.
+    :type backups: int
+    :param sample: Write one of this many records marked for sampling.
+    :type sample: int
+    :param queue_size: The maximum number of records waiting to be written.
+    :type queue_size: int
+    :param level: The level of the shared logger, ``logging.DEBUG`` to
+        also log curl commands and (truncated) response bodies of every
+        request, unsampled.
+    :type level: int
+    :rtype: ``logging.Logger``
+    """
+    global _handler
+    log_dir = log_dir or config.LOG_DIR
+    path = os.path.join(log_dir, 'relayr-api-%d.log' % os.getpid())
+    fh = RotatingFileHandler(path,
+        maxBytes=config.LOG_MAX_BYTES if max_bytes is None else max_bytes,
+        backupCount=config.LOG_BACKUPS if backups is None else backups)
+    fh.setFormatter(JsonFormatter())
+    handler = AsyncHandler([fh], queue_size)
+    handler.addFilter(SamplingFilter(config.LOG_SAMPLE if sample is None else sample))
+    logger = logging.getLogger(LOGGER_NAME)
+    logger.setLevel(level)
+    with _lock:
+        old, _handler = _handler, handler
+        logger.addHandler(handler)
+    if old is not None:
+        logger.removeHandler(old)
+        old.close()
+    return logger
+
+
+def get_logger():
+    "Return the shared logger, setting it up on first use."
+
+    with _lock:
+        configured = _handler is not None
+    if not configured:
+        return configure()
+    return logging.getLogger(LOGGER_NAME)
+
+
+def shutdown():
+    "Write all pending records and remove the handler from the shared logger."
+
+    global _handler
+    with _lock:
+        handler, _handler = _handler, None
+    if handler is not None:
+        logging.getLogger(LOGGER_NAME).removeHandler(handler)
+        handler.close()
+
+
+atexit.register(shutdown)
@@ -0,0 +1,377 @@
+# -*- coding: utf-8 -*-
+
+"""
+Multiprocess Data Pipeline
+
+This module provides a pipeline distributing received device data over
+several worker processes for CPU-bound per-message processing. The process
+owning the data connections ships batches of messages through shared memory
+ring buffers to the workers, which run a user provided handler. All messages
+of one topic are handled by the same worker, so results for a device are
+delivered in the order its messages were received.
+
+Example:
+
+.. code-block:: python
+
+    import time
+    from relayr import Client
+    from relayr.dataconnection import MqttStream
+    from relayr.pipeline import Pipeline
+
+    def score(topic, payload):
+        # runs in a worker process
+        return len(payload)
+
+    def show(topic, result):
+        # runs in the main process
+        print('%s %s' % (topic, result))
+
+    c = Client(token='<my_access_token>')
+    dev = c.get_device(id='<my_device_id>')
+    pipeline = Pipeline(score, show, workers=4)
+    pipeline.start()
+    stream = MqttStream(pipeline.submit, [dev])
+    stream.start()
+    time.sleep(10)
+    stream.stop()
+    pipeline.stop()
+"""
+
+import time
+import pickle
+import warnings
+import collections
+import struct
+import threading
+import traceback
+import multiprocessing
+from zlib import crc32
+
+from relayr import config
+from relayr.compat import PY2
+
+
+_header = struct.Struct('!I')
+
+
+class RingBuffer(object):
+    """
+    A ring buffer of byte records in shared memory.
+
+    It is meant for one producer and one consumer process, which need
+    to be forked/spawned after the buffer was created.
+    """
+
+    def __init__(self, size=2**22):
+        """
+        :param size: The buffer size in bytes.
+        :type size: int
+        """
+        self.size = size
+        self._data = multiprocessing.RawArray('c', size)
+        self._head = multiprocessing.RawValue('l', 0) # write position
+        self._tail = multiprocessing.RawValue('l', 0) # read position
+        self._used = multiprocessing.RawValue('l', 0) # bytes in use
+        self._cond = multiprocessing.Condition()
+
+    def _wait(self, predicate, timeout):
+        "Wait for a predicate holding the condition lock, False on timeout."
+
+        deadline = None if timeout is None else time.time() + timeout
+        while not predicate():
+            if deadline is None:
+                self._cond.wait()
+            else:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+        return True
+
+    def _view(self):
+        """
+        Return a byte view of the shared memory.
+
+        Copying through a memoryview is much faster than slicing the
+        ctypes array, which copies byte by byte (Python 3 only).
+        """
+
+        if PY2:
+            return self._data
+        return memoryview(self._data).cast('B')
+
+    def _write(self, pos, data):
+        view = self._view()
+        end = pos + len(data)
+        if end <= self.size:
+            view[pos:end] = data
+        else:
+            split = self.size - pos
+            view[pos:] = data[:split]
+            view[:end - self.size] = data[split:]
+        return end % self.size
+
+    def _read(self, pos, n):
+        view = self._view()
+        end = pos + n
+        if end <= self.size:
+            data = bytes(view[pos:end])
+        else:
+            data = bytes(view[pos:]) + bytes(view[:end - self.size])
+        return data, end % self.size
+
+    def put(self, record, timeout=None):
+        """
+        Append a record, waiting for free space if needed.
+
+        Raises ``ValueError`` if the record can never fit into the buffer.
+
+        :param record: The record to append.
+        :type record: bytes
+        :param timeout: The maximum waiting time in seconds or ``None``.
+        :type timeout: float
+        :rtype: bool, False if the record was not written due to a timeout.
+        """
+        n = _header.size + len(record)
+        if n > self.size:
+            raise ValueError('Record of %d bytes exceeds buffer size.' % n)
+        with self._cond:
+            if not self._wait(lambda: self.size - self._used.value >= n, timeout):
+                return False
+            pos = self._write(self._head.value, _header.pack(len(record)))
+            self._head.value = self._write(pos, record)
+            self._used.value += n
+            self._cond.notify_all()
+        return True
+
+    def get(self, timeout=None):
+        """
+        Remove and return the oldest record, waiting for one if needed.
+
+        :param timeout: The maximum waiting time in seconds or ``None``.
+        :type timeout: float
+        :rtype: bytes, or None on timeout.
+        """
+        with self._cond:
+            if not self._wait(lambda: self._used.value > 0, timeout):
+                return None
+            header, pos = self._read(self._tail.value, _header.size)
+            length = _header.unpack(header)[0]
+            record, self._tail.value = self._read(pos, length)
+            self._used.value -= _header.size + length
+            self._cond.notify_all()
+        return record
+
+
+def _work(handler, inbox, outbox):
+    "Worker process loop applying the handler to every message of a batch."
+
+    while True:
+        record = inbox.get()
+        if not record:
+            outbox.put(b'')
+            break
+        results = []
+        for topic, payload in pickle.loads(record):
+            try:
+                results.append((topic, handler(topic, payload), None))
+            except Exception:
+                results.append((topic, None, traceback.format_exc()))
+        outbox.put(pickle.dumps(results, 2))
+
+
+class Pipeline(object):
+    """
+    Distributes device data messages over several worker processes.
+
+    Messages are passed to :py:meth:`submit`, e.g. by using it as the
+    callback of a :py:class:`relayr.dataconnection.MqttStream`. The
+    ``handler`` runs in the worker processes, the ``result_callback`` in
+    the main process on one collector thread per worker. Exceptions
+    raised by the callbacks are counted in ``callback_errors``.
+    """
+
+    def __init__(self, handler, result_callback=None, error_callback=None,
+        workers=None, batch_size=100, batch_timeout=0.05, buffer_size=2**22):
+        """
+        :param handler: A callable to be called with two arguments, the
+            topic and payload of a message, in a worker process. It must be
+            picklable if processes are not started by forking.
+        :type handler: A function.
+        :param result_callback: A callable to be called with two arguments,
+            the topic and the value returned by the handler.
+        :type result_callback: A function/method or object implementing the ``__call__`` method.
+        :param error_callback: A callable to be called with two arguments,
+            the topic and a traceback string if the handler raised an exception.
+        :type error_callback: A function/method or object implementing the ``__call__`` method.
+        :param workers: The number of worker processes, defaults to the
+            number of CPUs.
+        :type workers: int
+        :param batch_size: The maximum number of messages shipped at once.
+        :type batch_size: int
+        :param batch_timeout: The maximum time in seconds a message waits
+            for its batch to fill up.
+        :type batch_timeout: float
+        :param buffer_size: The size in bytes of each ring buffer.
+        :type buffer_size: int
+        """
+        self.handler = handler
+        self.result_callback = result_callback
+        self.error_callback = error_callback
+        self.workers = workers or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.buffer_size = buffer_size
+        self.submitted = 0
+        self.processed = 0
+        self.errors = 0
+        self.callback_errors = 0
+        self._inboxes = [RingBuffer(buffer_size) for i in range(self.workers)]
+        self._outboxes = [RingBuffer(buffer_size) for i in range(self.workers)]
+        self._batches = [[] for i in range(self.workers)]
+        self._batch_bytes = [0] * self.workers
+        self._ready = [collections.deque() for i in range(self.workers)]
+        self._lock = threading.Lock()
+        self._ship_locks = [threading.Lock() for i in range(self.workers)]
+        self._count_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._processes = []
+        self._threads = []
+        self._flusher = None
+
+    def start(self):
+        "Start the worker processes and the collector and flusher threads."
+
+        for inbox, outbox in zip(self._inboxes, self._outboxes):
+            p = multiprocessing.Process(target=_work,
+                args=(self.handler, inbox, outbox))
+            p.daemon = True
+            p.start()
+            self._processes.append(p)
+        for outbox in self._outboxes:
+            t = threading.Thread(target=self._collect, args=(outbox,))
+            t.daemon = True
+            t.start()
+            self._threads.append(t)
+        t = threading.Thread(target=self._flush_periodically)
+        t.daemon = True
+        t.start()
+        self._flusher = t
+
+    def stop(self, timeout=10):
+        """
+        Process all submitted messages, then stop workers and threads.
+
+        Workers still running after ``timeout`` seconds are terminated.
+        """
+        self._stop_event.set()
+        if self._flusher is not None:
+            self._flusher.join()
+        self.flush()
+        deadline = time.time() + timeout
+        for inbox, p in zip(self._inboxes, self._processes):
+            if p.is_alive():
+                inbox.put(b'', timeout=max(0, deadline - time.time()))
+        for p, outbox in zip(self._processes, self._outboxes):
+            p.join(max(0, deadline - time.time()))
+            if p.is_alive():
+                p.terminate()
+                p.join()
+            if p.exitcode != 0:
+                # the worker died without sending its end marker
+                outbox.put(b'', timeout=1)
+        for t in self._threads:
+            t.join(max(0, deadline - time.time()))
+
+    def worker_for(self, topic):
+        "Return the index of the worker handling messages of a topic."
+
+        return crc32(topic.encode('utf-8')) % self.workers
+
+    def submit(self, topic, payload):
+        """
+        Add a message to the batch of the worker handling its topic.
+
+        The signature matches the callback of
+        :py:class:`relayr.dataconnection.MqttStream`. It blocks while the
+        worker's ring buffer is full.
+        """
+        i = self.worker_for(topic)
+        with self._lock:
+            self.submitted += 1
+            batch = self._batches[i]
+            batch.append((topic, payload))
+            self._batch_bytes[i] += len(payload)
+            full = len(batch) >= self.batch_size or \
+                self._batch_bytes[i] >= self.buffer_size // 4
+            if full:
+                self._close_batch(i)
+        if full:
+            self._ship(i)
+
+    def flush(self):
+        "Ship all pending batches to the workers."
+
+        with self._lock:
+            for i in range(self.workers):
+                if self._batches[i]:
+                    self._close_batch(i)
+        for i in range(self.workers):
+            self._ship(i)
+
+    def _close_batch(self, i):
+        "Queue the pending batch of worker i for shipping, needs the lock to be held."
+
+        self._ready[i].append(self._batches[i])
+        self._batches[i] = []
+        self._batch_bytes[i] = 0
+
+    def _ship(self, i):
+        """
+        Ship the queued batches of worker i in order, without holding the
+        pipeline lock, so a full worker only blocks its own producers.
+        Batches for a worker that died are dropped and counted as errors.
+        """
+        ready, inbox = self._ready[i], self._inboxes[i]
+        with self._ship_locks[i]:
+            while ready:
+                batch = ready.popleft()
+                record = pickle.dumps(batch, 2)
+                while not inbox.put(record, timeout=1):
+                    if self._processes and not self._processes[i].is_alive():
+                        with self._count_lock:
+                            self.errors += len(batch)
+                        break
+
+    def _flush_periodically(self):
+        while not self._stop_event.is_set():
+            self._stop_event.wait(self.batch_timeout)
+            self.flush()
+
+    def _collect(self, outbox):
+        "Collector thread loop passing results of one worker to the callbacks."
+
+        while True:
+            record = outbox.get()
+            if not record:
+                break
+            results = pickle.loads(record)
+            with self._count_lock:
+                self.processed += len(results)
+            for topic, result, error in results:
+                if error is not None:
+                    with self._count_lock:
+                        self.errors += 1
+                try:
+                    if error is None:
+                        if self.result_callback is not None:
+                            self.result_callback(topic, result)
+                    elif self.error_callback is not None:
+                        self.error_callback(topic, error)
+                except Exception:
+                    # a dead collector would block its worker and submit()
+                    with self._count_lock:
+                        self.callback_errors += 1
+                    if config.DEBUG:
+                        warnings.warn('Pipeline callback failed:\n%s' % traceback.format_exc())
@@ -0,0 +1,255 @@
+# -*- coding: utf-8 -*-
+
+"""
+Client-side Rate Limiting
+
+This module provides a rate limiter for :py:class:`relayr.api.Api` that
+lets bulk jobs run as fast as the platform accepts. Requests are grouped by
+endpoint, e.g. all ``/devices/...`` requests form one group. Each group
+has a token bucket limiting its request rate and an adaptive limit of
+concurrent requests, which grows additively while requests succeed and
+shrinks multiplicatively when the platform answers with ``429 Too Many
+Requests`` or ``503 Service Unavailable``. Such responses also pause the
+group for the time given in their ``Retry-After`` header.
+
+Example:
+
+.. code-block:: python
+
+    from relayr import Client
+    from relayr.ratelimit import RateLimiter
+
+    c = Client(token='<my_access_token>')
+    c.api.limiter = RateLimiter(rate=20, rates={'devices': 50})
+"""
+
+import re
+import time
+import threading
+from email.utils import parsedate_tz, mktime_tz
+
+from relayr.compat import urlparse
+
+
+THROTTLED = (429, 503)
+
+
+def parse_retry_after(value):
+    """
+    Return the seconds to wait given by a ``Retry-After`` header value or None.
+
+    The value can be a number of seconds or an HTTP date.
+    """
+    if not value:
+        return None
+    value = value.strip()
+    if value.isdigit():
+        return int(value)
+    date = parsedate_tz(value)
+    if date is None:
+        return None
+    return max(0, mktime_tz(date) - time.time())
+
+
+class TokenBucket(object):
+    "A thread-safe token bucket limiting the rate of events."
+
+    def __init__(self, rate, burst=None):
+        """
+        :param rate: The number of tokens added per second.
+        :type rate: float
+        :param burst: The maximum number of tokens, defaults to the rate.
+        :type burst: float
+        """
+        self.rate = float(rate)
+        self.burst = float(burst or max(1, rate))
+        self.tokens = self.burst
+        self.paused_until = 0
+        self._stamp = time.time()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.tokens = min(self.burst, self.tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def acquire(self):
+        "Take one token, waiting until one is available."
+
+        while True:
+            with self._lock:
+                now = time.time()
+                self._refill(now)
+                if now < self.paused_until:
+                    delay = self.paused_until - now
+                elif self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                else:
+                    delay = (1 - self.tokens) / self.rate
+            time.sleep(delay)
+
+    def pause(self, seconds):
+        "Hand out no tokens for some time, e.g. as requested by the server."
+
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.time() + seconds)
+            self.tokens = 0
+
+
+class AdaptiveConcurrency(object):
+    """
+    A limit of concurrent requests adapted by additive increase and
+    multiplicative decrease (AIMD).
+
+    Every successful request raises the limit by ``increase / limit``, so
+    by about ``increase`` per round of requests at the current limit.
+    Every throttled request multiplies it by ``decrease``.
+    """
+
+    def __init__(self, initial=4, minimum=1, maximum=64, increase=1.0,
+        decrease=0.5):
+        """
+        :param initial: The initial limit.
+        :type initial: float
+        :param minimum: The lowest limit.
+        :type minimum: float
+        :param maximum: The highest limit.
+        :type maximum: float
+        :param increase: The increase per round of successful requests.
+        :type increase: float
+        :param decrease: The factor applied on throttling.
+        :type decrease: float
+        """
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.in_flight = 0
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        "Wait until another request may be started."
+
+        with self._cond:
+            while self.in_flight >= max(1, int(self.limit)):
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, throttled=False):
+        "Record the end of a request and adapt the limit."
+
+        with self._cond:
+            self.in_flight -= 1
+            if throttled:
+                self.limit = max(self.minimum, self.limit * self.decrease)
+            else:
+                self.limit = min(self.maximum,
+                    self.limit + self.increase / self.limit)
+            self._cond.notify_all()
+
+
+class RateLimiter(object):
+    """
+    Limits rate and concurrency of API requests per endpoint group.
+
+    By default a request's group is the first segment of its URL path,
+    e.g. ``devices`` for ``/devices/<id>/data``. Groups are created on
+    first use.
+    """
+
+    def __init__(self, rate=10, burst=None, rates=None, groups=None,
+        concurrency=4, max_concurrency=64, max_retries=3):
+        """
+        :param rate: The default number of requests per second per group.
+        :type rate: float
+        :param burst: The default number of requests that may be sent at
+            once after an idle period, defaults to the rate.
+        :type burst: float
+        :param rates: Requests per second overwriting the default per group.
+        :type rates: dict
+        :param groups: Group names keyed by regular expressions searched in
+            URL paths, tried before the default grouping.
+        :type groups: dict
+        :param concurrency: The initial concurrency limit per group.
+        :type concurrency: int
+        :param max_concurrency: The highest concurrency limit per group.
+        :type max_concurrency: int
+        :param max_retries: The number of times a throttled request is
+            sent again by :py:class:`relayr.api.Api`, after ``429``
+            responses and, for idempotent methods only, ``503`` responses.
+        :type max_retries: int
+        """
+        self.rate = rate
+        self.burst = burst
+        self.rates = rates or {}
+        self.patterns = [(re.compile(pat), name)
+            for pat, name in (groups or {}).items()]
+        self.concurrency = concurrency
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.buckets = {}
+        self.limits = {}
+        self.throttled = 0
+        self._lock = threading.Lock()
+
+    def group(self, url):
+        "Return the group name of a request URL."
+
+        path = urlparse(url).path
+        for pat, name in self.patterns:
+            if pat.search(path):
+                return name
+        segments = path.strip('/').split('/')
+        return segments[0]
+
+    def _get(self, group):
+        with self._lock:
+            if group not in self.buckets:
+                rate = self.rates.get(group, self.rate)
+                self.buckets[group] = TokenBucket(rate, self.burst)
+                self.limits[group] = AdaptiveConcurrency(self.concurrency,
+                    maximum=self.max_concurrency)
+            return self.buckets[group], self.limits[group]
+
+    def acquire(self, url):
+        """
+        Wait until a request may be sent, return its group name.
+
+        Every call must be followed by a call to :py:meth:`release`.
+        """
+        group = self.group(url)
+        bucket, limit = self._get(group)
+        limit.acquire()
+        bucket.acquire()
+        return group
+
+    def release(self, group, status=None, retry_after=None):
+        """
+        Record the end of a request of a group.
+
+        :param group: The group name returned by :py:meth:`acquire`.
+        :type group: string
+        :param status: The response status code, None if there was none.
+        :type status: int
+        :param retry_after: The ``Retry-After`` response header, if any.
+        :type retry_after: string
+        :rtype: bool, True if the request was throttled
+        """
+        bucket, limit = self._get(group)
+        throttled = status in THROTTLED
+        limit.release(throttled)
+        if throttled:
+            with self._lock:
+                self.throttled += 1
+            delay = parse_retry_after(retry_after)
+            bucket.pause(1.0 / bucket.rate if delay is None else delay)
+        return throttled
+
+    def stats(self):
+        "Return the current rate and concurrency limit per group."
+
+        with self._lock:
+            return dict((g, {'rate': self.buckets[g].rate,
+                'concurrency': self.limits[g].limit,
+                'in_flight': self.limits[g].in_flight}) for g in self.buckets)
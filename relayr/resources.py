@@ -8,8 +8,167 @@ devices, device models and transmitters.
 """
 
 
+import threading
+
 from relayr import exceptions
-from relayr.dataconnection import Connection
+from relayr import dataconnection
+from relayr.compat import Queue, Empty
+
+
+def run_concurrently(func, items, concurrency=8):
+    """
+    Call a function for each of several items on a pool of threads.
+
+    Duplicate items are processed once. An exception raised for one item
+    does not stop the others, it is returned instead of its result.
+
+    :param func: the function to be called with each item
+    :type func: A function.
+    :param items: hashable items, e.g. IDs or resources
+    :type items: iterable
+    :param concurrency: the maximum number of concurrent calls
+    :type concurrency: int
+    :rtype: A tuple of a dict of results and a dict of exceptions, both
+        keyed by item.
+    """
+    todo = Queue()
+    seen = set()
+    for item in items:
+        if item not in seen:
+            seen.add(item)
+            todo.put(item)
+    results, errors = {}, {}
+
+    def work():
+        while True:
+            try:
+                item = todo.get_nowait()
+            except Empty:
+                return
+            try:
+                results[item] = func(item)
+            except Exception as e:
+                errors[item] = e
+
+    threads = [threading.Thread(target=work)
+        for i in range(max(1, min(concurrency, len(seen))))]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        t.join()
+    return results, errors
+
+
+def load_all(resources, concurrency=8):
+    """
+    Retrieve the info of several resources concurrently.
+
+    Resources whose info cannot be retrieved are left as they are, so
+    the error is raised when their info is needed.
+
+    :param resources: resources with a ``get_info`` method
+    :type resources: list
+    :param concurrency: the maximum number of concurrent requests
+    :type concurrency: int
+    """
+    run_concurrently(lambda res: res.get_info(), resources, concurrency)
+
+
+class Batch(object):
+    """
+    A group of resources whose info is retrieved together when the first
+    of them needs it, see :py:class:`LazyInfo`.
+    """
+
+    def __init__(self, resources, concurrency=8):
+        """
+        :param resources: the resources of the group
+        :type resources: list
+        :param concurrency: the maximum number of concurrent requests
+        :type concurrency: int
+        """
+        self.resources = resources
+        self.concurrency = concurrency
+        self.done = False
+        self._lock = threading.Lock()
+        for res in resources:
+            res._batch = self
+
+    def load(self):
+        "Retrieve the info of all resources not loaded yet, only once."
+
+        with self._lock:
+            if not self.done:
+                self.done = True
+                load_all([r for r in self.resources if not r._loaded],
+                    self.concurrency)
+
+
+def batched(resources, size, concurrency=8):
+    """
+    Yield resources, grouping every ``size`` of them in a :py:class:`Batch`.
+
+    The resources of a group are read ahead from the given iterable
+    before the first of them is yielded. A size of 0 yields them as they
+    come without grouping them. The info of a group is retrieved with at
+    most ``concurrency`` concurrent requests, however large it is.
+    """
+    if not size:
+        for res in resources:
+            yield res
+        return
+    group = []
+    for res in resources:
+        group.append(res)
+        if len(group) == size:
+            Batch(group, concurrency)
+            for r in group:
+                yield r
+            group = []
+    if group:
+        Batch(group, concurrency)
+        for r in group:
+            yield r
+
+
+class LazyInfo(object):
+    """
+    Retrieves a resource's info on first access of a missing attribute.
+
+    Resources created from list results only carry the fields listed
+    there, e.g. their ``id``. The first access of another attribute calls
+    ``get_info`` once, or retrieves the info of the resource's whole
+    :py:class:`Batch` if it belongs to one.
+
+    This also applies to ``hasattr`` and ``getattr`` with a default, which
+    may therefore send requests and raise the exceptions of the API, e.g.
+    :py:class:`relayr.exceptions.RelayrApiException`, instead of returning
+    False or the default. Only attributes still missing after the info was
+    retrieved raise ``AttributeError``.
+    """
+
+    _loaded = False
+    _batch = None
+
+    def __getattr__(self, name):
+        d = self.__dict__
+        if name.startswith('_') or d.get('_loaded') or \
+                d.get('client') is None or d.get('id') is None:
+            raise AttributeError("%r object has no attribute %r" %
+                (self.__class__.__name__, name))
+        if self._batch is not None:
+            self._batch.load()
+        if not self._loaded:
+            self.get_info()
+        return object.__getattribute__(self, name)
+
+    def set_fields(self, fields):
+        "Store fields of the resource, e.g. from a list result, as attributes."
+
+        for k, v in fields.items():
+            setattr(self, k, v)
+        return self
 
 
 class User(object):
@@ -32,41 +191,55 @@ class User(object):
             yield p
 
     def get_apps(self):
-        "Returns a generator of the apps of the user."
+        "Returns a generator of the apps of the user, retrieving their info lazily."
 
         for app_json in self.client.api.get_user_apps(self.id):
             ## TODO: change 'app' field to 'id' in API?
-            app = App(app_json['app'], client=self.client)
-            app.get_info()
-            yield app
+            yield App(app_json['app'], client=self.client)
 
     def get_transmitters(self):
-        "Returns a generator of the transmitters of the user."
+        "Returns a generator of the transmitters of the user, retrieving their info lazily."
 
         for trans_json in self.client.api.get_user_transmitters(self.id):
-            trans = Transmitter(trans_json['id'], client=self.client)
-            trans.get_info()
-            yield trans
+            yield Transmitter(trans_json['id'], client=self.client).set_fields(trans_json)
 
-    def get_devices(self):
-        "Returns a generator of the devices of the user."
+    def get_devices(self, prefetch=0, stream=False):
+        """
+        Returns a generator of the devices of the user, retrieving their info lazily.
+
+        :param prefetch: the number of devices whose info is retrieved
+            together when the first of them needs it, see
+            :py:func:`batched`
+        :type prefetch: int
+        :param stream: parse the list while it is received, bypassing the
+            response cache
+        :type stream: bool
+        """
+        devices = (Device(dev_json['id'], client=self.client).set_fields(dev_json)
+            for dev_json in self.client.api.get_user_devices(self.id, stream=stream))
+        return batched(devices, prefetch)
+
+    def connect_device(self, app, device, callback, hub=None):
+        """
+        Opens and returns a connection to the data provider.
 
-        for dev_json in self.client.api.get_user_devices(self.id):
-            dev = Device(dev_json['id'], client=self.client)
-            dev.get_info()
-            yield dev
+        :param hub: the data hub name, e.g. 'PubNub' or 'MQTT', defaults
+            to ``config.dataConnectionHubName``
+        :type hub: string
+        """
 
-    def connect_device(self, app, device, callback):
-        "Opens and returns a connection to the data provider."
+        return dataconnection.connect(callback, device, appID=app.id, hub=hub)
 
-        creds = self.client.api.post_apps_devices(app.id, device.id)
-        return Connection(callback, creds)
+    def connect_public_device(self, device, callback, hub=None):
+        """
+        Opens and returns a connection to the data provider.
 
-    def connect_public_device(self, device, callback):
-        "Opens and returns a connection to the data provider."
+        :param hub: the data hub name, e.g. 'PubNub' or 'MQTT', defaults
+            to ``config.dataConnectionHubName``
+        :type hub: string
+        """
 
-        creds = self.client.api.post_devices_public_subscription(device.id)
-        return Connection(callback, creds)
+        return dataconnection.connect(callback, device, hub=hub)
 
     def disconnect_device(self, id):
         # There is no disconnect in the API...
@@ -195,7 +368,7 @@ class Publisher(object):
         res = self.api.delete_publisher(self.id)
 
 
-class App(object):
+class App(LazyInfo):
     """
     A relayr application.
 
@@ -232,6 +405,7 @@ class App(object):
         res = func(self.id)
         for k in res:
             setattr(self, k, res[k])
+        self._loaded = True
         return self
 
     def update(self, description=None, name=None, redirectUri=None):
@@ -293,7 +467,7 @@ class App(object):
         raise NotImplementedError
 
 
-class Device(object):
+class Device(LazyInfo):
     """
     A relayr device.
     """
@@ -305,20 +479,42 @@ class Device(object):
     def __repr__(self):
         return "%s(id=%r)" % (self.__class__.__name__, self.id)
 
-    def get_info(self):
+    def get_info(self, models=None):
         """
         Retrieves device info and stores it as instance attributes.
 
+        :param models: device models already retrieved, keyed by ID, to be
+            reused instead of retrieving them again, new ones are added
+        :type models: dict
         :rtype: self.
         """
 
         res = self.client.api.get_device(self.id)
         for k in res:
             if k == 'model':
-                self.model = DeviceModel(res[k]['id'], client=self.client)
-                self.model.get_info()
+                modelID = res[k]['id']
+                model = models.get(modelID) if models is not None else None
+                if model is None:
+                    model = DeviceModel(modelID, client=self.client)
+                    model.get_info()
+                    if models is not None:
+                        model = models.setdefault(modelID, model)
+                self.model = model
             else:
                 setattr(self, k, res[k])
+        self._loaded = True
+        return self
+
+    def set_fields(self, fields):
+        "Store fields of the device, e.g. from a list result, as attributes."
+
+        for k, v in fields.items():
+            if k == 'model':
+                if isinstance(v, dict):
+                    v = DeviceModel(v.get('id'), client=self.client).set_fields(v)
+                elif v is not None:
+                    v = DeviceModel(v, client=self.client)
+            setattr(self, k, v)
         return self
 
     def update(self, description=None, name=None, modelID=None, public=None):
@@ -349,9 +545,7 @@ class Device(object):
         :rtype: A list of apps.
         """
         for app_json in self.client.api.get_device_apps(self.id):
-            app = App(id=app_json['id'], client=self.client)
-            app.get_info()
-            yield app
+            yield App(id=app_json['id'], client=self.client).set_fields(app_json)
 
     def connect_to_app(self, app):
         """
@@ -379,23 +573,28 @@ class Device(object):
         res = self.client.api.delete_app_device(app.id, self.id)
         return res
 
-    def connect_to_device(self, appID, id, callback):
+    def connect_to_device(self, appID, id, callback, hub=None):
         """
         Subscribes a user to a device.
+
+        :param hub: the data hub name, e.g. 'PubNub' or 'MQTT', defaults
+            to ``config.dataConnectionHubName``
+        :type hub: string
         """
-        creds = self.client.api.post_apps_devices(appID, self.id)
-        return Connection(callback, creds)
+        return dataconnection.connect(callback, self, appID=appID, hub=hub)
 
-    def connect_to_public_device(self, id, callback):
+    def connect_to_public_device(self, id, callback, hub=None):
         """
         Subscribes a user to a public device.
 
         :param id: the device's UID
         :type id: string
+        :param hub: the data hub name, e.g. 'PubNub' or 'MQTT', defaults
+            to ``config.dataConnectionHubName``
+        :type hub: string
         """
 
-        creds = self.client.api.post_devices_public_subscription(self.id)
-        return Connection(callback, creds)
+        return dataconnection.connect(callback, self, hub=hub)
 
     def send_command(self, command):
         """
@@ -461,7 +660,7 @@ class Device(object):
         return res
 
 
-class DeviceModel(object):
+class DeviceModel(LazyInfo):
     """
     relayr device model.
     """
@@ -482,10 +681,11 @@ class DeviceModel(object):
         res = self.client.api.get_device_model(self.id)
         for k, v in res.items():
             setattr(self, k, v)
+        self._loaded = True
         return self
 
 
-class Transmitter(object):
+class Transmitter(LazyInfo):
     "A relayr transmitter, The Master Module, for example."
 
     def __init__(self, id=None, client=None):
@@ -503,6 +703,7 @@ class Transmitter(object):
         res = self.client.api.get_transmitter(self.id)
         for k, v in res.items():
             setattr(self, k, v)
+        self._loaded = True
         return self
 
     def delete(self):
@@ -532,6 +733,4 @@ class Transmitter(object):
         """
         res = self.client.api.get_transmitter_devices(self.id)
         for d in res:
-            dev = Device(d['id'], client=self.client)
-            dev.get_info()
-            yield dev
+            yield Device(d['id'], client=self.client).set_fields(d)
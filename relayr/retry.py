@@ -0,0 +1,201 @@
+# -*- coding: utf-8 -*-
+
+"""
+Retries and Circuit Breaking
+
+This module provides the policies :py:class:`relayr.api.Api` uses to cope
+with transient failures. A :py:class:`RetryPolicy` sends failed idempotent
+requests again after exponentially growing, randomized delays within a
+total deadline. A :py:class:`CircuitBreaker` stops sending requests to a
+host for a while after several consecutive failures, so callers fail fast
+instead of piling up on a broken host.
+
+Example:
+
+.. code-block:: python
+
+    from relayr.api import Api
+    from relayr.retry import RetryPolicy, CircuitBreaker
+
+    api = Api(token='<my_access_token>', timeout=(3, 10),
+        retry=RetryPolicy(retries=5, deadline=60),
+        breaker=CircuitBreaker(threshold=10, reset_timeout=60))
+"""
+
+import time
+import random
+import threading
+
+from requests.exceptions import ConnectionError, ConnectTimeout, Timeout
+
+from relayr.exceptions import CircuitOpenException
+
+
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+
+class RetryPolicy(object):
+    """
+    Decides if and when a failed request is sent again.
+
+    Idempotent requests are retried after connection errors, timeouts and
+    responses with one of the given status codes. Other requests are only
+    retried if the connection could not be established, i.e. they were
+    never sent. Delays use "full jitter": a random time between zero and
+    ``backoff * 2 ** attempt`` seconds, capped at ``max_backoff``.
+    """
+
+    def __init__(self, retries=3, backoff=0.1, max_backoff=10, deadline=90,
+        statuses=(500, 502, 503, 504), methods=IDEMPOTENT_METHODS):
+        """
+        :param retries: The maximum number of retries per request.
+        :type retries: int
+        :param backoff: The base delay in seconds.
+        :type backoff: float
+        :param max_backoff: The maximum delay in seconds.
+        :type max_backoff: float
+        :param deadline: The maximum time in seconds spent on a request
+            including all retries. The read timeout of each attempt is
+            shortened to the time left, so it should be longer than the
+            read timeout of the :py:class:`relayr.api.Api`.
+        :type deadline: float
+        :param statuses: The response status codes to retry.
+        :type statuses: tuple
+        :param methods: The HTTP methods considered idempotent.
+        :type methods: tuple
+        """
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.deadline = deadline
+        self.statuses = statuses
+        self.methods = methods
+
+    def should_retry(self, method, attempt, deadline, status=None, error=None):
+        """
+        Return True if a failed request should be sent again.
+
+        :param method: The HTTP method.
+        :type method: string
+        :param attempt: The number of retries so far.
+        :type attempt: int
+        :param deadline: The time after which no retries are made.
+        :type deadline: float
+        :param status: The response status code, if there was a response.
+        :type status: int
+        :param error: The exception raised while sending, if any.
+        :type error: Exception
+        """
+        if attempt >= self.retries or time.time() >= deadline:
+            return False
+        if isinstance(error, ConnectTimeout):
+            return True
+        if method.upper() not in self.methods:
+            return False
+        if error is not None:
+            return isinstance(error, (ConnectionError, Timeout))
+        return status in self.statuses
+
+    def delay(self, attempt, deadline):
+        "Return the time in seconds to wait before a retry."
+
+        cap = min(self.max_backoff, self.backoff * 2 ** attempt)
+        return max(0, min(random.uniform(0, cap), deadline - time.time()))
+
+
+class CircuitBreaker(object):
+    """
+    Stops requests to hosts failing repeatedly.
+
+    Requests failing with connection errors, timeouts or one of the given
+    gateway status codes count as failures of the host, responses with
+    other status codes as successes, as the host was reachable. After
+    ``threshold`` consecutive failures the circuit of a host opens
+    and requests fail immediately. After ``reset_timeout`` seconds one
+    trial request is let through, which closes the circuit on success and
+    opens it again on failure. A trial without result, e.g. because it was
+    cancelled, lets another trial through ``reset_timeout`` seconds later.
+    """
+
+    def __init__(self, threshold=5, reset_timeout=30, statuses=(502, 503, 504)):
+        """
+        :param threshold: The number of consecutive failures opening the circuit.
+        :type threshold: int
+        :param reset_timeout: The time in seconds before a trial request.
+        :type reset_timeout: float
+        :param statuses: The response status codes counted as failures.
+        :type statuses: tuple
+        """
+        self.threshold = threshold
+        self.reset_timeout = reset_timeout
+        self.statuses = statuses
+        self.failures = {}
+        self.opened = {}
+        self._trials = {} # start times of trial requests
+        self._lock = threading.Lock()
+
+    def is_open(self, host):
+        "Return True if requests to the host are currently blocked."
+
+        with self._lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return False
+            now = time.time()
+            last = max(opened, self._trials.get(host, opened))
+            if now - last >= self.reset_timeout:
+                # half-open: let exactly one trial request through
+                self._trials[host] = now
+                return False
+            return True
+
+    def check(self, host):
+        "Raise ``CircuitOpenException`` if requests to the host are blocked."
+
+        if self.is_open(host):
+            raise CircuitOpenException('Circuit open for %s after %d failures' %
+                (host, self.failures.get(host, 0)))
+
+    def record(self, host, status=None, error=None):
+        """
+        Record the result of a request, after all its retries.
+
+        :param host: The host the request was sent to.
+        :type host: string
+        :param status: The response status code, if there was a response.
+        :type status: int
+        :param error: The exception raised while sending, if any.
+        :type error: Exception
+        """
+        if error is not None:
+            if isinstance(error, (ConnectionError, Timeout)):
+                self.failure(host)
+            else:
+                self.cancel(host)
+        elif status in self.statuses:
+            self.failure(host)
+        else:
+            self.success(host)
+
+    def success(self, host):
+        "Record a successful request, closing the circuit."
+
+        with self._lock:
+            self.failures.pop(host, None)
+            self.opened.pop(host, None)
+            self._trials.pop(host, None)
+
+    def failure(self, host):
+        "Record a failed request, opening the circuit if needed."
+
+        with self._lock:
+            n = self.failures[host] = self.failures.get(host, 0) + 1
+            if n >= self.threshold or host in self._trials:
+                self.opened[host] = time.time()
+                self._trials.pop(host, None)
+
+    def cancel(self, host):
+        "End a trial request without result, letting the next request try again."
+
+        with self._lock:
+            self._trials.pop(host, None)
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Simulator of the BlueZ tools ``hciconfig``, ``hcitool`` and ``gatttool``.
+
+This allows running and benchmarking the code in :py:mod:`relayr.ble`
+without Bluetooth hardware and root permissions. The simulated tools
+replay the GATT tables and values of a transcript of real devices with
+configurable latencies. The default transcript contains a WunderBar
+microphone module as captured in ``demos/scan_wunderbars.py``.
+
+The simulated tools are installed as small wrapper scripts into a folder
+that needs to be put in front of the ``PATH`` environment variable:
+
+.. code-block:: python
+
+    import os
+    from relayr.utils import bluezsim
+    bindir = bluezsim.install('/tmp/fakebluez', latency={'connect': 0.5})
+    os.environ['PATH'] = bindir + os.pathsep + os.environ['PATH']
+
+GATT requests sent via the same simulated adapter are handled one at a
+time, like on a real adapter, so throughput grows with the number of
+adapters used.
+
+A transcript is a JSON file (or dict) looking like this, with services
+given as ``[start handle, end handle, UUID]``, characteristics as
+``[name handle, properties, value handle, UUID]`` and values and
+notifications as hex digit strings per value handle::
+
+    {
+        "latency": {"scan": 0.1, "connect": 1.0, "command": 0.05, "notify": 0.1},
+        "adapters": ["hci0", "hci1"],
+        "devices": {
+            "F1:42:E6:63:20:A2": {
+                "name": "WunderbarMIC",
+                "services": [["0x0001", "0x0007", "00001800-0000-1000-8000-00805f9b34fb"], ...],
+                "characteristics": [["0x0002", "0x02", "0x0003", "00002a00-0000-1000-8000-00805f9b34fb"], ...],
+                "values": {"0x0003": "57 75 6e 64 65 72 62 61 72 4d 49 43", ...},
+                "notifications": {"0x001d": ["0a 00", "0b 00"]}
+            }
+        }
+    }
+
+This module uses only the standard library and is run as a script by the
+wrappers, so it does not import the relayr package.
+"""
+
+import os
+import re
+import sys
+import json
+import stat
+import fcntl
+import time
+import signal
+import threading
+
+
+UUID_FMT = '0000%s-0000-1000-8000-00805f9b34fb'
+
+DEFAULT_LATENCY = {
+    'scan': 0.1,     # time between two devices found by a scan
+    'connect': 1.0,  # time to connect to a device
+    'command': 0.05, # time for a single GATT request
+    'notify': 0.1,   # time between two notifications
+}
+
+DEFAULT_TRANSCRIPT = {
+    'latency': DEFAULT_LATENCY,
+    'adapters': ['hci0'],
+    'devices': {
+        'F1:42:E6:63:20:A2': {
+            'name': 'WunderbarMIC',
+            'services': [
+                ['0x0001', '0x0007', UUID_FMT % '1800'],
+                ['0x0008', '0x000b', UUID_FMT % '1801'],
+                ['0x000c', '0x001f', UUID_FMT % '2000'],
+                ['0x0020', '0x0026', UUID_FMT % '180a'],
+                ['0x0027', '0x002a', UUID_FMT % '180f'],
+            ],
+            'characteristics': [
+                ['0x0002', '0x02', '0x0003', UUID_FMT % '2a00'],
+                ['0x0004', '0x02', '0x0005', UUID_FMT % '2a01'],
+                ['0x0006', '0x02', '0x0007', UUID_FMT % '2a04'],
+                ['0x0009', '0x20', '0x000a', UUID_FMT % '2a05'],
+                ['0x000d', '0x02', '0x000e', UUID_FMT % '2010'],
+                ['0x0010', '0x0a', '0x0011', UUID_FMT % '2011'],
+                ['0x0013', '0x0a', '0x0014', UUID_FMT % '2012'],
+                ['0x0016', '0x08', '0x0017', UUID_FMT % '2013'],
+                ['0x0019', '0x0a', '0x001a', UUID_FMT % '2014'],
+                ['0x001c', '0x32', '0x001d', UUID_FMT % '2016'],
+                ['0x0021', '0x02', '0x0022', UUID_FMT % '2a29'],
+                ['0x0023', '0x02', '0x0024', UUID_FMT % '2a27'],
+                ['0x0025', '0x02', '0x0026', UUID_FMT % '2a26'],
+                ['0x0028', '0x12', '0x0029', UUID_FMT % '2a19'],
+            ],
+            'values': {
+                '0x0002': '02 03 00 00 2a',
+                '0x0003': '57 75 6e 64 65 72 62 61 72 4d 49 43',
+                '0x0004': '02 05 00 01 2a',
+                '0x0005': '00 02',
+                '0x0006': '02 07 00 04 2a',
+                '0x0007': 'b0 00 b0 00 05 00 2c 01',
+                '0x0009': '20 0a 00 05 2a',
+                '0x000d': '02 0e 00 10 20',
+                '0x0010': '0a 11 00 11 20',
+                '0x0013': '0a 14 00 12 20',
+                '0x0016': '08 17 00 13 20',
+                '0x0019': '0a 1a 00 14 20',
+                '0x001c': '32 1d 00 16 20',
+                '0x001d': '2a 00',
+                '0x0021': '02 22 00 29 2a',
+                '0x0022': '52 65 6c 61 79 72',
+                '0x0023': '02 24 00 27 2a',
+                '0x0024': '31 2e 30 2e 32',
+                '0x0025': '02 26 00 26 2a',
+                '0x0026': '31 2e 30 2e 30',
+                '0x0028': '12 29 00 19 2a',
+                '0x0029': '64',
+            },
+            'notifications': {
+                '0x001d': ['2a 00', '2b 00', '2d 00', '29 00'],
+            },
+        },
+    },
+}
+
+
+def install(bindir, transcript=None, latency=None, adapters=None):
+    """
+    Install wrapper scripts for the simulated tools into a folder.
+
+    :param bindir: the folder, created if needed
+    :type bindir: string
+    :param transcript: a transcript dict or the path of a JSON file
+        containing one, defaults to ``DEFAULT_TRANSCRIPT``
+    :type transcript: dict or string
+    :param latency: latencies in seconds overwriting the ones of the
+        transcript, e.g. ``{'connect': 0}``
+    :type latency: dict
+    :param adapters: HCI device names of the simulated adapters
+        overwriting the ones of the transcript, e.g. ``['hci0', 'hci1']``
+    :type adapters: list
+    :rtype: the folder path
+    """
+    if transcript is None:
+        transcript = DEFAULT_TRANSCRIPT
+    elif not isinstance(transcript, dict):
+        with open(transcript) as f:
+            transcript = json.load(f)
+    transcript = dict(transcript)
+    transcript['latency'] = dict(DEFAULT_LATENCY,
+        **dict(transcript.get('latency', {}), **(latency or {})))
+    if adapters:
+        transcript['adapters'] = list(adapters)
+
+    if not os.path.exists(bindir):
+        os.makedirs(bindir)
+    path = os.path.join(bindir, 'transcript.json')
+    with open(path, 'w') as f:
+        json.dump(transcript, f, indent=1)
+
+    script = os.path.abspath(__file__)
+    if script.endswith(('.pyc', '.pyo')):
+        script = script[:-1]
+    for tool in ('hciconfig', 'hcitool', 'gatttool'):
+        wrapper = os.path.join(bindir, tool)
+        with open(wrapper, 'w') as f:
+            f.write('#!/bin/sh\n')
+            f.write('exec "%s" "%s" "%s" "%s" "$@"\n' %
+                (sys.executable, script, path, tool))
+        os.chmod(wrapper, os.stat(wrapper).st_mode | stat.S_IEXEC)
+    return bindir
+
+
+class Simulator(object):
+    "Simulated BlueZ tools replaying a transcript."
+
+    def __init__(self, transcript, out=sys.stdout, folder=None):
+        self.devices = transcript['devices']
+        self.adapters = transcript.get('adapters', ['hci0'])
+        self.lock_path = None
+        self.latency = dict(DEFAULT_LATENCY, **transcript.get('latency', {}))
+        self.out = out
+        self.folder = folder
+        self._lock = threading.Lock()
+
+    def write(self, text):
+        with self._lock:
+            self.out.write(text)
+            self.out.flush()
+
+    def wait(self, kind):
+        if kind == 'command' and self.lock_path:
+            # an adapter handles one GATT request at a time
+            with open(self.lock_path, 'w') as f:
+                fcntl.flock(f, fcntl.LOCK_EX)
+                time.sleep(self.latency[kind])
+        else:
+            time.sleep(self.latency[kind])
+
+    # hciconfig and hcitool
+
+    def hciconfig(self, args):
+        if not args:
+            for i, name in enumerate(self.adapters):
+                self.write('%s:\tType: Primary  Bus: USB\n' % name)
+                self.write('\tBD Address: 00:1A:7D:DA:71:%02X  ACL MTU: 310:10  '
+                    'SCO MTU: 64:8\n\tUP RUNNING\n\n' % i)
+        return 0
+
+    def hcitool(self, args):
+        if 'lescan' not in args:
+            sys.stderr.write('Only lescan is simulated.\n')
+            return 1
+        signal.signal(signal.SIGINT, lambda signum, frame: sys.exit(0))
+        self.write('LE Scan ...\n')
+        for addr, dev in sorted(self.devices.items()):
+            self.wait('scan')
+            self.write('%s %s\n' % (addr, dev['name']))
+        while True:
+            time.sleep(1)
+
+    # gatttool
+
+    def gatttool(self, args):
+        addr = args[args.index('-b') + 1]
+        if '-i' in args and args[args.index('-i') + 1] not in self.adapters:
+            sys.stderr.write('Device not found\n')
+            return 1
+        adapter = args[args.index('-i') + 1] if '-i' in args else self.adapters[0]
+        if self.folder:
+            self.lock_path = os.path.join(self.folder, adapter + '.lock')
+        if '-I' in args or '--interactive' in args:
+            return self.interactive(addr)
+        self.wait('connect')
+        dev = self.devices.get(addr)
+        if dev is None:
+            sys.stderr.write('connect error: Connection refused (111)\n')
+            return 1
+        options = dict(re.findall(r'--([\w-]+)(?:=(\S+))?', ' '.join(args)))
+        if 'handle' in options and not options['handle']:
+            options['handle'] = args[args.index('--handle') + 1]
+        self.wait('command')
+        if 'primary' in options:
+            self.write(self.primary(dev, '='))
+        elif 'characteristics' in options:
+            self.write(self.characteristics(dev, '=', options.get('uuid')))
+        elif 'char-desc' in options:
+            self.write(self.char_desc(dev, '='))
+        elif 'char-read' in options:
+            self.write(self.char_read(dev, options['handle']))
+        elif 'char-write-req' in options:
+            self.write(self.char_write(dev, options['handle'], options['value']))
+        return 0
+
+    def interactive(self, addr):
+        prompt = '[%s][LE]> ' % addr
+        dev = None
+        while True:
+            self.write(prompt)
+            line = sys.stdin.readline()
+            if not line:
+                return 0
+            cmd = line.split()
+            if not cmd:
+                continue
+            name, args = cmd[0], cmd[1:]
+            if name in ('exit', 'quit'):
+                return 0
+            elif name == 'connect':
+                self.write('Attempting to connect to %s\n' % addr)
+                self.wait('connect')
+                dev = self.devices.get(addr)
+                if dev is None:
+                    self.write('Error: connect error: Connection refused (111)\n')
+                else:
+                    self.write('Connection successful\n')
+            elif name == 'disconnect':
+                dev = None
+            elif dev is None:
+                self.write('Error: Disconnected\n')
+            else:
+                self.wait('command')
+                if name == 'primary':
+                    self.write(self.primary(dev, ':'))
+                elif name == 'characteristics':
+                    uuid = args[2] if len(args) > 2 else None
+                    self.write(self.characteristics(dev, ':', uuid))
+                elif name == 'char-desc':
+                    self.write(self.char_desc(dev, ':'))
+                elif name == 'char-read-hnd':
+                    self.write(self.char_read(dev, args[0]))
+                elif name == 'char-write-req':
+                    self.write(self.char_write(dev, args[0], args[1]))
+                else:
+                    self.write('Error: Unknown command\n')
+
+    # GATT tables
+
+    def primary(self, dev, sep):
+        lines = ['attr handle %s %s, end grp handle %s %s uuid: %s\n' %
+            (sep, start, sep, end, uuid) for start, end, uuid in dev['services']]
+        return ''.join(lines)
+
+    def characteristics(self, dev, sep, uuid=None):
+        lines = []
+        for name_handle, props, value_handle, char_uuid in dev['characteristics']:
+            if uuid and not char_uuid.startswith(uuid.zfill(8)) and char_uuid != uuid:
+                continue
+            args = (sep, name_handle, sep, props, sep, value_handle, sep, char_uuid)
+            lines.append('handle %s %s, char properties %s %s, '
+                'char value handle %s %s, uuid %s %s\n' % args)
+        return ''.join(lines)
+
+    def char_desc(self, dev, sep):
+        descs = [(int(start, 16), UUID_FMT % '2800')
+            for start, end, uuid in dev['services']]
+        for name_handle, props, value_handle, uuid in dev['characteristics']:
+            descs.append((int(name_handle, 16), UUID_FMT % '2803'))
+            descs.append((int(value_handle, 16), uuid))
+            if int(props, 16) & 0x30:
+                descs.append((int(value_handle, 16) + 1, UUID_FMT % '2902'))
+        lines = ['handle %s 0x%04x, uuid %s %s\n' % (sep, handle, sep, uuid)
+            for handle, uuid in sorted(descs)]
+        return ''.join(lines)
+
+    def char_read(self, dev, handle):
+        value = dev['values'].get('0x%04x' % int(handle, 0))
+        if value is None:
+            return 'Error: Characteristic value/descriptor read failed: Invalid handle\n'
+        return 'Characteristic value/descriptor: %s \n' % value
+
+    def char_write(self, dev, handle, value):
+        handle = int(handle, 0)
+        for name_handle, props, value_handle, uuid in dev['characteristics']:
+            if int(value_handle, 16) + 1 == handle and int(props, 16) & 0x30:
+                # client characteristic configuration descriptor
+                if value in ('0100', '0200'):
+                    kind = 'Notification' if value == '0100' else 'Indication'
+                    t = threading.Thread(target=self.notify,
+                        args=(dev, value_handle, kind))
+                    t.daemon = True
+                    t.start()
+                break
+            if int(value_handle, 16) == handle:
+                dev['values'][value_handle] = ' '.join(re.findall('..', value))
+                break
+        else:
+            return 'Error: Characteristic Write Request failed: Invalid handle\n'
+        return 'Characteristic value was written successfully\n'
+
+    def notify(self, dev, value_handle, kind):
+        for value in dev.get('notifications', {}).get(value_handle, []):
+            self.wait('notify')
+            self.write('%s handle = %s value: %s \n' % (kind, value_handle, value))
+
+
+def main(argv):
+    "Run a simulated tool, called by wrappers with transcript path and tool name."
+
+    path, tool, args = argv[1], argv[2], argv[3:]
+    with open(path) as f:
+        transcript = json.load(f)
+    sim = Simulator(transcript, folder=os.path.dirname(path))
+    return getattr(sim, tool)(args)
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv))
@@ -0,0 +1,842 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the request layer of the API against a local stub server.
+
+These tests need no credentials and no network access.
+"""
+
+import json
+import zlib
+import time
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+
+import pytest
+
+
+def gzip_compress(data):
+    c = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return c.compress(data) + c.flush()
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    """
+    A handler serving JSON resources from the server's ``resources`` dict.
+
+    Responses carry an ETag and honour ``If-None-Match``, writes replace
+    or delete resources. All requests are recorded in ``requests``.
+    """
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=None, headers=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        if data and self.server.gzip and \
+                'gzip' in self.headers.get('Accept-Encoding', ''):
+            data = gzip_compress(data)
+            headers = dict(headers or {}, **{'Content-Encoding': 'gzip'})
+        self.send_response(status)
+        for k, v in (headers or {}).items():
+            self.send_header(k, v)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _record(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        if self.headers.get('Content-Encoding') == 'gzip':
+            body = zlib.decompress(body, 16 + zlib.MAX_WBITS)
+        self.server.requests.append((self.command, self.path, body))
+        return body
+
+    def do_GET(self):
+        self._record()
+        time.sleep(self.server.delay)
+        if self.server.throttle > 0:
+            self.server.throttle -= 1
+            return self._send(429, {'message': 'too many requests'},
+                {'Retry-After': '0'})
+        if self.server.fail > 0 or self.path in self.server.broken:
+            self.server.fail = max(0, self.server.fail - 1)
+            return self._send(self.server.fail_status, {'message': 'internal error'})
+        res = self.server.resources.get(self.path)
+        if res is None:
+            return self._send(404, {'message': 'not found'})
+        etag = '"%d"' % (hash(json.dumps(res, sort_keys=True)) & 0xffffffff)
+        headers = dict(self.server.extra_headers, ETag=etag)
+        if self.headers.get('If-None-Match') == etag:
+            return self._send(304, headers=headers)
+        self._send(200, res, headers)
+
+    def do_PATCH(self):
+        body = self._record()
+        if self.server.unavailable > 0:
+            self.server.unavailable -= 1
+            return self._send(503, {'message': 'unavailable'})
+        if self.server.fail > 0:
+            self.server.fail -= 1
+            return self._send(500, {'message': 'internal error'})
+        self.server.resources[self.path] = json.loads(body.decode('utf-8') or '{}')
+        self._send(200, self.server.resources[self.path])
+
+    do_POST = do_PATCH
+
+    def do_DELETE(self):
+        self._record()
+        self.server.resources.pop(self.path, None)
+        self._send(200)
+
+
+class StubServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    request_queue_size = 64
+
+
+@pytest.fixture
+def stub(monkeypatch):
+    "Run a stub API server in a thread and point the configuration to it."
+    from relayr import config
+    server = StubServer(('localhost', 0), StubHandler)
+    server.requests = []
+    server.extra_headers = {}
+    server.delay = 0
+    server.throttle = 0
+    server.fail = 0
+    server.fail_status = 500
+    server.broken = set()
+    server.gzip = False
+    server.unavailable = 0
+    server.resources = {'/server-status': {'database': 'ok'}}
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    monkeypatch.setattr(config, 'relayrAPI', 'http://localhost:%d' % server.server_port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestResponseCache(object):
+    "Test caching results of GET requests."
+
+    def test_lru(self):
+        "Test evicting least recently used entries."
+        from relayr.httpcache import MemoryStore
+        store = MemoryStore(maxsize=2)
+        store.set('a', 1)
+        store.set('b', 2)
+        assert store.get('a') == 1
+        store.set('c', 3)
+        assert store.get('b') is None
+        assert sorted(store.keys()) == ['a', 'c']
+        store.delete('a')
+        assert len(store) == 1
+
+    def test_revalidation(self, stub):
+        "Test conditional requests for cached results."
+        from relayr.api import Api
+        from relayr.httpcache import ResponseCache
+        stub.resources['/device-models'] = [{'id': 'm1'}]
+        api = Api(cache=ResponseCache())
+        assert api.get_public_device_models() == [{'id': 'm1'}]
+        assert api.get_public_device_models() == [{'id': 'm1'}]
+        gets = [r for r in stub.requests if r[1] == '/device-models']
+        assert len(gets) == 2
+        assert api.cache.revalidations == 1
+
+    def test_ttl(self, stub):
+        "Test fresh results from Cache-Control and per endpoint TTLs."
+        from relayr.api import Api
+        from relayr.httpcache import ResponseCache
+        stub.resources['/device-models'] = [{'id': 'm1'}]
+        stub.resources['/publishers'] = [{'id': 'p1'}]
+        stub.extra_headers['Cache-Control'] = 'no-store'
+        api = Api(cache=ResponseCache(ttls={'^/device-models$': 60}))
+        for i in range(3):
+            api.get_public_device_models()
+            api.get_public_publishers()
+        paths = [r[1] for r in stub.requests]
+        assert paths.count('/device-models') == 1
+        assert paths.count('/publishers') == 3
+        stub.extra_headers['Cache-Control'] = 'max-age=60'
+        for i in range(3):
+            api.get_public_publishers()
+        paths = [r[1] for r in stub.requests]
+        assert paths.count('/publishers') == 4
+
+    def test_invalidation(self, stub, tmpdir):
+        "Test invalidating cached results on writes to the same resource."
+        from relayr.api import Api
+        from relayr.httpcache import ResponseCache, DiskStore
+        stub.resources['/devices/d1'] = {'id': 'd1', 'name': 'old'}
+        cache = ResponseCache(disk=DiskStore(str(tmpdir)), default_ttl=60)
+        api = Api(cache=cache)
+        assert api.get_device('d1')['name'] == 'old'
+        api.patch_device('d1', name='new')
+        assert api.get_device('d1')['name'] == 'new'
+        # the disk store is shared with other instances
+        api2 = Api(cache=ResponseCache(disk=DiskStore(str(tmpdir))))
+        n = len(stub.requests)
+        assert api2.get_device('d1')['name'] == 'new'
+        assert len(stub.requests) == n
+
+        # invalidated again once the write is done
+        invalidated = []
+        invalidate = cache.invalidate
+        cache.invalidate = lambda url: invalidated.append(url) or invalidate(url)
+        api.patch_device('d1', name='newer')
+        assert len(invalidated) == 2
+
+    def test_index(self, tmpdir):
+        "Test invalidating by path without reading all entries."
+        from relayr.httpcache import ResponseCache, DiskStore
+        disk = DiskStore(str(tmpdir))
+        cache = ResponseCache(disk=disk, default_ttl=60)
+        for path in ['/devices', '/devices/d1', '/devices/d1/readings',
+                '/devices/d2', '/apps']:
+            cache.store('https://api.relayr.io' + path, {}, {}, path)
+        cache = ResponseCache(disk=disk)
+        cache.invalidate('https://api.relayr.io/apps/a1')
+        disk.keys = disk.get = None
+        cache.invalidate('https://api.relayr.io/devices/d1')
+        paths = sorted(k.split(' ', 1)[1] for k in DiskStore(str(tmpdir)).keys())
+        assert paths == ['https://api.relayr.io/devices/d2']
+        cache.clear()
+        assert DiskStore(str(tmpdir)).keys() == []
+
+    def test_shared_disk(self, tmpdir):
+        "Test caches sharing a disk store see each other's writes and invalidations."
+        from relayr.httpcache import ResponseCache, DiskStore
+        url = 'https://api.relayr.io/devices/d1'
+        a = ResponseCache(disk=DiskStore(str(tmpdir)), default_ttl=60)
+        b = ResponseCache(disk=DiskStore(str(tmpdir)), default_ttl=60)
+        a.store(url, {}, {}, 'old')
+        assert b.lookup(url)[1]['data'] == 'old'
+        b.invalidate(url)
+        assert a.lookup(url)[1] is None
+        assert b.lookup(url)[1] is None
+        b.store(url, {}, {}, 'new')
+        assert a.lookup(url)[1]['data'] == 'new'
+        a.store(url + '/readings', {}, {}, 'readings')
+        b.invalidate(url)
+        assert a.lookup(url + '/readings')[1] is None
+
+
+class TestSingleFlight(object):
+    "Test sharing identical concurrent GET requests."
+
+    def test_single_flight(self):
+        "Test sharing results and exceptions of calls in flight."
+        from relayr.api import SingleFlight
+        flights = SingleFlight()
+        calls = []
+        results = []
+        def slow(value):
+            calls.append(value)
+            time.sleep(0.2)
+            if value is None:
+                raise ValueError('no value')
+            return value
+        def run(key, value):
+            try:
+                results.append(flights.do(key, lambda: slow(value)))
+            except ValueError as e:
+                results.append(e)
+        threads = [threading.Thread(target=run, args=(k, v))
+            for k, v in [('a', 1), ('a', 2), ('b', None), ('b', 3)]]
+        for t in threads:
+            t.start()
+            time.sleep(0.01)
+        for t in threads:
+            t.join()
+        assert calls == [1, None]
+        assert results[:2] == [1, 1]
+        assert all(isinstance(r, ValueError) for r in results[2:])
+        assert results[2] is results[3]
+        assert flights.shared == 2
+        assert flights.do('a', lambda: 4) == 4
+
+    def test_coalesce(self, stub):
+        "Test identical concurrent GETs causing a single request."
+        from relayr.api import Api
+        stub.resources['/device-models/m1'] = {'id': 'm1'}
+        api = Api()
+        stub.delay = 0.2
+        results = []
+        def get():
+            results.append(api.get_device_model('m1'))
+        threads = [threading.Thread(target=get) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert results == [{'id': 'm1'}] * 10
+        assert [r[1] for r in stub.requests].count('/device-models/m1') == 1
+        api.coalesce = False
+        threads = [threading.Thread(target=get) for i in range(3)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        assert [r[1] for r in stub.requests].count('/device-models/m1') == 4
+
+
+class TestRateLimiter(object):
+    "Test limiting rate and concurrency of requests."
+
+    def test_token_bucket(self):
+        "Test limiting the rate of events."
+        from relayr.ratelimit import TokenBucket
+        bucket = TokenBucket(rate=50, burst=5)
+        t0 = time.time()
+        for i in range(15):
+            bucket.acquire()
+        assert 0.15 < time.time() - t0 < 0.5
+        bucket.pause(0.1)
+        t0 = time.time()
+        bucket.acquire()
+        assert time.time() - t0 >= 0.1
+
+    def test_aimd(self):
+        "Test adapting the concurrency limit."
+        from relayr.ratelimit import AdaptiveConcurrency
+        limit = AdaptiveConcurrency(initial=4, maximum=8)
+        for i in range(4):
+            limit.acquire()
+        assert limit.in_flight == 4
+        for i in range(4):
+            limit.release()
+        assert 4.9 < limit.limit < 5
+        limit.acquire()
+        limit.release(throttled=True)
+        assert 2.4 < limit.limit < 2.5
+
+    def test_retry_after(self):
+        "Test parsing Retry-After headers."
+        from email.utils import formatdate
+        from relayr.ratelimit import parse_retry_after
+        assert parse_retry_after('120') == 120
+        assert 9 < parse_retry_after(formatdate(time.time() + 10, usegmt=True)) <= 10
+        assert parse_retry_after(None) is None
+        assert parse_retry_after('soon') is None
+
+    def test_groups(self):
+        "Test grouping requests by endpoint."
+        from relayr.ratelimit import RateLimiter
+        limiter = RateLimiter(groups={'^/devices/[^/]+/data$': 'data'})
+        assert limiter.group('https://api.relayr.io/devices/d1') == 'devices'
+        assert limiter.group('https://api.relayr.io/devices/d1/data') == 'data'
+        assert limiter.group('https://api.relayr.io/apps?x=1') == 'apps'
+
+    def test_throttling(self, stub):
+        "Test sending throttled requests again."
+        from relayr.api import Api
+        from relayr.ratelimit import RateLimiter
+        from relayr.exceptions import RelayrApiException
+        stub.resources['/device-models'] = []
+        api = Api(limiter=RateLimiter(rate=100, max_retries=2))
+        stub.throttle = 2
+        assert api.get_public_device_models() == []
+        assert api.limiter.throttled == 2
+        assert api.limiter.stats()['device-models']['concurrency'] < 4
+        stub.throttle = 3
+        with pytest.raises(RelayrApiException):
+            api.get_public_device_models()
+
+    def test_no_resend_of_writes(self, stub):
+        "Test not sending writes again after a 503 response."
+        from relayr.api import Api
+        from relayr.ratelimit import RateLimiter
+        from relayr.exceptions import RelayrApiException
+        api = Api(limiter=RateLimiter(rate=100))
+        stub.unavailable = 1
+        with pytest.raises(RelayrApiException):
+            api.post_device_data('d1', {'readings': []})
+        posts = [r for r in stub.requests if r[0] == 'POST']
+        assert len(posts) == 1
+        assert api.limiter.throttled == 1
+
+    def test_streamed_slot(self, stub):
+        "Test streamed requests keeping their slot until read."
+        from relayr.api import Api
+        from relayr.ratelimit import RateLimiter
+        stub.resources['/devices/public'] = [{'id': 'd1'}, {'id': 'd2'}]
+        api = Api(limiter=RateLimiter(rate=100))
+        devices = api.get_public_devices(stream=True)
+        assert next(devices) == {'id': 'd1'}
+        assert api.limiter.stats()['devices']['in_flight'] == 1
+        assert list(devices) == [{'id': 'd2'}]
+        assert api.limiter.stats()['devices']['in_flight'] == 0
+
+
+class TestRetry(object):
+    "Test retrying failed requests and circuit breaking."
+
+    def test_retry_idempotent(self, stub):
+        "Test retrying failed GET requests but not POST requests."
+        from relayr.api import Api
+        from relayr.retry import RetryPolicy
+        from relayr.exceptions import RelayrApiException
+        stub.resources['/device-models'] = []
+        api = Api(retry=RetryPolicy(retries=3, backoff=0.01))
+        stub.fail = 2
+        assert api.get_public_device_models() == []
+        stub.fail = 1
+        n = len(stub.requests)
+        with pytest.raises(RelayrApiException):
+            api.post_device_data('d1', {'readings': []})
+        assert len(stub.requests) == n + 1
+
+    def test_timeout_deadline(self, stub):
+        "Test read timeouts and the total deadline of retries."
+        import requests
+        from relayr.api import Api
+        from relayr.retry import RetryPolicy
+        stub.resources['/device-models'] = []
+        api = Api(timeout=(1, 0.1),
+            retry=RetryPolicy(retries=100, backoff=0.01, deadline=0.5))
+        stub.delay = 0.3
+        t0 = time.time()
+        with pytest.raises(requests.Timeout):
+            api.get_public_device_models()
+        assert time.time() - t0 < 1.5
+
+    def test_circuit_breaker(self):
+        "Test opening, half-opening and closing circuits."
+        from relayr.retry import CircuitBreaker
+        from relayr.exceptions import CircuitOpenException
+        breaker = CircuitBreaker(threshold=2, reset_timeout=0.1)
+        breaker.failure('a')
+        breaker.check('a')
+        breaker.failure('a')
+        with pytest.raises(CircuitOpenException):
+            breaker.check('a')
+        assert not breaker.is_open('b')
+        time.sleep(0.1)
+        breaker.check('a')
+        assert breaker.is_open('a')
+        breaker.failure('a')
+        assert breaker.is_open('a')
+        time.sleep(0.1)
+        breaker.check('a')
+        breaker.success('a')
+        assert not breaker.is_open('a')
+
+    def test_lost_trial(self):
+        "Test letting another trial through if one ends without result."
+        from relayr.retry import CircuitBreaker
+        breaker = CircuitBreaker(threshold=1, reset_timeout=0.1)
+        breaker.failure('a')
+        time.sleep(0.1)
+        breaker.check('a')
+        assert breaker.is_open('a')
+        time.sleep(0.1)
+        # the trial was never reported and has expired
+        breaker.check('a')
+        breaker.cancel('a')
+        breaker.check('a')
+        assert breaker.is_open('a')
+
+    def test_api_trial_error(self, stub):
+        "Test cancelling a trial request failing with another error."
+        from relayr.api import Api
+        from relayr.retry import RetryPolicy, CircuitBreaker
+        stub.resources['/device-models'] = []
+        api = Api(retry=RetryPolicy(retries=0),
+            breaker=CircuitBreaker(threshold=1, reset_timeout=60))
+        host = 'localhost:%d' % stub.server_port
+        api.breaker.failure(host)
+        api.breaker.opened[host] -= 60
+        def broken(*args, **kwargs):
+            raise KeyError('bug')
+        send, api._send = api._send, broken
+        with pytest.raises(KeyError):
+            api.get_public_device_models()
+        api._send = send
+        assert api.get_public_device_models() == []
+        assert not api.breaker.is_open(host)
+
+    def test_api_breaker(self, stub):
+        "Test refusing requests to a failing host."
+        from relayr.api import Api
+        from relayr.retry import RetryPolicy, CircuitBreaker
+        from relayr.exceptions import RelayrApiException, CircuitOpenException
+        stub.resources['/device-models'] = []
+        api = Api(retry=RetryPolicy(retries=0),
+            breaker=CircuitBreaker(threshold=2, reset_timeout=60))
+        stub.fail = 2
+        stub.fail_status = 502
+        for i in range(2):
+            with pytest.raises(RelayrApiException):
+                api.get_public_device_models()
+        n = len(stub.requests)
+        with pytest.raises(CircuitOpenException):
+            api.get_public_device_models()
+        assert len(stub.requests) == n
+
+    def test_broken_endpoint(self, stub):
+        "Test an endpoint failing with 500 does not open the host's circuit."
+        from relayr.api import Api
+        from relayr.retry import RetryPolicy
+        from relayr.exceptions import RelayrApiException
+        stub.broken.add('/device-models')
+        api = Api(retry=RetryPolicy(backoff=0.001))
+        for i in range(3):
+            with pytest.raises(RelayrApiException):
+                api.get_public_device_models()
+        assert len([r for r in stub.requests if r[1] == '/device-models']) == 12
+        assert api.get_server_status() == {'database': 'ok'}
+        assert not api.breaker.failures
+        # a request failing at the gateway counts once, however often retried
+        stub.fail, stub.fail_status = 4, 502
+        with pytest.raises(RelayrApiException):
+            api.get_server_status()
+        assert list(api.breaker.failures.values()) == [1]
+
+
+class TestRequestPath(object):
+    "Test serialization and logging on the request path."
+
+    def test_bodyless(self, stub):
+        "Test sending requests without data without a body."
+        from relayr.api import Api
+        stub.resources['/devices/d1/subscription'] = {}
+        api = Api()
+        api.post_devices_public_subscription('d1')
+        api.post_device_data('d1', {'readings': [{'meaning': 'x', 'value': 1}]})
+        bodies = [r[2] for r in stub.requests if r[0] == 'POST']
+        assert bodies[0] == b''
+        assert json.loads(bodies[1].decode('utf-8'))['readings'][0]['value'] == 1
+
+    def test_json_codec(self, stub):
+        "Test using a custom JSON codec."
+        from relayr.api import Api
+        calls = []
+        class Codec(object):
+            def dumps(self, data):
+                calls.append('dumps')
+                return json.dumps(data).encode('utf-8')
+            def loads(self, text):
+                calls.append('loads')
+                return json.loads(text)
+        stub.resources['/device-models'] = [{'id': 'm1'}]
+        api = Api(json_codec=Codec())
+        assert api.get_public_device_models() == [{'id': 'm1'}]
+        api.post_device_data('d1', {'readings': []})
+        assert calls == ['loads', 'loads', 'dumps', 'loads']
+
+    def test_lazy_logging(self, stub, tmpdir, monkeypatch):
+        "Test debug messages being formatted only at the debug level."
+        import logging
+        from relayr import api as api_module, config, log
+        from relayr.api import Api
+        monkeypatch.setattr(config, 'LOG', True)
+        monkeypatch.setattr(config, 'LOG_DIR', str(tmpdir))
+        calls = []
+        def curl(*args):
+            calls.append(args)
+            return 'curl'
+        monkeypatch.setattr(api_module, 'build_curl_call', curl)
+        log.configure(log_dir=str(tmpdir))
+        try:
+            api = Api()
+            api.get_server_status()
+            assert calls == []
+            api.logger.setLevel(logging.DEBUG)
+            api.get_server_status()
+            assert len(calls) == 1
+        finally:
+            log.shutdown()
+            logging.getLogger(log.LOGGER_NAME).setLevel(logging.INFO)
+
+
+class TestLogging(object):
+    "Test the shared asynchronous logger."
+
+    def test_shared_handler(self, stub, tmpdir, monkeypatch):
+        "Test many API objects sharing one handler and writing JSON records."
+        import logging
+        from relayr import config, log
+        from relayr.api import Api
+        monkeypatch.setattr(config, 'LOG', True)
+        log.configure(log_dir=str(tmpdir))
+        try:
+            apis = [Api() for i in range(20)]
+            logger = logging.getLogger(log.LOGGER_NAME)
+            assert len(logger.handlers) == 1
+            logger.handlers[0].flush()
+            files = tmpdir.listdir()
+            assert len(files) == 1
+            records = [json.loads(line) for line in files[0].readlines()]
+            calls = [r for r in records if r['message'].startswith('API call')]
+            assert len(calls) == 20
+            assert calls[0]['status'] == 200 and calls[0]['method'] == 'GET'
+            assert calls[0]['url'].endswith('/server-status')
+        finally:
+            log.shutdown()
+
+    def test_sampling(self):
+        "Test passing only every n-th record marked for sampling."
+        import logging
+        from relayr.log import SamplingFilter
+        f = SamplingFilter(every=10)
+        def record(level, **extra):
+            r = logging.LogRecord('x', level, '', 0, 'msg', (), None)
+            r.__dict__.update(extra)
+            return r
+        passed = [f.filter(record(logging.INFO, sample=True)) for i in range(100)]
+        assert passed.count(True) == 10
+        assert f.filter(record(logging.INFO))
+        assert f.filter(record(logging.WARNING, sample=True))
+
+    def test_non_blocking(self):
+        "Test dropping records instead of blocking when the queue is full."
+        import logging
+        from relayr.log import AsyncHandler
+        release = threading.Event()
+        written = []
+        class SlowHandler(logging.Handler):
+            def emit(self, record):
+                release.wait()
+                written.append(record.getMessage())
+        h = AsyncHandler([SlowHandler()], maxsize=5)
+        logger = logging.getLogger('relayr-test-async')
+        logger.propagate = False
+        logger.addHandler(h)
+        t0 = time.time()
+        for i in range(100):
+            logger.warning('record %d', i)
+        assert time.time() - t0 < 1
+        assert h.dropped >= 90
+        release.set()
+        logger.removeHandler(h)
+        h.close()
+        assert written[0] == 'record 0'
+        assert len(written) + h.dropped == 100
+
+
+class TestJsonStream(object):
+    "Test parsing JSON arrays incrementally."
+
+    def test_chunks(self):
+        "Test arrays split into chunks at every possible position."
+        from relayr.jsonstream import iter_json_array
+        items = [{'id': u'd\xfcsseldorf', 'n': [1, 2.5e3]}, 12345, u'x,]',
+            None, True, [], {}, [u'a\\"]', {u'}': u'\\'}], -0.5]
+        doc = (' ' + json.dumps(items, ensure_ascii=False) + '\n').encode('utf-8')
+        for i in range(len(doc)):
+            assert list(iter_json_array([doc[:i], doc[i:]])) == items
+        singles = [doc[i:i+1] for i in range(len(doc))]
+        assert list(iter_json_array(singles)) == items
+        assert list(iter_json_array([b' [ ] '])) == []
+
+    def test_large_element(self):
+        "Test an element spanning many chunks."
+        from relayr.jsonstream import iter_json_array
+        item = {'readings': [{'meaning': 'x"%d' % i, 'value': i}
+            for i in range(20000)]}
+        doc = json.dumps([item, 1]).encode('utf-8')
+        chunks = [doc[i:i+100] for i in range(0, len(doc), 100)]
+        start = time.time()
+        assert list(iter_json_array(chunks)) == [item, 1]
+        assert time.time() - start < 5
+
+    def test_invalid(self):
+        "Test rejecting documents that are no valid JSON array."
+        from relayr.jsonstream import iter_json_array
+        for doc in [b'', b'{"a": 1}', b'[1, 2', b'[1 2]', b'[1,]', b'[1] 2',
+                b'[{"a": }]', b'[{"a": [1}]', b'["a\\"]']:
+            with pytest.raises(ValueError):
+                list(iter_json_array([doc]))
+        items = iter_json_array([b'[1, 2, x'])
+        assert next(items) == 1
+
+    def test_stream_request(self, stub):
+        "Test list endpoints yielding elements from a streamed response."
+        from relayr.api import Api
+        from relayr.exceptions import RelayrApiException
+        devices = [{'id': 'd%d' % i, 'name': 'dev %d' % i} for i in range(1000)]
+        stub.resources['/devices/public'] = devices
+        api = Api()
+        result = api.get_public_devices(stream=True)
+        assert not isinstance(result, list)
+        assert list(result) == devices
+        assert api.get_public_devices() == devices
+        with pytest.raises(RelayrApiException):
+            list(api.get_public_apps(stream=True))
+
+
+class TestCompression(object):
+    "Test compressed responses and request bodies."
+
+    def test_compression(self, stub):
+        "Test compressing large request bodies and counting bytes."
+        from relayr.api import Api
+        from relayr.compression import Compression
+        compression = Compression(threshold=1024)
+        api = Api(compression=compression)
+        readings = {'readings': [{'meaning': 'temperature', 'value': 21.5,
+            'recorded': 1400000000 + i} for i in range(200)]}
+        assert api.post_device_data('d1', readings) == readings
+        assert api.post_device_data('d2', {'readings': []}) == {'readings': []}
+        stats = compression.stats()
+        assert stats['sent']['ratio'] > 5
+        assert stub.resources['/devices/d1/data'] == readings
+        stub.gzip = True
+        devices = [{'id': 'd%d' % i, 'model': {'readings': [{'meaning':
+            'temperature', 'unit': 'celsius'}]}} for i in range(500)]
+        stub.resources['/devices/public'] = devices
+        assert api.get_public_devices() == devices
+        assert list(api.get_public_devices(stream=True)) == devices
+        received = compression.stats()['received']
+        assert received['ratio'] > 3
+        assert received['raw'] > 2 * len(json.dumps(devices))
+
+    def test_threshold(self):
+        "Test leaving small or incompressible bodies uncompressed."
+        import os
+        from relayr.compression import Compression
+        c = Compression(threshold=100)
+        assert c.encode(b'x' * 100) == (b'x' * 100, None)
+        body, encoding = c.encode(b'x' * 101)
+        assert encoding == 'gzip'
+        assert zlib.decompress(body, 16 + zlib.MAX_WBITS) == b'x' * 101
+        noise = os.urandom(1000)
+        assert c.encode(noise) == (noise, None)
+        assert Compression().encode(b'x' * 10000)[1] is None
+
+
+class TestGetDevices(object):
+    "Test fetching many devices at once."
+
+    def test_get_devices(self, stub):
+        "Test deduplicated, concurrent fetching with per ID failures."
+        from relayr import Client
+        from relayr.exceptions import RelayrApiException
+        for i in range(20):
+            stub.resources['/devices/d%d' % i] = {'id': 'd%d' % i,
+                'name': 'dev %d' % i, 'model': {'id': 'm%d' % (i % 2)}}
+        stub.resources['/device-models/m0'] = {'id': 'm0', 'name': 'model 0'}
+        stub.resources['/device-models/m1'] = {'id': 'm1', 'name': 'model 1'}
+        stub.delay = 0.05
+        c = Client()
+        ids = ['d%d' % i for i in range(20)] + ['d3', 'd5', 'missing']
+        t0 = time.time()
+        devices, errors = c.get_devices(ids, concurrency=10)
+        assert time.time() - t0 < 20 * 0.05
+        assert sorted(devices) == sorted('d%d' % i for i in range(20))
+        assert devices['d3'].name == 'dev 3'
+        assert devices['d3'].model is devices['d5'].model
+        assert devices['d3'].model.name == 'model 1'
+        assert list(errors) == ['missing']
+        assert isinstance(errors['missing'], RelayrApiException)
+        paths = [r[1] for r in stub.requests]
+        assert paths.count('/devices/d3') == 1
+        assert paths.count('/device-models/m1') <= 2
+        assert c.api.session is not None
+
+
+class TestLazyResources(object):
+    "Test retrieving resource info on first access."
+
+    def test_lazy(self, stub):
+        "Test listing devices without retrieving their info."
+        from relayr import Client
+        from relayr.resources import Device
+        stub.resources['/devices/public'] = [{'id': 'd%d' % i,
+            'model': 'm1'} for i in range(10)]
+        for i in range(10):
+            stub.resources['/devices/d%d' % i] = {'id': 'd%d' % i,
+                'name': 'dev %d' % i, 'model': {'id': 'm1'}}
+        stub.resources['/device-models/m1'] = {'id': 'm1', 'name': 'model 1'}
+        c = Client()
+        n = len(stub.requests)
+        devices = list(c.get_public_devices())
+        assert [d.id for d in devices] == ['d%d' % i for i in range(10)]
+        assert devices[0].model.id == 'm1'
+        assert len(stub.requests) == n + 1
+        assert devices[0].name == 'dev 0'
+        assert devices[0].model.name == 'model 1'
+        assert len(stub.requests) == n + 3
+        with pytest.raises(AttributeError):
+            devices[0].unknown
+        assert not hasattr(Device('d1'), 'name')
+        assert len(stub.requests) == n + 3
+
+    def test_run_concurrently(self):
+        "Test calling a function for unique items, collecting exceptions."
+        from relayr.resources import run_concurrently
+        calls = []
+        def half(n):
+            calls.append(n)
+            if n % 2:
+                raise ValueError(n)
+            return n // 2
+        results, errors = run_concurrently(half, [4, 3, 4, 2, 3], concurrency=2)
+        assert results == {4: 2, 2: 1}
+        assert list(errors) == [3] and isinstance(errors[3], ValueError)
+        assert sorted(calls) == [2, 3, 4]
+
+    def test_batch_concurrency(self):
+        "Test capping the concurrent requests of a large prefetch group."
+        from relayr.resources import LazyInfo, batched
+        lock = threading.Lock()
+        counts = {'active': 0, 'max': 0}
+
+        class Res(LazyInfo):
+            def get_info(self):
+                with lock:
+                    counts['active'] += 1
+                    counts['max'] = max(counts['max'], counts['active'])
+                time.sleep(0.01)
+                with lock:
+                    counts['active'] -= 1
+                self._loaded = True
+
+        resources = list(batched((Res() for i in range(50)), 50, concurrency=3))
+        resources[0]._batch.load()
+        assert all(r._loaded for r in resources)
+        assert counts['max'] == 3
+
+    def test_cached_listing(self, stub):
+        "Test listing devices from the cache unless streaming is asked for."
+        from relayr import Client
+        from relayr.httpcache import ResponseCache
+        stub.resources['/devices/public'] = [{'id': 'd%d' % i}
+            for i in range(3)]
+        c = Client()
+        c.api.cache = ResponseCache(default_ttl=60)
+        n = len(stub.requests)
+        assert [d.id for d in c.get_public_devices()] == ['d0', 'd1', 'd2']
+        assert [d.id for d in c.get_public_devices()] == ['d0', 'd1', 'd2']
+        assert len(stub.requests) == n + 1
+        assert [d.id for d in c.get_public_devices(stream=True)] == ['d0', 'd1', 'd2']
+        assert len(stub.requests) == n + 2
+
+    def test_prefetch(self, stub):
+        "Test retrieving the info of a batch of devices together."
+        from relayr import Client
+        stub.resources['/devices/public'] = [{'id': 'd%d' % i}
+            for i in range(10)]
+        for i in range(10):
+            stub.resources['/devices/d%d' % i] = {'id': 'd%d' % i,
+                'name': 'dev %d' % i}
+        c = Client()
+        n = len(stub.requests)
+        names = []
+        for d in c.get_public_devices(prefetch=4):
+            names.append(d.name)
+            if d.id == 'd0':
+                paths = [r[1] for r in stub.requests[n:]]
+                assert sorted(paths[1:]) == ['/devices/d%d' % i for i in range(4)]
+        assert names == ['dev %d' % i for i in range(10)]
+        assert len(stub.requests) == n + 11
@@ -0,0 +1,74 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the asyncio based MQTT stream.
+
+These tests feed messages directly into the stream's buffer and need
+no network connection.
+"""
+
+import sys
+
+import pytest
+
+
+PY35 = sys.version_info[:2] >= (3, 5)
+
+
+class Message(object):
+    "A stand-in for a received paho MQTT message."
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode('utf-8')
+
+
+@pytest.mark.skipif(not PY35, reason="requires Python 3.5 or above")
+class TestAsyncMqttStream(object):
+    "Test buffering and retrieving messages of an asyncio MQTT stream."
+
+    def setup_method(self, method):
+        import asyncio
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+
+    def teardown_method(self, method):
+        import asyncio
+        asyncio.set_event_loop(None)
+        self.loop.close()
+
+    def test_iterate(self):
+        "Test iterating over buffered messages until the stream is stopped."
+        from relayr.asyncstream import AsyncMqttStream
+        stream = AsyncMqttStream([])
+        stream.on_message(None, None, Message('/v1/a', '{"x": 1}'))
+        stream.on_message(None, None, Message('/v1/b', '{"x": 2}'))
+        run = self.loop.run_until_complete
+        assert run(stream.__anext__()) == ('/v1/a', '{"x": 1}')
+        run(stream.stop())
+        assert run(stream.__anext__()) == ('/v1/b', '{"x": 2}')
+        with pytest.raises(StopAsyncIteration):
+            run(stream.__anext__())
+
+    def test_bounded_buffer(self):
+        "Test dropping the oldest messages when the buffer is full."
+        from relayr.asyncstream import AsyncMqttStream
+        stream = AsyncMqttStream([], maxsize=2)
+        for i in range(5):
+            stream.on_message(None, None, Message('/v1/a', str(i)))
+        assert stream.qsize() == 2
+        assert stream.dropped == 3
+        batch = self.loop.run_until_complete(stream.get_batch(10, timeout=0.01))
+        assert batch == [('/v1/a', '3'), ('/v1/a', '4')]
+
+    def test_get_batch(self):
+        "Test getting a batch filled while waiting for it."
+        from relayr.asyncstream import AsyncMqttStream
+        stream = AsyncMqttStream([])
+        for i in range(3):
+            self.loop.call_later(0.01 * i, stream.on_message,
+                None, None, Message('/v1/a', str(i)))
+        batch = self.loop.run_until_complete(stream.get_batch(2, timeout=5))
+        assert [payload for topic, payload in batch] == ['0', '1']
+        batch = self.loop.run_until_complete(stream.get_batch(2, timeout=0.1))
+        assert [payload for topic, payload in batch] == ['2']
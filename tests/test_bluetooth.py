@@ -36,3 +36,351 @@ class TestBle(object):
         assert len(d.characteristics()) > 0
         assert len(d.char_desc()) > 0
         assert len(d.char_read_hnd(0x0016)) > 0
+
+
+class TestGattCache(object):
+    "Test caching discovered GATT characteristics (no root permissions needed)."
+
+    chars = [
+        {'name_handle': '0x0002', 'properties': '0x02', 'value_handle': '0x0003',
+         'uuid': '00002a00-0000-1000-8000-00805f9b34fb', '_uuid': '2a00'},
+        {'name_handle': '0x0028', 'properties': '0x12', 'value_handle': '0x0029',
+         'uuid': '00002a19-0000-1000-8000-00805f9b34fb', '_uuid': '2a19'},
+    ]
+
+    def test_lookup(self):
+        "Test looking up characteristics by UUID and handle."
+        from relayr.ble import GattDevice
+        d = GattDevice('F4:D7:AB:6D:EB:D5', use_cache=False)
+        d._index_characteristics(self.chars)
+        assert d.characteristic(uuid='2a19') is self.chars[1]
+        assert d.characteristic(uuid=self.chars[0]['uuid']) is self.chars[0]
+        assert d.characteristic(handle='0x0029') is self.chars[1]
+        assert d.characteristic(handle=2) is self.chars[0]
+        assert d.characteristic(uuid='2a29') is None
+        assert d.characteristics(uuid='2a00') == [self.chars[0]]
+
+    def test_missing_name(self):
+        "Test reading the name of a device without name characteristic."
+        from relayr.ble import GattDevice
+        d = GattDevice('F4:D7:AB:6D:EB:D5', use_cache=False)
+        d._index_characteristics(self.chars[1:])
+        assert d.read_device_name() is None
+
+    def test_failed_read(self):
+        "Test reading name and battery level when reads fail."
+        from relayr.ble import GattDevice
+        d = GattDevice('F4:D7:AB:6D:EB:D5', use_cache=False)
+        d._index_characteristics(self.chars)
+        d.char_read_hnd = lambda handle: None
+        assert d.read_device_name() is None
+        assert d.read_battery_level() is None
+
+    def test_corrupt_cache_file(self, tmpdir, monkeypatch):
+        "Test ignoring a corrupt cache file."
+        from relayr import config
+        from relayr.ble import GattDevice
+        monkeypatch.setattr(config, 'RELAYR_FOLDER', str(tmpdir))
+        d = GattDevice('F4:D7:AB:6D:EB:D5')
+        d.save_cache()
+        with open(d.cache_path(), 'w') as f:
+            f.write('{"services": [')
+        d = GattDevice('F4:D7:AB:6D:EB:D5')
+        assert d.data['characteristics'] == []
+        assert not d.load_cache()
+
+    def test_cache_file(self, tmpdir, monkeypatch):
+        "Test known characteristics are loaded from the cache file."
+        from relayr import config
+        from relayr.ble import GattDevice
+        monkeypatch.setattr(config, 'RELAYR_FOLDER', str(tmpdir))
+        d = GattDevice('F4:D7:AB:6D:EB:D5')
+        assert d.data['characteristics'] == []
+        d._index_characteristics(self.chars)
+        d.save_cache()
+
+        # no gatttool call needed for known devices
+        d = GattDevice('F4:D7:AB:6D:EB:D5')
+        assert d.characteristics() == self.chars
+        assert d.characteristic(uuid='2a19')['value_handle'] == '0x0029'
+
+
+class FakeGattDevice(object):
+    "A connected device returning a counter value for every read."
+
+    def __init__(self, addr):
+        self.addr = addr
+        self.reads = 0
+        self.session = self
+
+    def connect(self):
+        pass
+
+    def disconnect(self):
+        pass
+
+    def isalive(self):
+        return True
+
+    def characteristic(self, uuid=None, handle=None):
+        return {'2a19': {'value_handle': '0x0029'}}.get(uuid)
+
+    def char_read_hnd(self, handle):
+        self.reads += 1
+        return '%02x' % self.reads
+
+
+class TestBlePoller(object):
+    "Test polling several devices (no root permissions needed)."
+
+    def test_poll(self):
+        "Test polling characteristics at different rates."
+        import time
+        from relayr.ble import BlePoller
+        p = BlePoller(device_class=FakeGattDevice)
+        p.add('F4:D7:AB:6D:EB:D5', '2a19', interval=0.01)
+        p.add('D0:DA:36:13:EB:39', '0x0003', interval=10)
+        p.start()
+        time.sleep(0.2)
+        p.stop()
+        results = []
+        while not p.results.empty():
+            results.append(p.results.get())
+        fast = [r for r in results if r[0] == 'F4:D7:AB:6D:EB:D5']
+        slow = [r for r in results if r[0] == 'D0:DA:36:13:EB:39']
+        assert len(fast) > 5
+        assert fast[:2] == [('F4:D7:AB:6D:EB:D5', '0x0029', '01'),
+            ('F4:D7:AB:6D:EB:D5', '0x0029', '02')]
+        assert slow == [('D0:DA:36:13:EB:39', '0x0003', '01')]
+        stats = p.stats()
+        assert stats['F4:D7:AB:6D:EB:D5']['reads'] == len(fast)
+        assert stats['D0:DA:36:13:EB:39']['errors'] == 0
+
+    def test_connection_limit(self):
+        "Test devices wait for a free connection slot."
+        import time
+        from relayr.ble import BlePoller
+        p = BlePoller(device_class=FakeGattDevice, max_connections=1)
+        p.add('F4:D7:AB:6D:EB:D5', '2a19', interval=0.01)
+        p.add('D0:DA:36:13:EB:39', '2a19', interval=0.01)
+        p.start()
+        time.sleep(0.1)
+        p.stop()
+        connects = [st['connects'] for st in p.stats().values()]
+        assert sorted(connects) == [0, 1]
+
+    def test_failing_callback(self):
+        "Test polling goes on when the callback raises an exception."
+        import time
+        from relayr.ble import BlePoller
+        def callback(addr, handle, value):
+            raise ValueError(value)
+        p = BlePoller(callback, device_class=FakeGattDevice)
+        p.add('F4:D7:AB:6D:EB:D5', '2a19', interval=0.01)
+        p.start()
+        time.sleep(0.1)
+        assert all(t.is_alive() for t in p._threads)
+        p.stop()
+        st = p.stats()['F4:D7:AB:6D:EB:D5']
+        assert st['reads'] > 2 and st['callback_errors'] == st['reads']
+        assert st['connects'] == 1
+
+
+class TestNotifications(object):
+    "Test handling BLE notifications (no root permissions needed)."
+
+    def test_device_callbacks(self):
+        "Test dispatching received values by value handle."
+        from relayr.ble import DeviceCallbacks
+        received = []
+        callbacks = DeviceCallbacks()
+        callbacks.register('0x1d', lambda *args: received.append(args))
+        callbacks('0x001d', '01 00')
+        callbacks('0x0029', '64')
+        callbacks.unregister('0x001d')
+        callbacks('0x001d', '02 00')
+        assert received == [('0x001d', '01 00')]
+
+    def test_cccd_handle(self):
+        "Test finding the configuration descriptor of a value handle."
+        from relayr.ble import GattDevice
+        d = GattDevice('F4:D7:AB:6D:EB:D5', use_cache=False)
+        assert d._cccd_handle('0x001d') == '0x001e'
+        d.data['char-desc'] = [
+            'handle: 0x001d, uuid: 00002016-0000-1000-8000-00805f9b34fb',
+            'handle: 0x001e, uuid: 00002901-0000-1000-8000-00805f9b34fb',
+            'handle: 0x001f, uuid: 00002902-0000-1000-8000-00805f9b34fb',
+        ]
+        assert d._cccd_handle('0x001d') == '0x001f'
+
+
+@pytest.fixture
+def bluezsim(tmpdir, monkeypatch):
+    "Put simulated BlueZ tools with short latencies in front of the PATH."
+    import os
+    from relayr import config
+    from relayr.utils import bluezsim
+    latency = {'scan': 0.01, 'connect': 0.01, 'command': 0, 'notify': 0.01}
+    bindir = bluezsim.install(str(tmpdir.join('bin')), latency=latency)
+    monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+    monkeypatch.setattr(config, 'RELAYR_FOLDER', str(tmpdir))
+    return bluezsim
+
+
+@pytest.mark.skipif(not ON_LINUX, reason="requires Linux")
+class TestBluezSimulator(object):
+    "Test accessing BLE devices via simulated Bluez tools (no root permissions needed)."
+
+    addr = 'F1:42:E6:63:20:A2'
+
+    def test_scan(self, bluezsim):
+        "Test scanning for simulated devices."
+        from relayr.ble import scan_ble_devices
+        devs = scan_ble_devices(name_filter='Wunderbar', timeout=5, max_devices=1)
+        assert devs == [{'addr': self.addr, 'name': 'WunderbarMIC'}]
+
+    def test_gatttool(self, bluezsim):
+        "Test GATT operations spawning one process per operation."
+        from relayr.ble import GattDevice
+        d = GattDevice(self.addr, use_cache=False)
+        assert len(d.primary()) == 5
+        assert len(d.characteristics()) == 14
+        assert d.characteristics(uuid='2016', refresh=True)[0]['value_handle'] == '0x001d'
+        assert d.read_device_name() == 'WunderbarMIC'
+        assert d.read_battery_level() == 100
+        assert d.char_write_req('0x0017', '01')
+
+    def test_session(self, bluezsim):
+        "Test GATT operations and notifications in an interactive session."
+        from relayr.ble import WunderbarGattDevice
+        received = []
+        with WunderbarGattDevice(self.addr) as d:
+            assert len(d.characteristics()) == 14
+            assert d.read_device_name() == 'WunderbarMIC'
+            assert d.char_read_hnd('0x00ff') is None
+            assert d.subscribe('2016', lambda *args: received.append(args))
+            d.listen(0.5)
+        assert received[:2] == [('0x001d', '2a 00'), ('0x001d', '2b 00')]
+
+    def test_unknown_device(self, bluezsim):
+        "Test connecting to a device not in the transcript."
+        from relayr.ble import GattDevice
+        from relayr.exceptions import RelayrException
+        d = GattDevice('00:00:00:00:00:00', timeout=2, use_cache=False)
+        with pytest.raises(RelayrException):
+            d.connect()
+
+
+class TestCodecs(object):
+    "Test converting and decoding GATT values (no root permissions needed)."
+
+    def test_hex_bytes(self):
+        "Test converting between hex digit strings and bytes."
+        from relayr.ble import hex2bytes, bytes2hex, data2str, str2data
+        assert hex2bytes('57 75 6e 64 65 72') == b'Wunder'
+        assert hex2bytes('00ff0a') == b'\x00\xff\x0a'
+        assert bytes2hex(b'\x00\xff\x0a') == '00 ff 0a'
+        assert bytes2hex(bytearray(b'IR')) == '49 52'
+        assert data2str('57 75 6e 64 65 72 62 61 72 49 52') == 'WunderbarIR'
+        assert str2data('WunderbarIR') == '57 75 6e 64 65 72 62 61 72 49 52'
+        assert str2data('\n') == '0a'
+        assert data2str('') == ''
+
+    def test_decode_wunderbar(self):
+        "Test decoding WunderBar sensor values."
+        from relayr.ble import decode_wunderbar
+        assert decode_wunderbar('mic', '2a 00') == {'noise_level': 42}
+        htu = decode_wunderbar('htu', b'\x66\x08\x10\x10')
+        assert abs(htu['temperature'] - 21.5) < 1e-9
+        assert abs(htu['humidity'] - 41.12) < 1e-9
+        gyro = decode_wunderbar('gyro', '9c ff ff ff 00 00 00 00 64 00 00 00 '
+            '00 00 9c ff 64 00')
+        assert abs(gyro['gyro_x'] + 1) < 1e-9
+        assert abs(gyro['acc_y'] + 1) < 1e-9
+        assert abs(gyro['acc_z'] - 1) < 1e-9
+
+    def test_decode_batch(self):
+        "Test decoding many values into NumPy arrays."
+        numpy = pytest.importorskip('numpy')
+        from relayr.ble import decode_wunderbar_batch
+        res = decode_wunderbar_batch('htu', ['66 08 10 10', b'\x00\x00\x00\x00'])
+        assert numpy.allclose(res['temperature'], [21.5, 0])
+        assert numpy.allclose(res['humidity'], [41.12, 0])
+        with pytest.raises(ValueError):
+            decode_wunderbar_batch('htu', ['66 08'])
+
+
+class TestAdapterPool(object):
+    "Test assigning devices to Bluetooth adapters (no root permissions needed)."
+
+    def test_assign(self):
+        "Test assigning devices to the least loaded adapter."
+        from relayr.ble import AdapterPool
+        pool = AdapterPool(['hci0', 'hci1'])
+        assert pool.assign('A', load=2.0) == 'hci0'
+        assert pool.assign('B', load=0.5) == 'hci1'
+        assert pool.assign('C', load=0.5) == 'hci1'
+        assert pool.assign('D', load=1.0) == 'hci1'
+        assert pool.assign('A') == 'hci0'
+        pool.release('A')
+        assert pool.loads['hci0'] == 0
+        assert pool.assign('E') == 'hci0'
+
+    def test_acquire(self):
+        "Test moving devices to adapters with free connection slots."
+        import threading
+        from relayr.ble import AdapterPool
+        pool = AdapterPool(['hci0', 'hci1'], max_connections=1)
+        assert pool.assign('A', load=0.1) == 'hci0'
+        assert pool.assign('B', load=1.0) == 'hci1'
+        assert pool.assign('C', load=0.1) == 'hci0'
+        assert pool.acquire('A') == 'hci0'
+        # hci0 is full, so C moves to hci1 although it is more loaded
+        assert pool.acquire('C') == 'hci1'
+        assert pool.assign('C') == 'hci1'
+        assert pool.loads['hci0'] == 0.1
+        acquired = []
+        t = threading.Thread(target=lambda: acquired.append(pool.acquire('B')))
+        t.start()
+        t.join(0.1)
+        assert acquired == []
+        pool.release_slot('hci0')
+        t.join(1)
+        assert acquired == ['hci0']
+
+    def test_gatttool_adapter(self):
+        "Test selecting the adapter used by gatttool."
+        from relayr.ble import GattDevice
+        d = GattDevice('F4:D7:AB:6D:EB:D5', use_cache=False, hci_name='hci1')
+        assert d._gatttool_args() == '-i hci1 -t random -b F4:D7:AB:6D:EB:D5'
+
+    @pytest.mark.skipif(not ON_LINUX, reason="requires Linux")
+    def test_poll_adapters(self, tmpdir, monkeypatch):
+        "Test polling simulated devices via two simulated adapters."
+        import os
+        import time
+        import copy
+        from relayr import config
+        from relayr.ble import BlePoller, list_adapters
+        from relayr.utils import bluezsim
+        transcript = copy.deepcopy(bluezsim.DEFAULT_TRANSCRIPT)
+        dev = transcript['devices'].pop('F1:42:E6:63:20:A2')
+        addrs = ['F1:42:E6:63:20:A%d' % i for i in range(4)]
+        for addr in addrs:
+            transcript['devices'][addr] = dev
+        latency = {'connect': 0.01, 'command': 0.01}
+        bindir = bluezsim.install(str(tmpdir.join('bin')), transcript,
+            latency=latency, adapters=['hci0', 'hci1'])
+        monkeypatch.setenv('PATH', bindir + os.pathsep + os.environ['PATH'])
+        monkeypatch.setattr(config, 'RELAYR_FOLDER', str(tmpdir))
+        assert list_adapters() == ['hci0', 'hci1']
+        p = BlePoller(adapters=list_adapters())
+        for addr in addrs:
+            p.add(addr, '0x0029', interval=0.05)
+        p.start()
+        time.sleep(2)
+        p.stop()
+        stats = p.stats()
+        assert sorted(st['adapter'] for st in stats.values()) == \
+            ['hci0', 'hci0', 'hci1', 'hci1']
+        assert all(st['reads'] > 0 for st in stats.values())
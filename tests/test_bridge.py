@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the BLE to cloud bridge (no network or root permissions needed).
+"""
+
+import threading
+try:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+
+import pytest
+
+
+class FakeApi(object):
+    "A stand-in for the API recording posted data, optionally failing."
+
+    def __init__(self):
+        self.session = None
+        self.posted = []
+        self.online = True
+
+    def post_device_data(self, deviceID, data):
+        import requests
+        if not self.online:
+            raise requests.ConnectionError('offline')
+        self.posted.append((deviceID, data))
+
+
+class ProxyErrorHandler(BaseHTTPRequestHandler):
+    "Answers posts with a proxy error page until the server's ``failures`` are used up."
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        body = b'{"database": "ok"}'
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.server.failures > 0:
+            self.server.failures -= 1
+            status, body, ctype = 502, b'<html>Bad Gateway</html>', 'text/html'
+        else:
+            self.server.posted += 1
+            status, body, ctype = 200, b'{}', 'application/json'
+        self.send_response(status)
+        self.send_header('Content-Type', ctype)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+@pytest.fixture
+def proxy(monkeypatch):
+    "Run a server failing like a proxy in a thread and point the configuration to it."
+    from relayr import config
+    server = HTTPServer(('localhost', 0), ProxyErrorHandler)
+    server.failures = 1
+    server.posted = 0
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    monkeypatch.setattr(config, 'relayrAPI', 'http://localhost:%d' % server.server_port)
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+class TestBleBridge(object):
+    "Test buffering, batching and spooling readings."
+
+    def test_batches(self, tmpdir):
+        "Test uploading buffered readings in batches per device."
+        from relayr.bridge import BleBridge
+        api = FakeApi()
+        bridge = BleBridge(api, batch_size=3, spool_dir=str(tmpdir))
+        assert api.session is not None
+        bridge.add_device('F1:42:E6:63:20:A2', 'mic-id', kind='mic')
+        bridge.add_device('F1:42:E6:63:20:A3', 'raw-id')
+        for i in range(4):
+            bridge('F1:42:E6:63:20:A2', '0x001d', '2a 00')
+        bridge('F1:42:E6:63:20:A3', '0x0029', '64')
+        bridge.flush()
+        sizes = [(deviceID, len(data['readings'])) for deviceID, data in api.posted]
+        assert sizes == [('mic-id', 3), ('mic-id', 1), ('raw-id', 1)]
+        reading = api.posted[0][1]['readings'][0]
+        assert reading['meaning'] == 'noise_level' and reading['value'] == 42
+        assert api.posted[2][1]['readings'][0]['value'] == '64'
+        assert bridge.uploaded == 5 and bridge.pending() == 0
+
+    def test_ignored(self, tmpdir):
+        "Test ignoring values of unmapped devices and undecodable values."
+        from relayr.bridge import BleBridge
+        bridge = BleBridge(FakeApi(), spool_dir=str(tmpdir))
+        bridge.add_device('F1:42:E6:63:20:A2', 'mic-id', kind='mic')
+        bridge('00:00:00:00:00:00', '0x001d', '2a 00')
+        bridge('F1:42:E6:63:20:A2', '0x001d', '2a')
+        bridge('F1:42:E6:63:20:A2', '0x001d', 'zz zz')
+        assert bridge.ignored == 3 and bridge.pending() == 0
+
+    def test_store_and_forward(self, tmpdir):
+        "Test spooling readings while offline and uploading them later."
+        from relayr.bridge import BleBridge
+        api = FakeApi()
+        bridge = BleBridge(api, spool_dir=str(tmpdir), retry_interval=0)
+        api.online = False
+        bridge.put('dev-id', [{'meaning': 'temperature', 'value': 1}])
+        bridge.flush()
+        bridge.put('dev-id', [{'meaning': 'temperature', 'value': 2}])
+        bridge.flush()
+        assert len(tmpdir.listdir()) == 2
+        assert bridge.spooled == 2 and bridge.pending() == 2
+        api.online = True
+        bridge.put('dev-id', [{'meaning': 'temperature', 'value': 3}])
+        bridge.flush()
+        values = [data['readings'][0]['value'] for deviceID, data in api.posted]
+        assert values == [1, 2, 3]
+        assert tmpdir.listdir() == []
+
+    def test_thread(self, tmpdir):
+        "Test uploading from the background thread."
+        import time
+        from relayr.bridge import BleBridge
+        api = FakeApi()
+        bridge = BleBridge(api, batch_size=2, flush_interval=10,
+            spool_dir=str(tmpdir))
+        bridge.start()
+        bridge.put('dev-id', [{'meaning': 'a', 'value': 1}] * 2)
+        for i in range(100):
+            if api.posted:
+                break
+            time.sleep(0.01)
+        assert len(api.posted) == 1
+        bridge.put('dev-id', [{'meaning': 'a', 'value': 1}])
+        bridge.stop()
+        assert bridge.uploaded == 3
+
+    def test_proxy_error(self, tmpdir, proxy):
+        "Test keeping readings if the upload fails with a response that is no JSON."
+        from relayr.api import Api
+        from relayr.bridge import BleBridge
+        from relayr.retry import RetryPolicy
+        api = Api(retry=RetryPolicy(retries=0))
+        bridge = BleBridge(api, spool_dir=str(tmpdir), retry_interval=0)
+        bridge.put('dev-1', [{'meaning': 'a', 'value': 1}])
+        bridge.put('dev-2', [{'meaning': 'a', 'value': 2}])
+        bridge.flush()
+        assert bridge.errors == 1 and bridge.uploaded == 0
+        assert bridge.spooled == 2 and bridge.pending() == 2
+        bridge.flush()
+        assert proxy.posted == 2 and bridge.uploaded == 2
+        assert bridge.pending() == 0
+
+    def test_thread_survives(self, tmpdir):
+        "Test the upload thread keeps running after failing to spool."
+        import time
+        from relayr.bridge import BleBridge
+        api = FakeApi()
+        api.online = False
+        spool_file = tmpdir.join('spool')
+        spool_file.write('')
+        bridge = BleBridge(api, batch_size=1, spool_dir=str(spool_file.join('sub')),
+            retry_interval=0)
+        bridge.start()
+        bridge.put('dev-id', [{'meaning': 'a', 'value': 1}])
+        for i in range(100):
+            if bridge.errors:
+                break
+            time.sleep(0.01)
+        assert bridge.errors == 1
+        assert bridge._thread.is_alive()
+        api.online = True
+        bridge.put('dev-id', [{'meaning': 'a', 'value': 2}])
+        bridge.stop()
+        assert bridge.uploaded == 1
@@ -0,0 +1,79 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the compact resource representation (no network needed).
+"""
+
+import pytest
+
+
+MODEL = {
+    'id': 'a7ec1b21-8582-4304-b1cf-15a1fc66d1e8',
+    'name': 'Wunderbar Thermometer & Humidity Sensor',
+    'manufacturer': 'Relayr GmbH',
+    'readings': [
+        {'meaning': 'temperature', 'unit': 'celsius', 'minimum': -100,
+            'maximum': 100, 'precision': 0.25},
+        {'meaning': 'humidity', 'unit': 'percent', 'minimum': 0,
+            'maximum': 100, 'precision': 0.25},
+    ],
+}
+
+
+def device_json(i, model=MODEL):
+    return {'id': 'device-%d' % i, 'name': 'sensor %d' % i, 'public': True,
+        'owner': '-'.join(['owner', '1']), 'firmwareVersion': '1.0.0', 'model': dict(model),
+        'integrationType': 'wunderbar1'}
+
+
+class TestCompactResources(object):
+    "Test slotted resources with shared models and interned strings."
+
+    def test_round_trip(self):
+        "Test keeping known and unknown fields."
+        from relayr.compact import CompactDevice
+        data = device_json(1)
+        dev = CompactDevice.from_json(data)
+        assert not hasattr(dev, '__dict__')
+        assert dev.name == 'sensor 1'
+        assert dev.integrationType == 'wunderbar1'
+        assert dev.description is None
+        assert dev.to_json() == data
+        dev.color = 'red'
+        assert dev.to_json()['color'] == 'red'
+        with pytest.raises(AttributeError):
+            dev.unknown
+
+    def test_sharing(self):
+        "Test sharing models and interning repeated strings."
+        from relayr.compact import CompactDevice
+        models = {}
+        a = CompactDevice.from_json(device_json(1), models)
+        b = CompactDevice.from_json(device_json(2), models)
+        assert a.model is b.model
+        assert list(models) == [MODEL['id']]
+        assert a.owner is b.owner
+        meanings = [r.meaning for r in a.model.readings]
+        assert meanings == ['temperature', 'humidity']
+        # a model seen first by its ID only is filled in later
+        models = {}
+        c = CompactDevice.from_json(dict(device_json(3), model=MODEL['id']), models)
+        assert c.model.name is None
+        d = CompactDevice.from_json(device_json(4), models)
+        assert c.model is d.model
+        assert c.model.readings[1].unit == 'percent'
+
+    def test_string_pool(self):
+        "Test sharing non-native strings through a pool per load."
+        from relayr.compact import CompactDevice, intern_string
+        strings = {}
+        owner = b'owner' if str is not bytes else u'owner'
+        a = CompactDevice.from_json({'id': 'a', 'owner': owner + owner[:0]},
+            strings=strings)
+        b = CompactDevice.from_json({'id': 'b', 'owner': owner[:2] + owner[2:]},
+            strings=strings)
+        assert a.owner is b.owner
+        assert list(strings.values()) == [owner]
+        assert intern_string(owner[:2] + owner[2:]) is not a.owner
+        native = ''.join(['own', 'er'])
+        assert intern_string(native) is intern_string('owner')
@@ -258,3 +258,162 @@ class TestDynmicMqttStreams(object):
         time.sleep(5)
 
         stream.stop()
+
+
+class TestDataHubs(object):
+    "Test selecting the data hub per connection at runtime."
+
+    def test_get_hub(self):
+        "Test getting the connection classes of the default data hubs."
+        from relayr.dataconnection import get_hub, \
+            PubnubDataConnection, MqttStream
+        assert get_hub('PubNub') == PubnubDataConnection
+        assert get_hub('MQTT') == MqttStream
+
+    def test_get_unknown_hub(self):
+        "Test getting a data hub that was never registered."
+        from relayr.dataconnection import get_hub
+        from relayr.exceptions import RelayrException
+        with pytest.raises(RelayrException):
+            get_hub('CarrierPigeon')
+
+    def test_connect_registered_hub(self):
+        "Test connecting to a device via a newly registered data hub."
+        from relayr.dataconnection import hubs, register_hub, connect
+
+        class DummyConnection(object):
+            def __init__(self, callback, device, appID):
+                self.callback = callback
+                self.device = device
+                self.appID = appID
+
+            @classmethod
+            def for_device(cls, callback, device, appID=None):
+                return cls(callback, device, appID)
+
+        register_hub('Dummy', DummyConnection)
+        try:
+            conn = connect(len, 'device', appID='app', hub='Dummy')
+            assert isinstance(conn, DummyConnection)
+            assert (conn.callback, conn.device, conn.appID) == \
+                (len, 'device', 'app')
+        finally:
+            del hubs['Dummy']
+
+
+class TestKeyedDispatcher(object):
+    "Test dispatching messages by key to worker threads."
+
+    def test_order_per_key(self):
+        "Test messages with the same key are handled in order."
+        import threading
+        from relayr.dataconnection import KeyedDispatcher
+        received = {}
+        lock = threading.Lock()
+
+        def callback(topic, payload):
+            with lock:
+                received.setdefault(topic, []).append(payload)
+
+        d = KeyedDispatcher(callback, workers=4)
+        d.start()
+        for i in range(100):
+            d('/v1/%d' % (i % 10), i)
+        d.stop()
+        assert d.depths() == {}
+        for j in range(10):
+            assert received['/v1/%d' % j] == list(range(j, 100, 10))
+
+    def test_depths(self):
+        "Test reporting the number of pending messages per key."
+        import threading
+        from relayr.dataconnection import KeyedDispatcher
+        release = threading.Event()
+
+        d = KeyedDispatcher(lambda topic, payload: release.wait(), workers=2)
+        d.start()
+        for i in range(3):
+            d('/v1/hot', i)
+        d('/v1/cold', 0)
+        assert d.depth('/v1/hot') == 3
+        assert d.hot_keys(1) == [('/v1/hot', 3)]
+        release.set()
+        d.stop()
+        assert d.depth('/v1/hot') == 0
+
+    def test_failing_callback(self):
+        "Test a failing callback does not stop the worker thread."
+        from relayr.dataconnection import KeyedDispatcher
+        received = []
+
+        def callback(message, channel):
+            if message is None:
+                raise ValueError
+            received.append(message)
+
+        d = KeyedDispatcher(callback, workers=1,
+            key=lambda message, channel: channel)
+        d.start()
+        d(None, 'ch')
+        d({'ts': 1}, 'ch')
+        d.stop()
+        assert d.errors == 1
+        assert received == [{'ts': 1}]
+
+
+class FakeDevice(object):
+    "A device creating MQTT channel credentials without API access."
+
+    def __init__(self, id):
+        self.id = id
+
+    def create_channel(self, transport):
+        return {'channelId': 'ch-' + self.id,
+            'credentials': {'topic': '/v1/ch-' + self.id}}
+
+
+class FakeMessage(object):
+    "A stand-in for a received paho MQTT message."
+
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload.encode('utf-8')
+
+
+class TestMqttStreamRouting(object):
+    "Test routing MQTT messages to the devices they belong to."
+
+    def test_callback_with_device(self):
+        "Test the callback gets the device resolved from the topic."
+        from relayr.dataconnection import MqttStream
+        received = []
+        devs = [FakeDevice('a'), FakeDevice('b')]
+        stream = MqttStream(lambda *args: received.append(args), devs,
+            with_device=True)
+        assert stream.device_for('/v1/ch-b') is devs[1]
+        stream.on_message(None, None, FakeMessage('/v1/ch-b', '{}'))
+        assert received == [('/v1/ch-b', '{}', devs[1])]
+
+    def test_device_handlers(self):
+        "Test registering and removing per-device handlers."
+        from relayr.dataconnection import MqttStream
+
+        class FakeClient(object):
+            def unsubscribe(self, topic):
+                pass
+
+        default, handled = [], []
+        devs = [FakeDevice('a'), FakeDevice('b')]
+        stream = MqttStream(lambda *args: default.append(args), devs)
+        stream.client = FakeClient()
+        stream.on(devs[0], lambda *args: handled.append(args))
+        stream.on_message(None, None, FakeMessage('/v1/ch-a', '1'))
+        stream.on_message(None, None, FakeMessage('/v1/ch-b', '2'))
+        assert handled == [('/v1/ch-a', '1')]
+        assert default == [('/v1/ch-b', '2')]
+
+        stream.remove_device(devs[0])
+        assert stream.topics == ['/v1/ch-b']
+        assert stream.device_for('/v1/ch-a') is None
+        stream.on_message(None, None, FakeMessage('/v1/ch-a', '3'))
+        assert handled == [('/v1/ch-a', '1')]
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+"""
+Tests for the multiprocess data pipeline.
+
+These tests use local worker processes only and need no network connection.
+"""
+
+import os
+import sys
+import time
+import threading
+
+import pytest
+
+
+ON_WINDOWS = sys.platform.startswith("win")
+
+
+def double(topic, payload):
+    "Handler running in a worker process."
+    if payload == 'fail':
+        raise ValueError(payload)
+    return 2 * int(payload)
+
+
+def exit_on_die(topic, payload):
+    "Handler ending its worker process abruptly for a 'die' payload."
+    if payload == 'die':
+        os._exit(1)
+    return payload
+
+
+class TestRingBuffer(object):
+    "Test the shared memory ring buffer."
+
+    def test_put_get(self):
+        "Test records keep their order when wrapping around the buffer end."
+        from relayr.pipeline import RingBuffer
+        rb = RingBuffer(size=32)
+        for i in range(20):
+            record = ('record-%d' % i).encode('utf-8')
+            assert rb.put(record)
+            assert rb.get() == record
+
+    def test_timeouts(self):
+        "Test timeouts for an empty and a full buffer."
+        from relayr.pipeline import RingBuffer
+        rb = RingBuffer(size=16)
+        assert rb.get(timeout=0.01) is None
+        assert rb.put(b'12345678')
+        assert not rb.put(b'12345678', timeout=0.01)
+
+    def test_too_large_record(self):
+        "Test putting a record larger than the buffer."
+        from relayr.pipeline import RingBuffer
+        rb = RingBuffer(size=16)
+        with pytest.raises(ValueError):
+            rb.put(b'x' * 16)
+
+
+@pytest.mark.skipif(ON_WINDOWS, reason="requires forking worker processes")
+class TestPipeline(object):
+    "Test processing messages in worker processes."
+
+    def test_device_order(self):
+        "Test results of each topic are delivered in submission order."
+        from relayr.pipeline import Pipeline
+        results = {}
+        errors = []
+        lock = threading.Lock()
+
+        def collect(topic, result):
+            with lock:
+                results.setdefault(topic, []).append(result)
+
+        p = Pipeline(double, collect, lambda t, e: errors.append(t),
+            workers=3, batch_size=7)
+        p.start()
+        topics = ['/v1/device-%d' % i for i in range(5)]
+        for i in range(200):
+            p.submit(topics[i % 5], str(i))
+        p.submit(topics[0], 'fail')
+        p.stop()
+
+        assert p.submitted == p.processed == 201
+        assert p.errors == 1 and errors == [topics[0]]
+        for j, topic in enumerate(topics):
+            assert results[topic] == [2 * i for i in range(j, 200, 5)]
+
+    def test_stop_robustness(self):
+        "Test stopping a pipeline never started or with a dead worker."
+        from relayr.pipeline import Pipeline
+        Pipeline(double, workers=1).stop()
+        pipeline = Pipeline(exit_on_die, workers=1, batch_size=1)
+        pipeline.start()
+        pipeline.submit('t', 'die')
+        pipeline._processes[0].join(10)
+        pipeline.submit('t', 'late')
+        t0 = time.time()
+        pipeline.stop(timeout=2)
+        assert time.time() - t0 < 10
+
+    def test_failing_callback(self):
+        "Test failing result callbacks are counted and do not block the pipeline."
+        from relayr.pipeline import Pipeline
+        results = []
+
+        def collect(topic, result):
+            if result % 4 == 0:
+                raise RuntimeError('callback bug')
+            results.append(result)
+
+        p = Pipeline(double, collect, workers=1, batch_size=1,
+            buffer_size=256)
+        p.start()
+        for i in range(200):
+            p.submit('t', str(i))
+        p.stop()
+        assert p.processed == 200
+        assert p.callback_errors == 100
+        assert results == [2 * i for i in range(1, 200, 2)]